@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of hot paths on synthetic target tree: scan, descriptor comparison, archiving,
+transfer into local stand-in destination and server verification with retention.
+Tree is generated from seed, so runs with the same parameters are comparable across versions.
+Each run appends one JSON line with timings of all stages to output file.
+"""
+from __future__ import print_function
+import sys
+import os
+import io
+import json
+import math
+import time
+import random
+import shutil
+import logging
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'client'))
+sys.path.insert(0, os.path.join(ROOT, 'server'))
+
+import dirtool
+import storetool
+import systool
+import copytool
+import backup_tool
+import catalog
+import chunkstore
+import hashtool
+
+MB = 1024.0 * 1024.0
+WORDS = [u'alpha', u'beta', u'gamma', u'delta', u'backup', u'archive', u'target', u'server', u'client', u'\n']
+
+
+class TreeGenerator(object):
+    """
+    Synthetic target: random directory tree, lognormal file sizes with given mean,
+    given share of files with random (incompressible) content, the rest is text of few words.
+    """
+    def __init__(self, path, files, dirs, mean_kb, max_mb, incompressible, seed):
+        self.path = path
+        self.files = files
+        self.dirs = dirs
+        self.mean_kb = mean_kb
+        self.max_bytes = int(max_mb * MB)
+        self.incompressible = incompressible
+        self.random = random.Random(seed)
+        self.__dir_list = [u'']
+        self.__file_list = []
+        self.__next_id = 0
+
+    def __size(self):
+        sigma = 1.0
+        mu = math.log(self.mean_kb * 1024.0) - sigma * sigma / 2
+        return min(int(self.random.lognormvariate(mu, sigma)), self.max_bytes)
+
+    def __content(self, size):
+        if self.random.random() < self.incompressible:
+            return os.urandom(size)
+        words = []
+        length = 0
+        while length < size:
+            word = self.random.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return u' '.join(words).encode('utf8')[:size]
+
+    def __write(self, rel_path):
+        with io.open(os.path.join(self.path, rel_path), 'wb') as out_file:
+            out_file.write(self.__content(self.__size()))
+
+    def __add_file(self):
+        rel_path = os.path.join(self.random.choice(self.__dir_list), u'file%07d.dat' % self.__next_id)
+        self.__next_id += 1
+        self.__write(rel_path)
+        self.__file_list.append(rel_path)
+
+    def generate(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        for n in range(self.dirs):
+            rel_dir = os.path.join(self.random.choice(self.__dir_list), u'dir%05d' % n)
+            os.mkdir(os.path.join(self.path, rel_dir))
+            self.__dir_list.append(rel_dir)
+        for _ in range(self.files):
+            self.__add_file()
+
+    def change(self, rate):
+        """
+        Rewrite rate share of files, add and delete half as many
+        """
+        count = int(len(self.__file_list) * rate)
+        for rel_path in self.random.sample(self.__file_list, count):
+            self.__write(rel_path)
+        for rel_path in self.random.sample(self.__file_list, count // 2):
+            os.remove(os.path.join(self.path, rel_path))
+            self.__file_list.remove(rel_path)
+        for _ in range(count // 2):
+            self.__add_file()
+        # file times have one second resolution in descriptor
+        time.sleep(1)
+
+
+def _timed(stages, name, function, *args, **kwargs):
+    started = time.time()
+    try:
+        res = function(*args, **kwargs)
+        error = None
+    except Exception as err:
+        res = None
+        error = str(err)
+    stages[name] = {u'seconds': time.time() - started}
+    if error is not None:
+        stages[name][u'error'] = error
+    return res
+
+
+def _rate(stage, size):
+    stage[u'bytes'] = size
+    if stage[u'seconds'] > 0:
+        stage[u'mb_per_sec'] = size / MB / stage[u'seconds']
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', '-C', ROOT, 'rev-parse', 'HEAD']).strip().decode('utf8')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_once(target, work_path, stored_file, run_number):
+    stages = {}
+    actual = dirtool.DirDescriptor(target)
+    _timed(stages, u'scan', actual.load_actual_state)
+    stages[u'scan'][u'files'] = len(actual.metadata[u'files'])
+    stages[u'scan'][u'dirs'] = len(actual.metadata[u'subdirs'])
+    source_bytes = sum(int(r[2]) for r in actual.metadata[u'files'])
+    _rate(stages[u'scan'], source_bytes)
+
+    if os.path.exists(stored_file):
+        stored = dirtool.DirDescriptor(target)
+        stored.load_stored_state(stored_file)
+        pruned = dirtool.DirDescriptor(target)
+        _timed(stages, u'scan_pruned', pruned.load_actual_state, stored)
+
+        def compare():
+            with storetool.DescriptorStore(stored_file) as store:
+                return actual.matches_store(store)
+        same = _timed(stages, u'compare', compare)
+        stages[u'compare'][u'same'] = same
+    actual.save_to_store(stored_file)
+
+    temp_path = os.path.join(work_path, u'temp')
+    dest_path = os.path.join(work_path, u'dest')
+    suffix = '-run%03d' % run_number
+    res = _timed(stages, u'archive', systool.make_archived_file, target, temp_path,
+                 name_suffix=suffix, streaming=True)
+    if res is None or res[0] is None:
+        stages[u'archive'].setdefault(u'error', u'archive not made')
+        return stages
+    archive_bytes = os.path.getsize(res[1])
+    _rate(stages[u'archive'], source_bytes)
+    stages[u'archive'][u'ratio'] = float(archive_bytes) / source_bytes if source_bytes > 0 else 1.0
+
+    def transfer():
+        return [copytool.transfer_file(f, dest_path, retries=0, remove_source=True) for f in (res[1], res[0])]
+    _timed(stages, u'transfer', transfer)
+    _rate(stages[u'transfer'], archive_bytes)
+
+    def verify():
+        chunk_index = chunkstore.ChunkIndex(os.path.join(dest_path, u'chunks'))
+        with catalog.ArchiveCatalog(dest_path) as archive_catalog:
+            backup_tool.process_archives([os.path.basename(res[1])], dest_path, chunk_index, archive_catalog,
+                                         hashtool.default_workers(), 3)
+    _timed(stages, u'verify', verify)
+    _rate(stages[u'verify'], archive_bytes)
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark scan, archive, transfer and verify stages.')
+    parser.add_argument('--work', default=u'/tmp/backup_bench', help='directory for generated tree and results')
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--dirs', type=int, default=200)
+    parser.add_argument('--mean-kb', type=float, default=32.0, help='mean file size')
+    parser.add_argument('--max-mb', type=float, default=64.0, help='largest file size')
+    parser.add_argument('--incompressible', type=float, default=0.3, help='share of files with random content')
+    parser.add_argument('--change-rate', type=float, default=0.05, help='share of files changed between runs')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='JSON lines file, <work>/results.jsonl by default')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+    work_path = os.path.abspath(args.work).decode('utf8')
+    target = os.path.join(work_path, u'tree')
+    for sub_dir in (u'temp', u'dest'):
+        if os.path.exists(os.path.join(work_path, sub_dir)):
+            shutil.rmtree(os.path.join(work_path, sub_dir))
+        os.makedirs(os.path.join(work_path, sub_dir))
+    stored_file = os.path.join(work_path, u'tree' + storetool.STORE_EXTENSION)
+    if os.path.exists(stored_file):
+        os.remove(stored_file)
+    output = args.output if args.output is not None else os.path.join(work_path, u'results.jsonl')
+
+    generator = TreeGenerator(target, args.files, args.dirs, args.mean_kb, args.max_mb,
+                              args.incompressible, args.seed)
+    started = time.time()
+    generator.generate()
+    generate_seconds = time.time() - started
+
+    params = dict((k, v) for k, v in vars(args).items() if k not in ('work', 'output'))
+    for run_number in range(args.runs):
+        if run_number > 0:
+            generator.change(args.change_rate)
+        stages = run_once(target, work_path, stored_file, run_number)
+        result = {u'time': time.time(), u'commit': _commit(), u'params': params, u'run': run_number,
+                  u'generate_seconds': generate_seconds, u'stages': stages}
+        line = json.dumps(result, sort_keys=True)
+        with io.open(output, 'a', encoding='utf8') as out_file:
+            out_file.write(line.decode('utf8') + u'\n')
+        print(u' '.join(u'{0}={1:.3f}s'.format(name, stage[u'seconds'])
+                        for name, stage in sorted(stages.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import json
+import hashlib
+import logging
+
+CACHE_SUFFIX = u'.content.json'
+HASH_BUFFER_SIZE = 1024 * 1024
+NS = 1000000000
+
+
+def cache_file_name(path, target):
+    key = hashlib.sha1(os.path.abspath(target).encode('utf8')).hexdigest()[:16]
+    return os.path.join(path, key.decode('utf8') + CACHE_SUFFIX)
+
+
+def _time_ns(sys_info, name):
+    # python 2 stat has float times only, its resolution is below microsecond
+    value = getattr(sys_info, name + '_ns', None)
+    if value is None:
+        value = int(round(getattr(sys_info, name) * NS))
+    return value
+
+
+def file_key(sys_info):
+    return [sys_info.st_dev, sys_info.st_ino, sys_info.st_size,
+            _time_ns(sys_info, 'st_mtime'), _time_ns(sys_info, 'st_ctime')]
+
+
+def content_hash(path):
+    sha_obj = hashlib.sha1()
+    with io.open(path, 'rb') as source_file:
+        while True:
+            data = source_file.read(HASH_BUFFER_SIZE)
+            if not data:
+                break
+            sha_obj.update(data)
+    return sha_obj.hexdigest().decode('utf8')
+
+
+class ContentCache(object):
+    """
+    Persistent content hashes of files of one target, by relative path: [dev, inode, size, mtime_ns, ctime_ns, hash].
+    File is read again only when its key differs from cached one, any write changes ctime at least.
+    Cache is saved after scan only if some file was hashed or is gone, so unchanged target costs no write.
+    Change which keeps size and mtime second (file record of descriptor) is flagged by 1 after hash,
+    until archive of the target is done, as incremental archive can not find it by records.
+    """
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.__entries = {}
+        self.__seen = {}
+        self.hashed_files = 0
+        self.hashed_bytes = 0
+        if os.path.exists(cache_file):
+            try:
+                with io.open(cache_file, 'r', encoding='utf8') as source_file:
+                    self.__entries = json.loads(source_file.read())
+            except ValueError:
+                logging.warning('Content cache %s is damaged, files are hashed again.', cache_file.encode('utf8'))
+
+    def content(self, rel_path, path, sys_info=None):
+        """
+        Content hash of file; without stat result (entry taken from stored descriptor) cached hash is trusted.
+        Unreadable file gets empty hash, so it is reported as changed.
+        """
+        entry = self.__entries.get(rel_path)
+        if sys_info is None:
+            if entry is not None:
+                self.__seen[rel_path] = entry
+                return entry[5]
+            try:
+                sys_info = os.stat(path)
+            except OSError:
+                return u''
+        key = file_key(sys_info)
+        if entry is None or entry[:5] != key:
+            try:
+                new_hash = content_hash(path)
+            except IOError as ioe:
+                logging.error('Can not read %s: %s', path.encode('utf8'), str(ioe))
+                return u''
+            hidden = entry is not None and (len(entry) > 6 or (entry[5] != new_hash and entry[2] == key[2] and
+                                                               entry[3] // NS == key[3] // NS))
+            entry = key + [new_hash] + ([1] if hidden else [])
+            self.hashed_files += 1
+            self.hashed_bytes += sys_info.st_size
+        self.__seen[rel_path] = entry
+        return entry[5]
+
+    def hidden_changes(self):
+        return set(rel_path for rel_path, entry in self.__entries.items() if len(entry) > 6)
+
+    def commit(self):
+        """
+        Archive of the target is done, flags of hidden changes are cleared
+        """
+        if len(self.hidden_changes()) > 0:
+            self.__write(dict((rel_path, entry[:6]) for rel_path, entry in self.__entries.items()))
+
+    def save(self):
+        if self.hashed_files == 0 and len(self.__seen) == len(self.__entries):
+            return
+        self.__write(self.__seen)
+
+    def __write(self, entries):
+        json_string = json.dumps(entries, ensure_ascii=False)
+        if isinstance(json_string, bytes):
+            json_string = json_string.decode('utf8')
+        with io.open(self.cache_file + u'.tmp', 'w', encoding='utf8') as cache_out:
+            cache_out.write(json_string)
+        os.rename(self.cache_file + u'.tmp', self.cache_file)
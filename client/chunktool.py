@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import json
+import zlib
+import hashlib
+import logging
+import subprocess
+import systool
+
+CHUNK_MIN_SIZE = 32 * 1024
+CHUNK_MAX_SIZE = 512 * 1024
+READ_SIZE = 4 * 1024 * 1024
+INDEX_FILE_NAME = u'index.json'
+MANIFEST_SUFFIX = u'.chunks.json'
+
+# Each byte is mapped to one bit and chunk ends right after 15 bits forming the pattern.
+# Boundary depends only on the last 15 bytes, so inserted or removed data moves
+# boundaries with it and the rest of chunks stay the same.
+_BIT_TABLE = b''.join([b'1' if bytearray(hashlib.sha256(bytearray([b])).digest())[0] & 1 else b'0'
+                       for b in range(256)])
+_BOUNDARY = b'101100111000101'
+
+_stores = {}
+
+
+def _find_cut(bits, start, end, min_size, max_size):
+    """
+    End of chunk starting at start, or -1 if more data is needed to find it
+    """
+    limit = min(end, start + max_size)
+    pos = bits.find(_BOUNDARY, start + min_size - len(_BOUNDARY), limit)
+    if pos >= 0:
+        return pos + len(_BOUNDARY)
+    if start + max_size <= end:
+        return start + max_size
+    return -1
+
+
+def iter_chunks(stream, min_size=CHUNK_MIN_SIZE, max_size=CHUNK_MAX_SIZE):
+    """
+    Split stream into content-defined chunks
+    """
+    tail = b''
+    eof = False
+    while not eof:
+        data = stream.read(READ_SIZE)
+        eof = len(data) == 0
+        buf = tail + data
+        bits = buf.translate(_BIT_TABLE)
+        start = 0
+        while start < len(buf):
+            cut = _find_cut(bits, start, len(buf), min_size, max_size)
+            if cut < 0:
+                if not eof:
+                    break
+                cut = len(buf)
+            yield buf[start:cut]
+            start = cut
+        tail = buf[start:]
+
+
+class ChunkStore(object):
+    """
+    Content-addressed chunk storage in destination directory.
+    Chunk is kept zlib-compressed as <root>/<id[:2]>/<id>, id is sha-256 of raw chunk.
+    Chunks registered by server are listed in <root>/index.json, only other ones are written.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.known = set()
+        index_file = os.path.join(root, INDEX_FILE_NAME)
+        if os.path.exists(index_file):
+            with io.open(index_file, 'r', encoding='utf8') as source_file:
+                self.known = set(json.loads(source_file.read()).keys())
+
+    def chunk_path(self, chunk_id):
+        return os.path.join(self.root, chunk_id[:2], chunk_id)
+
+    def put(self, data):
+        """
+        Store chunk if server does not have it yet, returns (chunk id, True if chunk was written)
+        """
+        chunk_id = hashlib.sha256(data).hexdigest().decode('utf8')
+        if chunk_id in self.known:
+            return chunk_id, False
+        chunk_file = self.chunk_path(chunk_id)
+        if not os.path.isdir(os.path.dirname(chunk_file)):
+            try:
+                os.makedirs(os.path.dirname(chunk_file))
+            except OSError:
+                # created by another worker meanwhile
+                if not os.path.isdir(os.path.dirname(chunk_file)):
+                    raise
+        temp_file = chunk_file + u'.tmp' + str(os.getpid()).decode('utf8')
+        with io.open(temp_file, 'wb') as out_file:
+            out_file.write(zlib.compress(data, 6))
+        os.rename(temp_file, chunk_file)
+        self.known.add(chunk_id)
+        return chunk_id, True
+
+
+def open_store(root):
+    # one store per process, index of known chunks is loaded once
+    if root not in _stores:
+        _stores[root] = ChunkStore(root)
+    return _stores[root]
+
+
+def make_chunked_version(source_dir, temp_dir, store, name_suffix=None, tar_args=None, name=None):
+    """
+    Split tar stream of source directory into chunks, send new ones into store and write
+    version manifest with its hash file into temp_dir.
+    Returns [hash file, manifest file] or [None, None, None] on error, as make_archived_file does.
+    """
+    head, tail = os.path.split(source_dir)
+    if not name is None:
+        tail = name
+    if not name_suffix is None:
+        tail += name_suffix
+    manifest_filename = os.path.join(temp_dir, tail + MANIFEST_SUFFIX)
+    sha_filename = os.path.join(temp_dir, tail + '.sha512')
+
+    if tar_args is None:
+        tar_args = [str(source_dir)]
+    tar_proc = subprocess.Popen(['tar', '-cf', '-'] + tar_args, stdout=subprocess.PIPE)
+    sha_obj = hashlib.sha512()
+    chunks = []
+    total_size = 0
+    new_chunks = 0
+    new_size = 0
+    for data in iter_chunks(tar_proc.stdout):
+        sha_obj.update(data)
+        chunk_id, written = store.put(data)
+        chunks.append([chunk_id, len(data)])
+        total_size += len(data)
+        if written:
+            new_chunks += 1
+            new_size += len(data)
+    tar_res = tar_proc.wait()
+    if tar_res != 0:
+        logging.error('Target : %s tar stream error, code %s', str(source_dir), str(tar_res))
+        return [None, None, None]
+
+    manifest = {u'target': os.path.abspath(source_dir), u'size': total_size,
+                u'sha512': sha_obj.hexdigest().decode('utf8'), u'chunks': chunks}
+    with io.open(manifest_filename, 'w', encoding='utf8') as manifest_file:
+        json_string = json.dumps(manifest, ensure_ascii=False)
+        if isinstance(json_string, bytes):
+            json_string = json_string.decode('utf8')
+        manifest_file.write(json_string)
+    logging.info('Target : %s split into %s chunks (%s bytes), new: %s chunks (%s bytes)',
+                 str(source_dir), str(len(chunks)), str(total_size), str(new_chunks), str(new_size))
+
+    res = systool.sha512_file(manifest_filename)
+    if not res is None:
+        with io.open(sha_filename, 'w', encoding='utf8') as sha_file:
+            sha_file.write(' '.join(res).decode('utf8'))
+        res[0] = sha_filename
+    return res
+
+
+def read_version(manifest_file, store_root, out_stream):
+    """
+    Write tar stream of stored version into out_stream, returns True if its hash matches manifest
+    """
+    with io.open(manifest_file, 'r', encoding='utf8') as source_file:
+        manifest = json.loads(source_file.read())
+    sha_obj = hashlib.sha512()
+    for chunk_id, _ in manifest[u'chunks']:
+        with io.open(os.path.join(store_root, chunk_id[:2], chunk_id), 'rb') as chunk_file:
+            data = zlib.decompress(chunk_file.read())
+        sha_obj.update(data)
+        out_stream.write(data)
+    return sha_obj.hexdigest().decode('utf8') == manifest[u'sha512']
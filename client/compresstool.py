@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import json
+import time
+import zlib
+import fcntl
+import logging
+import multiprocessing
+
+STATS_FILE_NAME = u'compression.json'
+STORE_LEVEL = 0
+LEVELS = (9, 7, 5, 3, 1)
+# rough one-thread LZMA2 speed on input data (MB/s), used for levels without own statistics
+DEFAULT_MB_PER_SEC = {9: 1.5, 7: 2.5, 5: 4.0, 3: 12.0, 1: 25.0}
+INCOMPRESSIBLE_EXTENSIONS = frozenset([
+    u'.jpg', u'.jpeg', u'.png', u'.gif', u'.webp', u'.heic',
+    u'.mp3', u'.m4a', u'.aac', u'.ogg', u'.opus', u'.flac',
+    u'.mp4', u'.m4v', u'.mkv', u'.avi', u'.mov', u'.webm',
+    u'.zip', u'.7z', u'.gz', u'.tgz', u'.bz2', u'.xz', u'.zst', u'.rar', u'.jar',
+    u'.docx', u'.xlsx', u'.pptx', u'.odt', u'.ods', u'.epub', u'.pdf',
+])
+SAMPLE_FILES = 16
+SAMPLE_BYTES = 64 * 1024
+# smaller archives are made fast at any level, their samples say little
+MIN_ADAPTIVE_BYTES = 1024 * 1024
+MB = 1024.0 * 1024.0
+
+
+def _packed(rel_path):
+    return os.path.splitext(rel_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS
+
+
+def sample_ratio(target_path, records):
+    """
+    Compressed/original size of the beginnings of the largest files, zlib level 1 as fast estimate
+    """
+    largest = sorted(records, key=lambda r: int(r[2]), reverse=True)[:SAMPLE_FILES]
+    original = 0
+    compressed = 0
+    for record in largest:
+        try:
+            with io.open(os.path.join(target_path, record[0]), 'rb') as source_file:
+                data = source_file.read(SAMPLE_BYTES)
+        except (IOError, OSError):
+            continue
+        original += len(data)
+        compressed += len(zlib.compress(data, 1))
+    if original == 0:
+        return 1.0
+    return float(compressed) / original
+
+
+class CompressionPolicy(object):
+    """
+    Chooses 7z options for each target archive:
+    - store only (-mx=0) when most of data is in already compressed formats or samples do not shrink,
+    - otherwise the highest level not above configured one which fits time budget of the target,
+      estimated by speed recorded for this target (or rough default speed),
+    - compression in given number of threads (0 - as many as CPU cores).
+    Achieved ratio and speed of each archive are recorded in stats file of service directory.
+    """
+    def __init__(self, stats_dir, level=7, threads=0, adaptive=False, time_budget=0, store_threshold=0.9):
+        self.stats_file = os.path.join(stats_dir, STATS_FILE_NAME)
+        self.level = level
+        self.threads = threads
+        self.adaptive = adaptive
+        self.time_budget = time_budget
+        self.store_threshold = store_threshold
+
+    def zip_args(self, level):
+        threads = 'on' if self.threads == 0 else str(self.threads)
+        return ['-mx=%d' % level, '-mmt=%s' % threads]
+
+    def __speed(self, target_stats, level):
+        recorded = target_stats.get(str(level))
+        if recorded is not None and recorded[u'mb_per_sec'] > 0:
+            return recorded[u'mb_per_sec']
+        threads = self.threads if self.threads > 0 else multiprocessing.cpu_count()
+        return DEFAULT_MB_PER_SEC[level] * threads
+
+    def choose(self, target, target_path, records):
+        """
+        Level for archive of given file records of target
+        """
+        if not self.adaptive:
+            return self.level
+        total = sum(int(r[2]) for r in records)
+        if total < MIN_ADAPTIVE_BYTES:
+            return self.level
+        packed = sum(int(r[2]) for r in records if _packed(r[0]))
+        ratio = sample_ratio(target_path, [r for r in records if not _packed(r[0])])
+        estimated = (packed + (total - packed) * ratio) / total
+        if estimated >= self.store_threshold:
+            logging.info('Target %s is not compressible (estimated ratio %.2f), store only.',
+                         str(target), estimated)
+            return STORE_LEVEL
+
+        target_stats = self.load().get(target, {})
+        level = self.level
+        if self.time_budget > 0:
+            candidates = [l for l in LEVELS if l <= self.level] or [min(LEVELS)]
+            fitting = [l for l in candidates if total / MB / self.__speed(target_stats, l) <= self.time_budget]
+            level = fitting[0] if len(fitting) > 0 else candidates[-1]
+        recorded = target_stats.get(str(level))
+        if recorded is not None and recorded[u'ratio'] >= self.store_threshold:
+            logging.info('Level %s did not compress %s last time, store only.', str(level), str(target))
+            return STORE_LEVEL
+        logging.info('Target %s: %.1f MB, estimated ratio %.2f, level %s.',
+                     str(target), total / MB, estimated, str(level))
+        return level
+
+    def load(self):
+        if not os.path.exists(self.stats_file):
+            return {}
+        with io.open(self.stats_file, 'r', encoding='utf8') as source_file:
+            return json.loads(source_file.read())
+
+    def record(self, target, level, input_bytes, output_bytes, seconds):
+        """
+        Save achieved ratio and speed; archives are made in several processes, so file is locked
+        """
+        ratio = float(output_bytes) / input_bytes if input_bytes > 0 else 1.0
+        mb_per_sec = input_bytes / MB / seconds if seconds > 0 else 0.0
+        logging.info('Archive of %s: level %s, ratio %.2f, %.1f MB/s.', str(target), str(level), ratio, mb_per_sec)
+        with io.open(self.stats_file + u'.lock', 'w') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            stats = self.load()
+            stats.setdefault(target, {})[str(level)] = {u'ratio': ratio, u'mb_per_sec': mb_per_sec,
+                                                        u'time': time.time()}
+            with io.open(self.stats_file + u'.tmp', 'w', encoding='utf8') as out_file:
+                json_string = json.dumps(stats, ensure_ascii=False)
+                if isinstance(json_string, bytes):
+                    json_string = json_string.decode('utf8')
+                out_file.write(json_string)
+            os.rename(self.stats_file + u'.tmp', self.stats_file)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import json
+import time
+import errno
+import ctypes
+import ctypes.util
+import logging
+
+MB = 1024 * 1024
+BLOCK_SIZE = 8 * MB
+PART_SUFFIX = u'.part'
+INFO_SUFFIX = u'.part.json'
+
+# errors meaning 'this copy method can not be used for these files'
+_UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF)
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+
+def _libc_function(name, argtypes):
+    func = getattr(_libc, name, None) if _libc is not None else None
+    if func is not None:
+        func.restype = ctypes.c_ssize_t
+        func.argtypes = argtypes
+    return func
+
+
+_copy_file_range = _libc_function('copy_file_range', [ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                                                       ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                                                       ctypes.c_size_t, ctypes.c_uint])
+_sendfile = _libc_function('sendfile', [ctypes.c_int, ctypes.c_int,
+                                        ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t])
+
+
+class TransferStats(object):
+    """
+    Result of one file transfer
+    """
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.resumed_from = 0
+        self.seconds = 0.0
+        self.method = u''
+
+    @property
+    def mb_per_sec(self):
+        if self.seconds <= 0:
+            return 0.0
+        return self.bytes / float(MB) / self.seconds
+
+
+class FileTransfer(object):
+    """
+    Copy of file into destination directory under temporary name, renamed when complete.
+    Data is moved by the kernel (copy_file_range, then sendfile) when possible,
+    otherwise with aligned buffer of block_size. Interrupted copy of the same source
+    (same size and mtime) continues from the last block which matches the source.
+    """
+    def __init__(self, src, dest_path, block_size=BLOCK_SIZE):
+        self.src = src
+        _, tail = os.path.split(src)
+        self.dest_file = os.path.join(dest_path, tail)
+        self.part_file = self.dest_file + PART_SUFFIX
+        self.info_file = self.dest_file + INFO_SUFFIX
+        self.block_size = max(MB, block_size - block_size % MB)
+        self.stats = TransferStats(tail)
+        self.__methods = [m for m, f in ((u'copy_file_range', _copy_file_range), (u'sendfile', _sendfile))
+                          if f is not None] + [u'buffered']
+        self.__buffer = None
+
+    def __source_signature(self):
+        src_stat = os.stat(self.src)
+        return {u'size': src_stat.st_size, u'mtime': src_stat.st_mtime}
+
+    def __verified_offset(self, src_file, part_file):
+        """
+        Offset up to which partial copy is kept: end of its last whole block, if that block matches source.
+        Only the last block is compared: copy is resumed for the same source (size and mtime) only,
+        and partial file is written in order, so interruption can damage its end only.
+        Complete archive is checked against its hash on server anyway.
+        """
+        part_size = os.fstat(part_file.fileno()).st_size
+        offset = part_size - part_size % self.block_size
+        if offset == 0:
+            return 0
+        src_file.seek(offset - self.block_size)
+        part_file.seek(offset - self.block_size)
+        if src_file.read(self.block_size) != part_file.read(self.block_size):
+            logging.warning('Partial copy %s does not match source, start from zero.', str(self.part_file))
+            return 0
+        return offset
+
+    def __copy_block(self, src_file, part_file, offset, count):
+        while True:
+            method = self.__methods[0]
+            try:
+                if method == u'copy_file_range':
+                    off_in = ctypes.c_longlong(offset)
+                    off_out = ctypes.c_longlong(offset)
+                    copied = _copy_file_range(src_file.fileno(), ctypes.byref(off_in),
+                                              part_file.fileno(), ctypes.byref(off_out), count, 0)
+                elif method == u'sendfile':
+                    os.lseek(part_file.fileno(), offset, os.SEEK_SET)
+                    off_in = ctypes.c_longlong(offset)
+                    copied = _sendfile(part_file.fileno(), src_file.fileno(), ctypes.byref(off_in), count)
+                else:
+                    return self.__buffered_copy(src_file, part_file, offset, count)
+                if copied < 0:
+                    err = ctypes.get_errno()
+                    raise OSError(err, os.strerror(err))
+                if copied == 0 and count > 0:
+                    # some file systems report nothing copied instead of error
+                    raise OSError(errno.EINVAL, 'nothing copied')
+                return copied
+            except OSError as ose:
+                if ose.errno not in _UNSUPPORTED or len(self.__methods) == 1:
+                    raise
+                logging.debug('Copy method %s not usable for %s: %s', method, str(self.src), str(ose))
+                self.__methods.pop(0)
+
+    def __buffered_copy(self, src_file, part_file, offset, count):
+        if self.__buffer is None:
+            self.__buffer = bytearray(self.block_size)
+        src_file.seek(offset)
+        part_file.seek(offset)
+        view = memoryview(self.__buffer)[:count]
+        size = src_file.readinto(view)
+        if size == 0 and count > 0:
+            raise IOError(errno.EIO, 'source file is shorter than its size at start of copy')
+        written = 0
+        while written < size:
+            written += part_file.write(view[written:size])
+        return size
+
+    def run(self):
+        started = time.time()
+        signature = self.__source_signature()
+        resume = False
+        if os.path.exists(self.part_file) and os.path.exists(self.info_file):
+            with io.open(self.info_file, 'r', encoding='utf8') as info:
+                resume = json.loads(info.read()) == signature
+        if not resume:
+            with io.open(self.info_file, 'w', encoding='utf8') as info:
+                info.write(json.dumps(signature).decode('utf8'))
+
+        with io.FileIO(self.src, 'r') as src_file, \
+                io.FileIO(self.part_file, 'r+' if resume else 'w+') as part_file:
+            offset = self.__verified_offset(src_file, part_file) if resume else 0
+            part_file.truncate(offset)
+            self.stats.resumed_from = offset
+            while offset < signature[u'size']:
+                count = min(self.block_size - offset % self.block_size, signature[u'size'] - offset)
+                offset += self.__copy_block(src_file, part_file, offset, count)
+            os.fsync(part_file.fileno())
+
+        os.rename(self.part_file, self.dest_file)
+        os.remove(self.info_file)
+        self.stats.bytes = signature[u'size'] - self.stats.resumed_from
+        self.stats.seconds = time.time() - started
+        self.stats.method = self.__methods[0]
+        return self.stats
+
+
+def transfer_file(src, dest_path, retries=3, retry_delay=10, block_size=BLOCK_SIZE, remove_source=True):
+    """
+    Transfer file with retries, each retry resumes interrupted copy.
+    Source is removed only after successful copy. Returns TransferStats or None.
+    """
+    stats = None
+    for attempt in range(retries + 1):
+        try:
+            stats = FileTransfer(src, dest_path, block_size).run()
+            break
+        except (IOError, OSError) as err:
+            logging.error('Copy %s error occure (attempt %s): %s', str(src), str(attempt + 1), str(err))
+            if attempt < retries:
+                time.sleep(retry_delay)
+    if stats is None:
+        return None
+    if remove_source:
+        os.remove(src)
+    logging.info('Transfer %s: %s bytes in %.1f s, %.1f MB/s, %s, resumed from %s.',
+                 str(src), str(stats.bytes), stats.seconds, stats.mb_per_sec, stats.method,
+                 str(stats.resumed_from))
+    return stats
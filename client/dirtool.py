@@ -4,43 +4,249 @@
 from __future__ import print_function
 import os
 import sys
+import socket
 import hashlib
 import time
 import logging
 import json
 import io
 import ConfigParser
+import Queue
+import threading
+import multiprocessing
+import multiprocessing.pool
 import nettool
 import systool
+import storetool
+import chunktool
+import copytool
+import streamtool
+import journaltool
+import compresstool
+import ruletool
+import metrictool
+import runtool
+import cachetool
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+DEFAULT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ%Z'
+VERIFY_CONTENT = u'content'
+
+
+class _ListdirEntry(object):
+    """
+    Minimal replacement of scandir() entry for interpreters without scandir
+    """
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def list_dir_entries(directory):
+    if _scandir is not None:
+        return list(_scandir(directory))
+    return [_ListdirEntry(directory, name) for name in os.listdir(directory)]
+
+
+class _StoredEntry(object):
+    """
+    Directory entry restored from stored descriptor, keeps stored file record
+    """
+    def __init__(self, directory, name, record=None):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self.record = record
+
+
+class TreeScanner(object):
+    """
+    Single pass directory walker.
+    Yields subdirectories and files in sorted order of their relative paths,
+    together with directory entry objects (which keep stat data from scandir).
+    Collects mtime and ctime of every visited directory, unless keep_visited is False.
+    Entries excluded by target rules (see ruletool) are skipped, excluded directories are not entered.
+    """
+    SUBDIR = 0
+    FILE = 1
+    _SUBDIR_CONTENT = 2
+
+    def __init__(self, directory, keep_visited=True, rules=None):
+        self.root = directory
+        self.visited = {} if keep_visited else None
+        self.rules = rules
+
+    def _list_items(self, directory, rel_dir, dir_stat):
+        items = []
+        for entry in list_dir_entries(directory):
+            rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+            if self.rules is not None and self.rules.excludes(rel_path, entry.is_dir(), entry.stat):
+                continue
+            if entry.is_dir():
+                items.append((entry.name, self.SUBDIR, rel_path, entry))
+                # content of subdirectory sorts right after 'name/' prefix
+                if not entry.is_symlink():
+                    items.append((entry.name + os.sep, self._SUBDIR_CONTENT, rel_path, entry))
+            else:
+                items.append((entry.name, self.FILE, rel_path, entry))
+        return items
+
+    def _sorted_items(self, directory, rel_dir):
+        try:
+            # stat before listing: change made while listing makes directory dirty next time
+            dir_stat = os.stat(directory)
+            items = self._list_items(directory, rel_dir, dir_stat)
+        except OSError:
+            # same as os.walk: unreadable directory is skipped silently
+            logging.warning('Can not read directory: %s', directory)
+            return []
+        if self.visited is not None:
+            self.visited[rel_dir] = [dir_stat.st_mtime, dir_stat.st_ctime]
+        items.sort(key=lambda it: it[0])
+        return items
+
+    def walk(self):
+        stack = [iter(self._sorted_items(self.root, u''))]
+        while len(stack) > 0:
+            item = next(stack[-1], None)
+            if item is None:
+                stack.pop()
+                continue
+            _, kind, rel_path, entry = item
+            if kind == self._SUBDIR_CONTENT:
+                stack.append(iter(self._sorted_items(entry.path, rel_path)))
+            else:
+                yield kind, rel_path, entry
+
+
+def _stored_children(stored_metadata):
+    """
+    Stored subdirectories and file records grouped by relative path of their directory
+    """
+    children = {}
+    for s in stored_metadata[u'subdirs']:
+        children.setdefault(os.path.dirname(s), []).append((TreeScanner.SUBDIR, s, None))
+    for record in stored_metadata[u'files']:
+        children.setdefault(os.path.dirname(record[0]), []).append((TreeScanner.FILE, record[0], record))
+    return children
+
+
+def _stored_items(scanner, directory, stored_dirs, children):
+    items = []
+    for kind, rel_path, record in children:
+        name = os.path.basename(rel_path)
+        entry = _StoredEntry(directory, name, record)
+        items.append((name, kind, rel_path, entry))
+        # subdirectories without own stored state are symlinks or unreadable ones
+        if kind == TreeScanner.SUBDIR and rel_path in stored_dirs:
+            items.append((name + os.sep, scanner._SUBDIR_CONTENT, rel_path, entry))
+    return items
+
+
+class PruningTreeScanner(TreeScanner):
+    """
+    Tree walker which reuses stored content of directories with unchanged mtime and ctime.
+    Such directories are not listed and their files are not stat'ed, so a file rewritten
+    in place (directory entry untouched) is noticed only by the next full scan.
+    """
+    def __init__(self, directory, stored_metadata, rules=None):
+        super(PruningTreeScanner, self).__init__(directory, rules=rules)
+        self.__dirs = stored_metadata[u'dirs']
+        self.__children = _stored_children(stored_metadata)
+        self.reused_dirs = 0
+
+    def _list_items(self, directory, rel_dir, dir_stat):
+        stored = self.__dirs.get(rel_dir)
+        if stored is None or stored[0] != dir_stat.st_mtime or stored[1] != dir_stat.st_ctime:
+            return super(PruningTreeScanner, self)._list_items(directory, rel_dir, dir_stat)
+
+        self.reused_dirs += 1
+        return _stored_items(self, directory, self.__dirs, self.__children.get(rel_dir, []))
+
+
+class JournalTreeScanner(TreeScanner):
+    """
+    Tree walker driven by change journal (see journaltool): only directories named in journal
+    and new subtrees are read from disk, the rest of tree is taken from stored descriptor
+    without any system call, so scan costs O(changes).
+    """
+    def __init__(self, directory, stored_metadata, journal_entries, rules=None):
+        super(JournalTreeScanner, self).__init__(directory, rules=rules)
+        self.__dirs = stored_metadata[u'dirs']
+        self.__children = _stored_children(stored_metadata)
+        self.__dirty = set(rel for kind, rel in journal_entries if kind == journaltool.DIRTY)
+        self.__subtrees = [rel for kind, rel in journal_entries if kind == journaltool.SUBTREE]
+        self.read_dirs = 0
+
+    def __must_read(self, rel_dir):
+        if rel_dir in self.__dirty or rel_dir not in self.__dirs:
+            return True
+        for root in self.__subtrees:
+            if root == u'' or rel_dir == root or rel_dir.startswith(root + os.sep):
+                return True
+        return False
+
+    def _sorted_items(self, directory, rel_dir):
+        if self.__must_read(rel_dir):
+            self.read_dirs += 1
+            return super(JournalTreeScanner, self)._sorted_items(directory, rel_dir)
+        stored = self.__dirs[rel_dir]
+        self.visited[rel_dir] = [stored[0], stored[1]]
+        items = _stored_items(self, directory, self.__dirs, self.__children.get(rel_dir, []))
+        items.sort(key=lambda it: it[0])
+        return items
 
 
 class DirDescriptor(object):
     """
-    Descriptor for directory
+    Descriptor for directory.
+    With content cache (see cachetool) hash of descriptor covers content hashes of files instead
+    of their mtime, so file touched without change gives the same state and same-second rewrite
+    of the same size does not.
     """
-    def __init__(self, directory, time_string_format='%Y-%m-%dT%H:%M:%SZ%Z'):
+    def __init__(self, directory, time_string_format=DEFAULT_TIME_FORMAT, rules=None, content_cache=None):
         if not os.path.isdir(directory):
-            logging.error('File reading error: {}', directory)
+            logging.error('File reading error: %s', directory)
             raise TypeError("Directory must be a directory.")
         self.metadata = dict()
         self.metadata[u'directory'] = os.path.basename(directory.decode('utf8'))
         self.metadata[u'path'] = os.path.abspath(directory).decode('utf8')
         self.metadata[u'parent'] = os.path.dirname(self.metadata[u'path']).decode('utf8')
         self.metadata[u'hash'] = u''
+        # state made with different rules has different content
+        if rules is not None:
+            self.metadata[u'rules'] = rules.fingerprint
+        if content_cache is not None:
+            self.metadata[u'verify'] = VERIFY_CONTENT
         self.time_format = time_string_format
-
-    def __relpath(self, path):
-        return os.path.relpath(path, start=self.metadata[u'path'])
+        self.rules = rules
+        self.content_cache = content_cache
+        self.__contents = {}
 
     def iterfiles(self):
-        for root, dirs, files in os.walk(self.metadata[u'path'], topdown=True):
-            for f in files:
-                yield self.__relpath(os.path.join(root, f))
+        for kind, rel_path, _ in TreeScanner(self.metadata[u'path'], rules=self.rules).walk():
+            if kind == TreeScanner.FILE:
+                yield rel_path
 
     def itersubdirs(self):
-        for root, dirs, files in os.walk(self.metadata[u'path'], topdown=True):
-            for d in dirs:
-                yield self.__relpath(os.path.join(root, d))
+        for kind, rel_path, _ in TreeScanner(self.metadata[u'path'], rules=self.rules).walk():
+            if kind == TreeScanner.SUBDIR:
+                yield rel_path
 
     def files(self, sort_key=lambda k: k, sort_reverse=False):
         return sorted(self.iterfiles(), key=sort_key, reverse=sort_reverse)
@@ -48,47 +254,270 @@ class DirDescriptor(object):
     def subdirs(self, sort_key=lambda k: k, sort_reverse=False):
         return sorted(self.itersubdirs(), key=sort_key, reverse=sort_reverse)
 
-    def load_actual_state(self):
-        self.metadata[u'subdirs'] = self.subdirs()
+    def file_record(self, rel_path, sys_info):
+        str_mtime = time.strftime(self.time_format, time.gmtime(sys_info.st_mtime))
+        str_size = str(sys_info.st_size)
+        return [rel_path, str_mtime.decode('utf8'), str_size.decode('utf8')]
+
+    def load_actual_state(self, stored_descr=None, journal_entries=None):
+        """
+        Scan directory. With stored descriptor having directory index, unchanged directories
+        are taken from it without listing (see PruningTreeScanner), or only directories named
+        by change journal are listed (see JournalTreeScanner).
+        """
+        self.metadata[u'scan_time'] = time.time()
+        if stored_descr is not None and u'dirs' in stored_descr.metadata:
+            if journal_entries is not None:
+                scanner = JournalTreeScanner(self.metadata[u'path'], stored_descr.metadata, journal_entries,
+                                             self.rules)
+            else:
+                scanner = PruningTreeScanner(self.metadata[u'path'], stored_descr.metadata, self.rules)
+            self.metadata[u'full_scan_time'] = stored_descr.metadata.get(u'full_scan_time', 0.0)
+        else:
+            scanner = TreeScanner(self.metadata[u'path'], rules=self.rules)
+            self.metadata[u'full_scan_time'] = time.time()
+
+        # one walk: subdirs are hashed as found, file records are collected
+        # in sorted order and hashed after them (hash layout is unchanged)
         sha_obj = hashlib.sha512()
         sha_obj.update(self.metadata[u'directory'].encode('utf8'))
-        for s in self.metadata[u'subdirs']:
-            sha_obj.update(s.encode('utf8'))
-
+        self.metadata[u'subdirs'] = []
         self.metadata[u'files'] = []
-        for f in self.files():
-            sys_info = os.stat(os.path.join(self.metadata[u'path'], f))
-            str_mtime = time.strftime(self.time_format, time.gmtime(sys_info.st_mtime))
-            str_size = str(sys_info.st_size)
+        for kind, rel_path, entry in scanner.walk():
+            if kind == TreeScanner.SUBDIR:
+                sha_obj.update(rel_path.encode('utf8'))
+                self.metadata[u'subdirs'].append(rel_path)
+            elif isinstance(entry, _StoredEntry):
+                self.metadata[u'files'].append(entry.record)
+                if self.content_cache is not None:
+                    self.__contents[rel_path] = self.content_cache.content(rel_path, entry.path)
+            else:
+                sys_info = entry.stat()
+                self.metadata[u'files'].append(self.file_record(rel_path, sys_info))
+                if self.content_cache is not None:
+                    self.__contents[rel_path] = self.content_cache.content(rel_path, entry.path, sys_info)
+        if self.content_cache is not None:
+            self.content_cache.save()
+
+        for f, str_mtime, str_size in self.metadata[u'files']:
             sha_obj.update(f.encode('utf8'))
-            sha_obj.update(str_mtime)
-            sha_obj.update(str_size)
-            self.metadata[u'files'].append([f,
-                                           str_mtime.decode('utf8'),
-                                           str_size.decode('utf8')])
+            sha_obj.update(self.__version(f, str_mtime).encode('utf8'))
+            sha_obj.update(str_size.encode('utf8'))
         self.metadata[u'hash'] = sha_obj.hexdigest().decode('utf8')
-
-    def load_stored_state(self, json_file):
-        if os.path.exists(json_file) and os.path.isfile(json_file):
-            with io.open(json_file, 'r', encoding='utf8') as source_file:
+        self.metadata[u'dirs'] = self.__merkle_index(scanner.visited)
+
+    def __version(self, rel_path, str_mtime):
+        # part of file record which tells its content has changed
+        if self.content_cache is not None:
+            return self.__contents[rel_path]
+        return str_mtime
+
+    def __merkle_index(self, visited):
+        """
+        Hash of each directory over its files and hashes of its subdirectories,
+        stored as [mtime, ctime, hash] by relative directory path ('' for root).
+        """
+        dir_files = {}
+        for record in self.metadata[u'files']:
+            dir_files.setdefault(os.path.dirname(record[0]), []).append(record)
+        dir_subdirs = {}
+        for s in self.metadata[u'subdirs']:
+            dir_subdirs.setdefault(os.path.dirname(s), []).append(s)
+
+        index = {}
+        # reverse order of paths visits subdirectories before their parents
+        for rel_dir in sorted(visited.keys(), reverse=True):
+            sha_obj = hashlib.sha512()
+            for f, str_mtime, str_size in dir_files.get(rel_dir, []):
+                sha_obj.update(u'\0'.join([os.path.basename(f), self.__version(f, str_mtime), str_size,
+                                           u'']).encode('utf8'))
+            for s in dir_subdirs.get(rel_dir, []):
+                sub_hash = index[s][2] if s in index else u''
+                sha_obj.update(u'\0'.join([os.path.basename(s), sub_hash, u'']).encode('utf8'))
+            index[rel_dir] = [visited[rel_dir][0], visited[rel_dir][1], sha_obj.hexdigest().decode('utf8')]
+        return index
+
+    def full_scan_expired(self, interval_days):
+        if u'dirs' not in self.metadata:
+            return True
+        return time.time() - self.metadata.get(u'full_scan_time', 0.0) > interval_days * 24 * 3600
+
+    def changed_dirs(self, other_index):
+        """
+        Relative paths of directories with different hashes in own and other directory index
+        """
+        own_index = self.metadata.get(u'dirs', {})
+        changed = []
+        for rel_dir in set(own_index.keys()) | set(other_index.keys()):
+            if own_index.get(rel_dir, [None] * 3)[2] != other_index.get(rel_dir, [None] * 3)[2]:
+                changed.append(rel_dir)
+        return sorted(changed)
+
+    def load_stored_state(self, state_file):
+        if os.path.exists(state_file) and os.path.isfile(state_file):
+            if storetool.is_store(state_file):
+                self.metadata = storetool.load_metadata(state_file, self.time_format)
+                return
+            with io.open(state_file, 'r', encoding='utf8') as source_file:
                 json_str = source_file.read()
                 self.metadata = json.loads(json_str)
         else:
-            logging.error('File %s for load Directory descriptor not found.', str(json_file))
+            logging.error('File %s for load Directory descriptor not found.', str(state_file))
 
     def save_to_json(self, filename):
         if filename is None:
-            logging.warning('No file to save json object for: {}', str(self.metadata[u'directory']))
+            logging.warning('No file to save json object for: %s', str(self.metadata[u'directory']))
             return
         with io.open(filename, 'w', encoding='utf8') as json_file:
             json_string = json.dumps(self.metadata, ensure_ascii=False)
             json_file.write(json_string)
 
+    def save_to_store(self, filename):
+        if filename is None:
+            logging.warning('No file to save descriptor for: %s', str(self.metadata[u'directory']))
+            return
+        storetool.write_store(filename, self.metadata, self.time_format)
+
+    def matches_store(self, store):
+        """
+        Compare with memory-mapped stored state using header only:
+        descriptor hash covers subdirectory names and all file records.
+        """
+        for k in (u'directory', u'path', u'parent', u'hash', u'rules', u'verify'):
+            if store.header.get(k) != self.metadata.get(k):
+                return False
+        return True
+
+    def streaming_matches_store(self, store):
+        """
+        Compare actual directory with memory-mapped stored state without building either of them:
+        sorted walk is merge-joined with stored subdirectory and file lists item by item, and
+        the first difference stops the walk. Memory use does not depend on number of files.
+        """
+        for k in (u'path', u'rules'):
+            if store.header.get(k) != self.metadata.get(k):
+                return False
+        stored_subdirs = store.iter_subdirs()
+        stored_files = store.iter_files()
+        for kind, rel_path, entry in TreeScanner(self.metadata[u'path'], False, self.rules).walk():
+            if kind == TreeScanner.SUBDIR:
+                if next(stored_subdirs, None) != rel_path:
+                    return False
+                continue
+            # store keeps mtime in whole seconds, as descriptor time string does
+            sys_info = entry.stat()
+            if next(stored_files, None) != (rel_path, int(sys_info.st_mtime), sys_info.st_size):
+                return False
+        return next(stored_subdirs, None) is None and next(stored_files, None) is None
+
+    def __state(self):
+        # directory index and scan times are not part of directory content,
+        # with verified content file records (their mtime) are covered by hash
+        skipped = (u'dirs', u'full_scan_time', u'scan_time')
+        if self.metadata.get(u'verify') == VERIFY_CONTENT:
+            skipped += (u'files',)
+        return dict((k, v) for k, v in self.metadata.items() if k not in skipped)
+
     def __eq__(self, other):
-        return self.metadata == other.metadata
+        return self.__state() == other.__state()
 
     def __ne__(self, other):
-        return self.metadata != other.metadata
+        return not self.__eq__(other)
+
+
+class StoredState(object):
+    """
+    Sorted subdirectory and file lists of stored descriptor.
+    Binary store is read lazily, JSON descriptor is loaded at once.
+    """
+    def __init__(self, state_file, time_format=DEFAULT_TIME_FORMAT):
+        self.time_format = time_format
+        self.__store = None
+        self.__metadata = None
+        if storetool.is_store(state_file):
+            self.__store = storetool.DescriptorStore(state_file)
+        else:
+            with io.open(state_file, 'r', encoding='utf8') as source_file:
+                self.__metadata = json.loads(source_file.read())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.__store is not None:
+            self.__store.close()
+            self.__store = None
+
+    def iter_subdirs(self):
+        if self.__store is not None:
+            return self.__store.iter_subdirs()
+        return iter(self.__metadata[u'subdirs'])
+
+    def iter_files(self):
+        if self.__store is not None:
+            return self.__store.iter_records(self.time_format)
+        return iter(self.__metadata[u'files'])
+
+
+ITEM_ADDED = u'added'
+ITEM_MODIFIED = u'modified'
+ITEM_DELETED = u'deleted'
+
+
+def diff_sorted(stored_items, actual_items, key=lambda it: it):
+    """
+    Merge-join of two lists sorted by key.
+    Yields (change, item): actual item for added and modified ones, stored item for deleted.
+    """
+    stored_it = iter(stored_items)
+    actual_it = iter(actual_items)
+    stored = next(stored_it, None)
+    actual = next(actual_it, None)
+    while stored is not None or actual is not None:
+        if actual is None or (stored is not None and key(stored) < key(actual)):
+            yield ITEM_DELETED, stored
+            stored = next(stored_it, None)
+        elif stored is None or key(actual) < key(stored):
+            yield ITEM_ADDED, actual
+            actual = next(actual_it, None)
+        else:
+            if stored != actual:
+                yield ITEM_MODIFIED, actual
+            stored = next(stored_it, None)
+            actual = next(actual_it, None)
+
+
+PENDING_SUFFIX = u'.new'
+CHAINS_FILE_NAME = u'chains.json'
+METRICS_SUFFIX = u'.metrics.jsonl'
+INCREMENTAL_MARK = u'.inc'
+INCOMING_DIR_NAME = u'incoming'
+QUEUE_DIR_NAME = u'queue'
+TRANSPORT_NFS = 'nfs'
+TRANSPORT_TCP = 'tcp'
+TRANSPORT_SSH = 'ssh'
+NFS_PORT = 2049
+SSH_PORT = 22
+READY_SUFFIX = u'.ready'
+DONE_MARKER = u'run.done'
+# temporary files in service directory: tar files, archives, hashes, indexes, lists, manifests, pending descriptors
+LEFTOVER_SUFFIXES = (u'.tar', u'.tar.7z', u'.sha512', systool.INDEX_SUFFIX, u'.lst', u'.manifest.json',
+                     chunktool.MANIFEST_SUFFIX, PENDING_SUFFIX, u'.tmp')
+
+
+def _run_stage(controller, stage, args):
+    """
+    Call stage method of controller inside pool worker.
+    Any failure is logged and turned into None, so one target can not stop the others.
+    """
+    try:
+        return getattr(controller, stage)(*args)
+    except Exception:
+        logging.exception('Stage %s failed for %s', stage, str(args[0]))
+        return None
 
 
 class BackupController(object):
@@ -117,6 +546,10 @@ class BackupController(object):
         if cfg_parser.has_section('targets'):
             self._target_list_file = cfg_parser.get('targets', 'list_file').decode('utf8')
             self._target_list = []
+            rules_file = None
+            if cfg_parser.has_option('targets', 'rules_file'):
+                rules_file = cfg_parser.get('targets', 'rules_file').decode('utf8')
+            self._rules = ruletool.load_rules(rules_file)
         else:
             logging.error('Invalid config file, %s not found. Exiting.', 'targets')
             quit(-1)
@@ -126,26 +559,197 @@ class BackupController(object):
             self._metadata_dict_file_name = cfg_parser.get('metadata', 'dict_file_name').decode('utf8')
             self._metadata_dict_file = u''
             self._metadata = {}
+            self._prune_unchanged_dirs = False
+            if cfg_parser.has_option('metadata', 'prune_unchanged_dirs'):
+                self._prune_unchanged_dirs = cfg_parser.getboolean('metadata', 'prune_unchanged_dirs')
+            self._full_scan_interval = 7
+            if cfg_parser.has_option('metadata', 'full_scan_interval_days'):
+                self._full_scan_interval = cfg_parser.getint('metadata', 'full_scan_interval_days')
+            self._store_format = u'binary'
+            if cfg_parser.has_option('metadata', 'store_format'):
+                self._store_format = cfg_parser.get('metadata', 'store_format').decode('utf8')
+            self._streaming_compare = False
+            if cfg_parser.has_option('metadata', 'streaming_compare'):
+                self._streaming_compare = cfg_parser.getboolean('metadata', 'streaming_compare')
+            self._verify_content = False
+            if cfg_parser.has_option('metadata', 'verify_content'):
+                self._verify_content = cfg_parser.getboolean('metadata', 'verify_content')
+            self._run_journal = None
+            if cfg_parser.has_option('metadata', 'run_journal') and cfg_parser.getboolean('metadata', 'run_journal'):
+                resume_hours = 24
+                if cfg_parser.has_option('metadata', 'resume_hours'):
+                    resume_hours = cfg_parser.getint('metadata', 'resume_hours')
+                self._run_journal = runtool.RunJournal(self._metadata_path, resume_hours)
         else:
             logging.error('Invalid config file, %s not found. Exiting.', 'metadata')
             quit(-1)
 
+        self._metrics = None
+        if cfg_parser.has_section('metrics') and cfg_parser.getboolean('metrics', 'enabled'):
+            metrics_path = self._log_path
+            if cfg_parser.has_option('metrics', 'path'):
+                metrics_path = cfg_parser.get('metrics', 'path').decode('utf8')
+            history_file = None
+            if cfg_parser.has_option('metrics', 'history_file'):
+                history_file = os.path.join(metrics_path, cfg_parser.get('metrics', 'history_file').decode('utf8'))
+            run_file = os.path.splitext(os.path.basename(self.log_file_name))[0] + METRICS_SUFFIX
+            self._metrics = metrictool.RunMetrics(os.path.join(metrics_path, run_file), history_file)
+
+        self._journal = None
+        if cfg_parser.has_section('journal') and cfg_parser.getboolean('journal', 'enabled'):
+            journal_path = os.path.join(self._metadata_path, u'journal')
+            if cfg_parser.has_option('journal', 'path'):
+                journal_path = cfg_parser.get('journal', 'path').decode('utf8')
+            self._journal = journaltool.ChangeJournal(journal_path)
+
+        self._parallel = False
+        self._overlap_wakeup = False
+        self._destination_ready = threading.Event()
+        self._destination_ok = False
+        self._scan_workers = 1
+        self._compress_workers = 1
+        self._transfer_workers = 1
+        self._target_timeout = 240 * 60
+        if cfg_parser.has_section('parallel'):
+            self._parallel = cfg_parser.getboolean('parallel', 'enabled')
+            if cfg_parser.has_option('parallel', 'overlap_wakeup'):
+                self._overlap_wakeup = cfg_parser.getboolean('parallel', 'overlap_wakeup')
+            self._scan_workers = cfg_parser.getint('parallel', 'scan_workers')
+            self._compress_workers = cfg_parser.getint('parallel', 'compress_workers')
+            self._transfer_workers = cfg_parser.getint('parallel', 'transfer_workers')
+            if cfg_parser.has_option('parallel', 'target_timeout_minutes'):
+                self._target_timeout = cfg_parser.getint('parallel', 'target_timeout_minutes') * 60
+
+        self._chunked = False
+        self._chunks_dir_name = u'chunks'
+        if cfg_parser.has_section('chunks'):
+            self._chunked = cfg_parser.getboolean('chunks', 'enabled')
+            if cfg_parser.has_option('chunks', 'dir_name'):
+                self._chunks_dir_name = cfg_parser.get('chunks', 'dir_name').decode('utf8')
+
+        self._transfer_retries = 3
+        self._transfer_retry_delay = 10
+        self._transfer_block_size = copytool.BLOCK_SIZE
+        if cfg_parser.has_section('transfer'):
+            if cfg_parser.has_option('transfer', 'retries'):
+                self._transfer_retries = cfg_parser.getint('transfer', 'retries')
+            if cfg_parser.has_option('transfer', 'retry_delay'):
+                self._transfer_retry_delay = cfg_parser.getint('transfer', 'retry_delay')
+            if cfg_parser.has_option('transfer', 'block_size_mb'):
+                self._transfer_block_size = cfg_parser.getint('transfer', 'block_size_mb') * copytool.MB
+
+        level = 7
+        threads = 0
+        adaptive = False
+        time_budget = 0
+        store_threshold = 0.9
+        if cfg_parser.has_section('compression'):
+            if cfg_parser.has_option('compression', 'level'):
+                level = cfg_parser.getint('compression', 'level')
+            if cfg_parser.has_option('compression', 'threads'):
+                threads = cfg_parser.getint('compression', 'threads')
+            if cfg_parser.has_option('compression', 'adaptive'):
+                adaptive = cfg_parser.getboolean('compression', 'adaptive')
+            if cfg_parser.has_option('compression', 'time_budget_minutes'):
+                time_budget = cfg_parser.getint('compression', 'time_budget_minutes') * 60
+            if cfg_parser.has_option('compression', 'store_threshold'):
+                store_threshold = cfg_parser.getfloat('compression', 'store_threshold')
+        self._compression = compresstool.CompressionPolicy(self._metadata_path, level, threads, adaptive,
+                                                           time_budget, store_threshold)
+
+        self._chains = {}
+        self._archive_streaming = False
+        self._incremental = False
+        self._full_interval = 7
+        self._volume_size = 0
+        self._volume_workers = 2
+        self._member_index = True
+        if cfg_parser.has_section('archive'):
+            if cfg_parser.has_option('archive', 'streaming'):
+                self._archive_streaming = cfg_parser.getboolean('archive', 'streaming')
+            if cfg_parser.has_option('archive', 'incremental'):
+                self._incremental = cfg_parser.getboolean('archive', 'incremental')
+            if cfg_parser.has_option('archive', 'full_interval_days'):
+                self._full_interval = cfg_parser.getint('archive', 'full_interval_days')
+            if cfg_parser.has_option('archive', 'volume_size_mb'):
+                self._volume_size = cfg_parser.getint('archive', 'volume_size_mb') * copytool.MB
+            if cfg_parser.has_option('archive', 'volume_workers'):
+                self._volume_workers = cfg_parser.getint('archive', 'volume_workers')
+            if cfg_parser.has_option('archive', 'member_index'):
+                self._member_index = cfg_parser.getboolean('archive', 'member_index')
+
+        self._ready_ports = None
+        self._wake_timeout = 300
         if cfg_parser.has_section('server'):
             self.server_ip = cfg_parser.get('server', 'ip')
             self.server_mac = cfg_parser.get('server', 'mac')
+            if cfg_parser.has_option('server', 'ready_ports'):
+                self._ready_ports = [int(p) for p in cfg_parser.get('server', 'ready_ports').split(',')]
+            if cfg_parser.has_option('server', 'wake_timeout'):
+                self._wake_timeout = cfg_parser.getint('server', 'wake_timeout')
         else:
             logging.error('Invalid config file, %s not found. Exiting.', 'server')
             quit(-1)
 
+        self._stream_handoff = False
+        self._incoming_dir_name = INCOMING_DIR_NAME
+        self._ingest_queue = False
+        self._queue_dir_name = QUEUE_DIR_NAME
+        self._client_id = socket.gethostname().decode('utf8')
         if cfg_parser.has_section('destination'):
             self._dest_mount = cfg_parser.get('destination', 'mount_point').decode('utf8')
             self._dest_path = cfg_parser.get('destination', 'path').decode('utf8')
             self._backup_list_filename = cfg_parser.get('destination', 'list_file_name_template').decode('utf8')
             self._backup_name_timestamp = cfg_parser.get('destination', 'file_name_timestamp_format')
+            if cfg_parser.has_option('destination', 'stream_handoff'):
+                self._stream_handoff = cfg_parser.getboolean('destination', 'stream_handoff')
+            if cfg_parser.has_option('destination', 'incoming_dir_name'):
+                self._incoming_dir_name = cfg_parser.get('destination', 'incoming_dir_name').decode('utf8')
+            if cfg_parser.has_option('destination', 'ingest_queue'):
+                self._ingest_queue = cfg_parser.getboolean('destination', 'ingest_queue')
+            if cfg_parser.has_option('destination', 'queue_dir_name'):
+                self._queue_dir_name = cfg_parser.get('destination', 'queue_dir_name').decode('utf8')
+            if cfg_parser.has_option('destination', 'client_id'):
+                self._client_id = cfg_parser.get('destination', 'client_id').decode('utf8')
         else:
             logging.error('Invalid config file, %s not found. Exiting.', 'destination')
             quit(-1)
 
+        self._transport = TRANSPORT_NFS
+        self._transport_host = self.server_ip
+        self._transport_port = 7070
+        self._transport_secret = None
+        self._ssh_command = None
+        self._connection = None
+        if cfg_parser.has_section('transport'):
+            self._transport = cfg_parser.get('transport', 'mode')
+            if cfg_parser.has_option('transport', 'host'):
+                self._transport_host = cfg_parser.get('transport', 'host')
+            if cfg_parser.has_option('transport', 'port'):
+                self._transport_port = cfg_parser.getint('transport', 'port')
+            if cfg_parser.has_option('transport', 'secret'):
+                self._transport_secret = cfg_parser.get('transport', 'secret') or None
+            if cfg_parser.has_option('transport', 'ssh_command'):
+                self._ssh_command = cfg_parser.get('transport', 'ssh_command').split()
+        if self._transport != TRANSPORT_NFS and self._chunked:
+            # chunks are written straight into destination directory
+            logging.warning('Chunked versions need NFS transport, archives are used.')
+            self._chunked = False
+        if self._verify_content and self._streaming_compare:
+            # stored state keeps no content hashes, streaming compare would miss same-second changes
+            logging.warning('Streaming compare can not verify content, full compare is used.')
+            self._streaming_compare = False
+        if self._overlap_wakeup and self._chunked:
+            logging.warning('Chunked versions need destination before archiving, wake-up is not overlapped.')
+            self._overlap_wakeup = False
+
+    def __getstate__(self):
+        # controller is sent to worker processes, connection and destination state stay in the main one
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        state['_destination_ready'] = None
+        return state
+
     @property
     def log_path(self):
         return self._log_path
@@ -238,9 +842,154 @@ class BackupController(object):
             logging.error('List of backup directories is empty.')
             quit(-1)
 
-    def _save_backup_list(self, file_list):
-        with io.open(os.path.join(self.dest_path, self._backup_list_filename), 'w', encoding='utf8') as dest_file:
+    def _save_backup_list(self, file_list, list_file=None):
+        # list is written under temporary name, server never reads a part of it
+        if list_file is None:
+            list_file = os.path.join(self.dest_path, self._backup_list_filename)
+        with io.open(list_file + u'.tmp', 'w', encoding='utf8') as dest_file:
             dest_file.write(('\n'.join(file_list)).decode('utf8'))
+        os.rename(list_file + u'.tmp', list_file)
+
+    def __submit_manifest(self, file_list):
+        """
+        Put list of copied archives into ingest queue of server as job of this client
+        """
+        queue_path = os.path.join(self.dest_path, self._queue_dir_name)
+        if not os.path.isdir(queue_path):
+            os.makedirs(queue_path)
+        job = u'{0}-{1}.lst'.format(self._client_id, time.strftime('%Y%m%dT%H%M%S', time.localtime()))
+        self._save_backup_list(file_list, os.path.join(queue_path, job))
+        logging.info('Job %s submitted to ingest queue.', job.encode('utf8'))
+
+    def __publish_archive(self, file_name, entry):
+        # server takes archive only after its marker appears, so marker is renamed into place
+        marker = os.path.join(self.dest_path, self._incoming_dir_name, file_name + READY_SUFFIX)
+        with io.open(marker + u'.tmp', 'w', encoding='utf8') as marker_file:
+            marker_file.write(entry.decode('utf8'))
+        os.rename(marker + u'.tmp', marker)
+
+    def __connect_destination(self):
+        """
+        Wake server and mount destination or connect to receiver, then set destination ready event
+        """
+        nfs = self._transport == TRANSPORT_NFS
+        try:
+            ready_ports = self.__ready_ports()
+            logging.info('Wait for server (ip=%s) ports %s.', str(self.server_ip), str(ready_ports))
+            started = time.time()
+            ready_time = nettool.wait_server_ready(self.server_ip, ready_ports, self._wake_timeout, self.server_mac)
+            if ready_time is None:
+                logging.error('Server wake-on-LAN failed: %s , %s', str(self.server_ip), str(self.server_mac))
+                return
+            logging.info('Server ready in %.1f s.', ready_time)
+            self.__metric(None, u'wake', time.time() - started)
+
+            started = time.time()
+
+            if not nfs:
+                # archives are streamed to receiver on server, nothing is mounted
+                self._connection = self.__open_connection()
+                if self._connection is None:
+                    return
+            elif not systool.mount_nfs_folder(self.dest_mount):
+                logging.error('Server folder mount failed: %s', str(self.dest_mount))
+                return
+            self.__metric(None, u'mount', time.time() - started)
+
+            if nfs and self.dest_path is None:
+                logging.error('Destination path not found: %s', str(self.dest_path))
+                return
+
+            # with stream handoff server checks each archive as soon as it is published
+            if nfs and self._stream_handoff:
+                incoming_path = os.path.join(self.dest_path, self._incoming_dir_name)
+                if not os.path.isdir(incoming_path):
+                    os.makedirs(incoming_path)
+                if os.path.exists(os.path.join(incoming_path, DONE_MARKER)):
+                    os.remove(os.path.join(incoming_path, DONE_MARKER))
+                self.__start_server_check()
+            self._destination_ok = True
+        finally:
+            self._destination_ready.set()
+
+    def __metric(self, target, phase, seconds, size=None, files=None):
+        if self._metrics is not None:
+            self._metrics.record(target, phase, seconds, size, files)
+
+    def __ready_ports(self):
+        # server is ready when the service used by transport accepts connections
+        if self._ready_ports is not None:
+            return self._ready_ports
+        if self._transport == TRANSPORT_TCP:
+            return [self._transport_port]
+        if self._transport == TRANSPORT_SSH:
+            return [SSH_PORT]
+        return [NFS_PORT]
+
+    def __open_connection(self):
+        try:
+            if self._transport == TRANSPORT_TCP:
+                connection = streamtool.StreamConnection.tcp(self._transport_host, self._transport_port,
+                                                             self._transport_secret)
+            elif self._transport == TRANSPORT_SSH and self._ssh_command is not None:
+                connection = streamtool.StreamConnection.ssh(self._ssh_command)
+            else:
+                logging.error('Unknown transport: %s', str(self._transport))
+                return None
+        except (IOError, OSError) as err:
+            logging.error('Receiver connection failed (%s): %s', str(self._transport), str(err))
+            return None
+        logging.info('Connected to receiver (%s).', str(self._transport))
+        return connection
+
+    def __start_server_check(self):
+        exec_path, _ = os.path.split(sys.argv[0])
+        exec_path = os.path.join(exec_path, 'ssh_cmd.run')
+        if not systool.try_execute_command(exec_path):
+            logging.error('Checksum recalculation task on serverside failed: %s', str(exec_path))
+        else:
+            logging.info('Checksum recalculation task on serverside start: %s', str(exec_path))
+
+    def __migrate_json_descriptors(self, resolved_metadata):
+        migrated = False
+        for d in resolved_metadata.keys():
+            m_el = resolved_metadata[d]
+            if m_el is None or not m_el.endswith(u'.json'):
+                continue
+            store_name = m_el[:-len(u'.json')] + storetool.STORE_EXTENSION
+            if storetool.migrate_json(os.path.join(self._metadata_path, m_el),
+                                      os.path.join(self._metadata_path, store_name),
+                                      DEFAULT_TIME_FORMAT):
+                resolved_metadata[d] = store_name
+                migrated = True
+        if migrated:
+            # dictionary must not point to removed JSON descriptors
+            metadata_dict = {}
+            with io.open(self._metadata_dict_file, 'r', encoding='utf8') as dict_file:
+                metadata_dict = json.loads(dict_file.read())
+            for d in resolved_metadata.keys():
+                if d in metadata_dict.keys():
+                    metadata_dict[d] = resolved_metadata[d]
+            self.__save_metadata_dict(metadata_dict)
+
+    def __save_descriptor(self, descr, file_name, suffix=u''):
+        full_name = os.path.join(self.metadata_path, file_name + suffix)
+        if file_name.endswith(u'.json'):
+            descr.save_to_json(full_name)
+        else:
+            descr.save_to_store(full_name)
+
+    def __compare_with_stored(self, target_descr, stored_file, control_descr=None):
+        """
+        Returns pair: is content of actual and stored states the same, stored directory index
+        """
+        if control_descr is None and storetool.is_store(stored_file):
+            with storetool.DescriptorStore(stored_file) as store:
+                return target_descr.matches_store(store), store.dirs_index()
+        if control_descr is None:
+            control_descr = DirDescriptor(target_descr.metadata[u'path'])
+            control_descr.load_stored_state(stored_file)
+        return control_descr == target_descr, control_descr.metadata.get(u'dirs', {})
 
     def load_metadata(self):
 
@@ -268,6 +1017,9 @@ class BackupController(object):
             logging.error('Actual metadata not found.')
             quit(-1)
 
+        if self._store_format == u'binary':
+            self.__migrate_json_descriptors(resolved_metadata)
+
         # delete expired metadata files without targets
         keys_to_remove = [k for k in metadata_dict.keys() if k not in self.target_list]
         if len(keys_to_remove) > 0:
@@ -275,8 +1027,682 @@ class BackupController(object):
                 logging.warning('Remove metadata descriptor: %s', str(k))
                 # delete metadata file
                 os.remove(os.path.join(self._metadata_path, metadata_dict[k]))
+                cache_file = cachetool.cache_file_name(self._metadata_path, k)
+                if os.path.exists(cache_file):
+                    os.remove(cache_file)
         return resolved_metadata
 
+    def _scan_target(self, curr_target, m_el):
+        """
+        Scan stage: compare actual and stored state of target.
+        Returns [target, descriptor name, pending descriptor name or None]. Actual state of
+        changed target is saved under pending name until its archive is transferred.
+        """
+        logging.info('Process directory %s ...', str(curr_target))
+        content_cache = None
+        if self._verify_content:
+            content_cache = cachetool.ContentCache(cachetool.cache_file_name(self.metadata_path, curr_target))
+        target_descr = DirDescriptor(curr_target, rules=self.__target_rules(curr_target), content_cache=content_cache)
+        control_descr = None
+        if m_el is not None and (self._prune_unchanged_dirs or self._journal is not None):
+            control_descr = DirDescriptor(curr_target)
+            control_descr.load_stored_state(os.path.join(self.metadata_path, m_el))
+        scan_expired = control_descr is None or control_descr.full_scan_expired(self._full_scan_interval)
+        if control_descr is not None and control_descr.metadata.get(u'rules') != target_descr.metadata.get(u'rules'):
+            # stored content of directories was filtered by other rules
+            logging.info('Rules of %s changed, full scan.', str(curr_target))
+            scan_expired = True
+
+        if self._streaming_compare and control_descr is None and m_el is not None and \
+                storetool.is_store(os.path.join(self.metadata_path, m_el)):
+            # unchanged target is found without building its state in memory
+            started = time.time()
+            with storetool.DescriptorStore(os.path.join(self.metadata_path, m_el)) as store:
+                same_content = target_descr.streaming_matches_store(store)
+            self.__metric(curr_target, u'compare', time.time() - started)
+            if same_content:
+                logging.info('Changes not found at %s (streaming compare)', str(curr_target))
+                return [curr_target, m_el, None]
+
+        journal_entries = None
+        if self._journal is not None:
+            # entries are taken in any case, they are dropped when the target is finished
+            entries = self._journal.take(curr_target)
+            if not scan_expired and self._journal.covers(curr_target, control_descr.metadata.get(u'scan_time')):
+                journal_entries = entries
+            if journal_entries is not None and len(journal_entries) == 0:
+                logging.info('Changes not found at %s (journal)', str(curr_target))
+                return [curr_target, m_el, None]
+
+        started = time.time()
+        if scan_expired or (journal_entries is None and not self._prune_unchanged_dirs):
+            target_descr.load_actual_state()
+        else:
+            target_descr.load_actual_state(control_descr, journal_entries)
+        records = target_descr.metadata[u'files']
+        self.__metric(curr_target, u'scan', time.time() - started, sum(int(r[2]) for r in records), len(records))
+        if content_cache is not None and content_cache.hashed_files > 0:
+            logging.info('Content of %s files (%s bytes) hashed at %s.', str(content_cache.hashed_files),
+                         str(content_cache.hashed_bytes), str(curr_target))
+
+        if m_el is None:
+            logging.info('Create new directory description for %s ', str(curr_target))
+            _, body = os.path.split(curr_target)
+            if self._store_format == u'binary':
+                m_el = body + storetool.STORE_EXTENSION
+            else:
+                m_el = body + u'.json'
+        else:
+            same_content, stored_index = self.__compare_with_stored(
+                target_descr, os.path.join(self.metadata_path, m_el), control_descr)
+            if same_content:
+                logging.info('Changes not found at %s ', str(curr_target))
+                if stored_index != target_descr.metadata[u'dirs'] or \
+                        (self._journal is not None and journal_entries is None):
+                    # keep directory times and scan time fresh, so next run can skip these directories
+                    self.__save_descriptor(target_descr, m_el)
+                return [curr_target, m_el, None]
+            logging.info('Found changes at %s ', str(curr_target))
+            logging.debug('Changed directories: %s', ', '.join(target_descr.changed_dirs(stored_index)))
+
+        self.__save_descriptor(target_descr, m_el, PENDING_SUFFIX)
+        return [curr_target, m_el, m_el + PENDING_SUFFIX]
+
+    def __target_rules(self, curr_target):
+        return self._rules.get(os.path.abspath(curr_target))
+
+    def __listed_tar_args(self, curr_target, list_file, subdirs, records):
+        """
+        Target with rules is archived from list of kept items, tar must not recurse into excluded ones
+        """
+        with io.open(list_file, 'wb') as paths:
+            for path in self.__volume_lists(curr_target, subdirs, records, [0] * len(records))[0]:
+                paths.write(path.encode('utf8') + b'\0')
+        return ['--no-recursion', '-C', os.sep, '--null', '-T', str(list_file)]
+
+    def __need_full_archive(self, chain, stored_file):
+        # chunk store keeps only new data anyway
+        if self._chunked or not self._incremental or chain is None or not os.path.exists(stored_file):
+            return True
+        return time.time() - chain[u'full_time'] >= self._full_interval * 24 * 3600
+
+    def __make_incremental_archive(self, curr_target, stored_file, name_suffix, chain):
+        """
+        Archive files added or modified since stored state together with manifest,
+        which names parent archive and lists deleted files and directories
+        """
+        tail = self.__target_key(curr_target) + name_suffix
+        list_file = os.path.join(self.metadata_path, tail + u'.lst')
+        manifest_name = tail + u'.manifest.json'
+        manifest_file = os.path.join(self.metadata_path, manifest_name)
+        target_path = os.path.abspath(curr_target).decode('utf8')
+        deleted = []
+        changed_records = []
+        n_changed = 0
+        hidden = set()
+        if self._verify_content:
+            hidden = cachetool.ContentCache(cachetool.cache_file_name(self.metadata_path, curr_target)).hidden_changes()
+        try:
+            with io.open(list_file, 'wb') as changes, \
+                    StoredState(stored_file) as stored, StoredState(stored_file + PENDING_SUFFIX) as actual:
+                subdir_changes = diff_sorted(([d] for d in stored.iter_subdirs()),
+                                             ([d] for d in actual.iter_subdirs()), key=lambda it: it[0])
+                file_changes = diff_sorted(stored.iter_files(), actual.iter_files(), key=lambda it: it[0])
+                for item_changes in (subdir_changes, file_changes):
+                    for change, item in item_changes:
+                        if change == ITEM_DELETED:
+                            deleted.append(item[0])
+                            continue
+                        # paths are relative to '/', as tar stores them for whole directory
+                        path = os.path.join(target_path, item[0]).lstrip(os.sep)
+                        changes.write(path.encode('utf8') + b'\0')
+                        n_changed += 1
+                        if len(item) == 3:
+                            changed_records.append(item)
+                if len(hidden) > 0:
+                    # content changed without change of file record (same size, mtime in the same second)
+                    listed = set(r[0] for r in changed_records)
+                    for item in actual.iter_files():
+                        if item[0] in hidden and item[0] not in listed:
+                            path = os.path.join(target_path, item[0]).lstrip(os.sep)
+                            changes.write(path.encode('utf8') + b'\0')
+                            n_changed += 1
+                            changed_records.append(item)
+            manifest = {u'target': target_path, u'base': chain[u'base'], u'parent': chain[u'last'],
+                        u'deleted': deleted}
+            with io.open(manifest_file, 'w', encoding='utf8') as manifest_out:
+                json_string = json.dumps(manifest, ensure_ascii=False)
+                if isinstance(json_string, bytes):
+                    json_string = json_string.decode('utf8')
+                manifest_out.write(json_string)
+            logging.info('Incremental archive for %s: %s changed, %s deleted items.',
+                         str(curr_target), str(n_changed), str(len(deleted)))
+
+            tar_args = ['--no-recursion', '-C', str(self.metadata_path), str(manifest_name),
+                        '-C', os.sep, '--null', '-T', str(list_file)]
+            return self.__compress(curr_target, changed_records, name_suffix=name_suffix, tar_args=tar_args)
+        finally:
+            for temp_file in (list_file, manifest_file):
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+
+    def __compress(self, curr_target, records, subdirs=None, **kwargs):
+        """
+        Make archive of file records with level chosen by compression policy, record its ratio and speed.
+        With subdirectories given (full archive) large target is split into volumes.
+        """
+        level = self._compression.choose(curr_target, os.path.abspath(curr_target), records)
+        zip_args = self._compression.zip_args(level)
+        volume_of = None
+        if subdirs is not None and self._volume_size > 0:
+            volume_of = self.__split_volumes(records)
+        started = time.time()
+        timings = {}
+        kwargs['name'] = self.__target_key(curr_target)
+        if volume_of is not None and volume_of[-1] > 0:
+            res = systool.make_volumes(curr_target, self.metadata_path, kwargs['name_suffix'],
+                                       self.__volume_lists(curr_target, subdirs, records, volume_of),
+                                       self._archive_streaming, zip_args, self._volume_workers, kwargs['name'])
+        else:
+            volume_of = None
+            list_file = None
+            if subdirs is not None and self.__target_rules(curr_target) is not None:
+                list_file = os.path.join(self.metadata_path, kwargs['name'] + kwargs['name_suffix'] + u'.lst')
+                kwargs['tar_args'] = self.__listed_tar_args(curr_target, list_file, subdirs, records)
+            try:
+                res = systool.make_archived_file(curr_target, self.metadata_path, streaming=self._archive_streaming,
+                                                 zip_args=zip_args, timings=timings, **kwargs)
+            finally:
+                if list_file is not None and os.path.exists(list_file):
+                    os.remove(list_file)
+        if res is not None and len(res) == 2:
+            input_bytes = sum(int(r[2]) for r in records)
+            output_bytes = sum(os.path.getsize(f) for f in self.__archive_files(res))
+            self._compression.record(curr_target, level, input_bytes, output_bytes, time.time() - started)
+            if len(timings) == 0:
+                # volumes are made in parallel, their steps overlap
+                self.__metric(curr_target, u'compress', time.time() - started, input_bytes, len(records))
+            else:
+                for phase, size in ((u'tar', input_bytes), (u'compress', input_bytes), (u'hash', output_bytes)):
+                    if phase in timings:
+                        self.__metric(curr_target, phase, timings[phase], size, len(records))
+            if self._member_index:
+                self.__write_index(curr_target, res, records, volume_of)
+        return res
+
+    def __split_volumes(self, records):
+        """
+        Volume number of each file record, volume holds about volume_size bytes of source files
+        """
+        volume_of = []
+        volume = 0
+        size = 0
+        for record in records:
+            if size >= self._volume_size:
+                volume += 1
+                size = 0
+            volume_of.append(volume)
+            size += int(record[2])
+        return volume_of
+
+    @staticmethod
+    def __volume_lists(curr_target, subdirs, records, volume_of):
+        # paths relative to '/', as tar stores them; directories go into the first volume
+        root = os.path.abspath(curr_target).decode('utf8').lstrip(os.sep)
+        n_volumes = volume_of[-1] + 1 if len(volume_of) > 0 else 1
+        volumes = [[root] + [os.path.join(root, d) for d in subdirs]] + [[] for _ in range(n_volumes - 1)]
+        for record, volume in zip(records, volume_of):
+            volumes[volume].append(os.path.join(root, record[0]))
+        return volumes
+
+    def __write_index(self, curr_target, res, records, volume_of):
+        """
+        Member index of archive: record of each archived file with number of volume which holds it
+        """
+        volumes = [os.path.basename(f) for f in self.__archive_files(res)]
+        index = {u'target': os.path.abspath(curr_target).decode('utf8'),
+                 u'archive': os.path.basename(res[1]),
+                 u'volumes': volumes,
+                 u'files': [[r[0], r[1], r[2], 0 if volume_of is None else volume_of[i]]
+                            for i, r in enumerate(records)]}
+        with io.open(systool.index_file_name(res[1]), 'w', encoding='utf8') as index_file:
+            json_string = json.dumps(index, ensure_ascii=False)
+            if isinstance(json_string, bytes):
+                json_string = json_string.decode('utf8')
+            index_file.write(json_string)
+
+    @staticmethod
+    def __archive_files(res):
+        # volumed archive is listed by its hash file, archive file itself does not exist
+        volumes = systool.read_volumes(res[0])
+        if len(volumes) > 0:
+            return [v for _, v in volumes]
+        return [res[1]]
+
+    @staticmethod
+    def __index_files(res):
+        index_file = systool.index_file_name(res[1])
+        return [index_file] if os.path.exists(index_file) else []
+
+    def __map_volumes(self, function, items):
+        if len(items) == 1:
+            return [function(items[0])]
+        pool = multiprocessing.pool.ThreadPool(self._volume_workers)
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+
+    def __name_suffix(self, curr_target, chain):
+        """
+        '-<time stamp>' part of new archive name. Archive with the same time stamp as the last one of the target
+        (second run on the same day with date format) gets sequence number '.2', '.3' and so on,
+        so it does not overwrite earlier archive of the chain in destination.
+        """
+        current_time = '-' + time.strftime(self._backup_name_timestamp, time.localtime())
+        tail = self.__target_key(curr_target) + u'-'
+        if chain is None or not chain[u'last'].startswith(tail):
+            return current_time
+        last_suffix = chain[u'last'][len(tail) - 1:]
+        for ending in (INCREMENTAL_MARK + u'.tar.7z', u'.tar.7z', chunktool.MANIFEST_SUFFIX):
+            if last_suffix.endswith(ending):
+                last_suffix = last_suffix[:-len(ending)]
+                break
+        if last_suffix == current_time:
+            return current_time + '.2'
+        sequence = last_suffix[len(current_time) + 1:]
+        if last_suffix.startswith(current_time + '.') and sequence.isdigit():
+            return current_time + '.%d' % (int(sequence) + 1)
+        return current_time
+
+    def _archive_target(self, curr_target, descr_name, chain):
+        """
+        Compress stage, returns [hash file, archive file] in service directory.
+        Archive is incremental to the last one of the chain, unless full one is due.
+        In chunk mode new chunks go straight into destination store and archive file is version manifest.
+        """
+        logging.info('Creating archive for %s ', str(curr_target))
+        current_time = self.__name_suffix(curr_target, chain)
+        stored_file = os.path.join(self.metadata_path, descr_name)
+        if self._chunked:
+            started = time.time()
+            store = chunktool.open_store(os.path.join(self.dest_path, self._chunks_dir_name))
+            list_file = os.path.join(self.metadata_path, self.__target_key(curr_target) + current_time + u'.lst')
+            tar_args = None
+            if self.__target_rules(curr_target) is not None:
+                with StoredState(stored_file + PENDING_SUFFIX) as actual:
+                    tar_args = self.__listed_tar_args(curr_target, list_file, list(actual.iter_subdirs()),
+                                                      list(actual.iter_files()))
+            try:
+                res = chunktool.make_chunked_version(curr_target, self.metadata_path, store,
+                                                     name_suffix=current_time, tar_args=tar_args,
+                                                     name=self.__target_key(curr_target))
+            finally:
+                if os.path.exists(list_file):
+                    os.remove(list_file)
+            self.__metric(curr_target, u'chunk', time.time() - started)
+        elif self.__need_full_archive(chain, stored_file):
+            with StoredState(stored_file + PENDING_SUFFIX) as actual:
+                records = list(actual.iter_files())
+                subdirs = list(actual.iter_subdirs())
+            res = self.__compress(curr_target, records, subdirs, name_suffix=current_time)
+        else:
+            res = self.__make_incremental_archive(curr_target, stored_file, current_time + INCREMENTAL_MARK, chain)
+        if (res is None) or len(res) != 2:
+            logging.error('Can not create archive for %s', str(curr_target))
+            return None
+        return res
+
+    def _transfer_archive(self, curr_target, res):
+        """
+        Transfer stage: copy archive and its hash into destination dir, returns archive name
+        """
+        # archive is staged in service directory until destination is ready
+        self._destination_ready.wait()
+        files = self.__archive_files(res) + self.__index_files(res)
+        if not self._destination_ok:
+            for src in files + [res[0]]:
+                if os.path.exists(src):
+                    os.remove(src)
+            return None
+        if self._connection is None:
+            # files moved into destination by interrupted run are not copied again
+            files = [f for f in files
+                     if os.path.exists(f) or not os.path.exists(os.path.join(self.dest_path, os.path.basename(f)))]
+        started = time.time()
+        size = sum(os.path.getsize(f) for f in files + [res[0]])
+        if self._connection is not None:
+            archive_name = self.__stream_archive(res, files, self.__target_key(curr_target))
+        else:
+            archive_name = self.__copy_archive(res, files)
+        if archive_name is not None:
+            self.__metric(curr_target, u'copy', time.time() - started, size, len(files) + 1)
+        return archive_name
+
+    def __copy_archive(self, res, files):
+        # archive (all its volumes and index) goes first, so its hash file in destination means the archive is complete
+        zip_done = all(self.__map_volumes(self.__transfer_file, files))
+        sha_done = zip_done and self.__transfer_file(res[0])
+        if not (sha_done and zip_done):
+            # local archive and partial copies in destination are kept, next run continues the copy
+            logging.error('Copy %s or %s failed.', str(res[0]), str(res[1]))
+            return None
+        logging.info('Copy %s and %s done.', str(res[0]), str(res[1]))
+        _, archive_name = os.path.split(res[1])
+        return archive_name
+
+    def __stream_archive(self, res, files, target_key):
+        # receiver checks hash on arrival and writes hash file itself
+        volumes = systool.read_volumes(res[0])
+        if len(volumes) == 0:
+            with io.open(res[0], 'r', encoding='utf8') as sha_file:
+                volumes = [(sha_file.read().split()[0], res[1])]
+
+        def send_volume(volume):
+            # only failed volume is sent again
+            for attempt in range(self._transfer_retries + 1):
+                if self._connection.send_file(volume[1], volume[0], target_key):
+                    return True
+                logging.warning('Stream %s failed, attempt %s.', str(volume[1]), str(attempt + 1))
+            return False
+        done = all(self.__map_volumes(send_volume, volumes))
+        for index_file in self.__index_files(res):
+            # index is only stored by receiver
+            done = done and self._connection.send_file(index_file, systool.sha512_file(index_file)[0], target_key)
+        if done and len(volumes) > 1:
+            # receiver registers volumed archive when its hash file comes after all volumes
+            done = self._connection.send_file(res[0], systool.sha512_file(res[0])[0], target_key)
+        for src in files + [res[0]]:
+            if os.path.exists(src):
+                os.remove(src)
+        if not done:
+            logging.error('Stream %s failed.', str(res[1]))
+            return None
+        logging.info('Stream %s done.', str(res[1]))
+        _, archive_name = os.path.split(res[1])
+        return archive_name
+
+    def __transfer_file(self, src):
+        stats = copytool.transfer_file(src, self.dest_path,
+                                       retries=self._transfer_retries,
+                                       retry_delay=self._transfer_retry_delay,
+                                       block_size=self._transfer_block_size)
+        return not stats is None
+
+    def __load_chains(self):
+        chains_file = os.path.join(self.metadata_path, CHAINS_FILE_NAME)
+        if not os.path.exists(chains_file):
+            return {}
+        with io.open(chains_file, 'r', encoding='utf8') as source_file:
+            return json.loads(source_file.read())
+
+    def __save_chains(self, chains):
+        with io.open(os.path.join(self.metadata_path, CHAINS_FILE_NAME), 'w', encoding='utf8') as json_file:
+            json_string = json.dumps(chains, ensure_ascii=False)
+            if isinstance(json_string, bytes):
+                json_string = json_string.decode('utf8')
+            json_file.write(json_string)
+
+    def __target_key(self, curr_target):
+        # server keeps versions and retention of target by this name, archive names start with it;
+        # clients of ingest queue share destination, so their targets are named by client too
+        if self._ingest_queue:
+            return self._client_id + u'.' + os.path.basename(curr_target)
+        return os.path.basename(curr_target)
+
+    def __list_entry(self, curr_target, archive_name):
+        """
+        Entry of archive list for server: '<archive name>\t<target>'
+        """
+        return archive_name + streamtool.LIST_SEPARATOR + self.__target_key(curr_target)
+
+    def __update_chain(self, curr_target, archive_name):
+        if archive_name.endswith(INCREMENTAL_MARK + u'.tar.7z'):
+            self._chains[curr_target][u'last'] = archive_name
+        else:
+            self._chains[curr_target] = {u'base': archive_name, u'last': archive_name, u'full_time': time.time()}
+
+    def __finish_target(self, actual_metadata, backuped_list, curr_target, descr_name, pending_descr,
+                        archive_name):
+        # stored state is replaced only when archive of the target reached destination
+        if pending_descr is None:
+            if self._journal is not None:
+                self._journal.commit(curr_target)
+            self.__journal_step(runtool.STEP_FINISHED, [curr_target, descr_name, pending_descr])
+            return
+        pending_file = os.path.join(self.metadata_path, pending_descr)
+        if archive_name is None:
+            # pending state stays with archive kept for the next run
+            if os.path.exists(pending_file) and not runtool.is_staged(self.metadata_path, descr_name):
+                os.remove(pending_file)
+            return
+        os.rename(pending_file, os.path.join(self.metadata_path, descr_name))
+        runtool.remove_staged(self.metadata_path, descr_name)
+        if self._journal is not None:
+            self._journal.commit(curr_target)
+        if self._verify_content:
+            cachetool.ContentCache(cachetool.cache_file_name(self.metadata_path, curr_target)).commit()
+        actual_metadata[curr_target] = descr_name
+        self.__update_chain(curr_target, archive_name)
+        backuped_list.append(self.__list_entry(curr_target, archive_name))
+        if self._stream_handoff and self._connection is None:
+            self.__publish_archive(archive_name, self.__list_entry(curr_target, archive_name))
+        self.__journal_step(runtool.STEP_FINISHED, [curr_target, descr_name, pending_descr],
+                            archive_name=archive_name)
+
+    def __journal_step(self, step, scan_res, res=None, archive_name=None):
+        if self._run_journal is not None:
+            self._run_journal.record(scan_res[0], step, scan_res, res, archive_name)
+
+    def __resume_run(self, actual_metadata, backuped_list, staged):
+        """
+        Continue interrupted run from its journal: results of finished targets are applied again,
+        other targets go on from their last step, if its files are intact. Leftovers of journaled targets
+        are removed.
+        Returns {target: [scan result, archive result, archive name]}, None for target which is done.
+        """
+        resumed = {}
+        # archives kept after failed copy are not leftovers
+        keep = [f for _, res, _ in staged.values() for f in res + self.__archive_files(res) + self.__index_files(res)]
+        keep += [os.path.join(self.metadata_path, scan_res[2]) for scan_res, _, _ in staged.values()]
+        records = self._run_journal.load()
+        started = self._run_journal.started()
+        for curr_target, record in records.items():
+            if curr_target not in actual_metadata:
+                continue
+            scan_res = [curr_target, record[u'descr'], record[u'pending']]
+            fresh = self._run_journal.fresh(record)
+            pending_file = None
+            if scan_res[2] is not None:
+                pending_file = os.path.join(self.metadata_path, scan_res[2])
+            if record[u'step'] == runtool.STEP_COPIED and pending_file is not None and \
+                    not os.path.exists(pending_file):
+                # stored state was replaced already, only the finish record is missing
+                record[u'step'] = runtool.STEP_FINISHED
+            if record[u'step'] == runtool.STEP_FINISHED:
+                if record[u'archive'] is not None:
+                    actual_metadata[curr_target] = scan_res[1]
+                    self.__update_chain(curr_target, record[u'archive'])
+                    backuped_list.append(self.__list_entry(curr_target, record[u'archive']))
+                if fresh:
+                    resumed[curr_target] = None
+                continue
+            if not fresh or (pending_file is not None and not os.path.exists(pending_file)):
+                continue
+            if pending_file is not None:
+                keep.append(pending_file)
+            if record[u'step'] == runtool.STEP_COPIED:
+                resumed[curr_target] = [scan_res, None, record[u'archive']]
+            elif record[u'step'] == runtool.STEP_ARCHIVED and runtool.archive_intact(record[u'res']):
+                keep += record[u'res'] + self.__archive_files(record[u'res']) + self.__index_files(record[u'res'])
+                resumed[curr_target] = [scan_res, record[u'res'], None]
+            else:
+                resumed[curr_target] = [scan_res, None, None]
+            logging.info('Resume %s after step %s of interrupted run.', str(curr_target),
+                         str(record[u'step']))
+        if started is not None:
+            # only pending states and archive files of targets in journal, made by the interrupted run
+            runtool.remove_leftovers(self.metadata_path, [r[u'pending'] for r in records.values() if r[u'pending']],
+                                     tuple(self.__target_key(t) + u'-' for t in records.keys()),
+                                     LEFTOVER_SUFFIXES, started, keep)
+        return resumed
+
+    def __transfer_stage(self, scan_res, res):
+        archive_name = _run_stage(self, '_transfer_archive', (scan_res[0], res))
+        self.__transfer_done(scan_res, res, archive_name)
+        return scan_res + [archive_name]
+
+    def __transfer_done(self, scan_res, res, archive_name):
+        if archive_name is not None:
+            self.__journal_step(runtool.STEP_COPIED, scan_res, res, archive_name)
+        elif os.path.exists(res[0]):
+            # archive which is left in service directory waits for the next run with its pending state
+            logging.warning('Archive %s is kept, next run continues its copy.', str(res[1]))
+            runtool.save_staged(self.metadata_path, scan_res, res)
+        else:
+            runtool.remove_staged(self.metadata_path, scan_res[1])
+
+    def __resume_staged(self, actual_metadata):
+        """
+        Archives kept by earlier runs after failed copy go straight to copy again, if their files are intact,
+        so copy continues from its partial file in destination. Target is not scanned in this run,
+        its later changes are found by the next one.
+        Returns {target: [scan result, archive result, None]}.
+        """
+        resumed = {}
+        for curr_target, record in runtool.load_staged(self.metadata_path).items():
+            pending_file = os.path.join(self.metadata_path, record[u'pending'])
+            if curr_target in actual_metadata and os.path.exists(pending_file) and \
+                    runtool.archive_intact(record[u'res']):
+                logging.info('Continue copy of %s kept by earlier run.', str(record[u'res'][1]))
+                resumed[curr_target] = [[curr_target, record[u'descr'], record[u'pending']], record[u'res'], None]
+                continue
+            logging.warning('Kept archive %s is not usable, target is archived again.', str(record[u'res'][1]))
+            for file_name in record[u'res']:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+            runtool.remove_staged(self.metadata_path, record[u'descr'])
+        return resumed
+
+    def __run_serial(self, targets, actual_metadata, resumed):
+        staged = []
+        for curr_target in targets:
+            scan_res, res, archive_name = resumed.get(curr_target, (None, None, None))
+            if archive_name is not None:
+                yield scan_res + [archive_name]
+                continue
+            if scan_res is None:
+                scan_res = _run_stage(self, '_scan_target', (curr_target, actual_metadata[curr_target]))
+                if scan_res is None:
+                    continue
+                self.__journal_step(runtool.STEP_SCANNED, scan_res)
+            if res is None and scan_res[2] is not None:
+                res = _run_stage(self, '_archive_target', (curr_target, scan_res[1], self._chains.get(curr_target)))
+                if res is not None:
+                    self.__journal_step(runtool.STEP_ARCHIVED, scan_res, res)
+            if res is None:
+                yield scan_res + [None]
+            else:
+                staged.append((scan_res, res))
+            # archives made while destination is not ready yet wait for it in service directory
+            while len(staged) > 0 and self._destination_ready.is_set():
+                scan_res, res = staged.pop(0)
+                yield self.__transfer_stage(scan_res, res)
+        for scan_res, res in staged:
+            yield self.__transfer_stage(scan_res, res)
+
+    def __start_pools(self):
+        """
+        Worker pools of parallel run: [scan, compress, transfer].
+        Processes are forked before any thread of this process starts (destination connector,
+        transfer threads), child process must not inherit lock held by other thread.
+        """
+        return [multiprocessing.Pool(self._scan_workers), multiprocessing.Pool(self._compress_workers),
+                multiprocessing.pool.ThreadPool(self._transfer_workers)]
+
+    def __run_parallel(self, targets, actual_metadata, resumed, pools):
+        """
+        Pipeline of worker pools: scan and compress run in processes, transfer in threads.
+        Targets pass stages independently; results come back to this process, which alone
+        updates metadata and run journal, so failed workers only drop their own targets.
+        Resumed target enters the pipeline after its last finished step.
+        Each callback reports its target as done if it fails itself; target lost with killed worker
+        is waited for target_timeout at most, then the rest of targets is abandoned.
+        """
+        scan_pool, compress_pool, transfer_pool = pools
+        done = Queue.Queue()
+
+        def guarded(callback, scan_res):
+            # callback runs in result thread of pool, target it drops would be waited for forever
+            def call(value):
+                try:
+                    callback(value)
+                except Exception:
+                    target_res = scan_res if scan_res is not None else value
+                    logging.exception('Pipeline step failed for %s', str(target_res[0] if target_res else None))
+                    done.put(target_res + [None] if target_res else None)
+            return call
+
+        def on_transfer(archive_name, scan_res, res):
+            self.__transfer_done(scan_res, res, archive_name)
+            done.put(scan_res + [archive_name])
+
+        def on_archive(res, scan_res):
+            if res is None:
+                done.put(scan_res + [None])
+                return
+            self.__journal_step(runtool.STEP_ARCHIVED, scan_res, res)
+            transfer_pool.apply_async(_run_stage, (self, '_transfer_archive', (scan_res[0], res)),
+                                      callback=guarded(lambda name: on_transfer(name, scan_res, res), scan_res))
+
+        def on_scan(scan_res, curr_target):
+            if scan_res is None:
+                done.put(None)
+                return
+            self.__journal_step(runtool.STEP_SCANNED, scan_res)
+            if scan_res[2] is None:
+                done.put(scan_res + [None])
+            else:
+                compress_pool.apply_async(_run_stage,
+                                          (self, '_archive_target',
+                                           (curr_target, scan_res[1], self._chains.get(curr_target))),
+                                          callback=guarded(lambda res: on_archive(res, scan_res), scan_res))
+
+        for curr_target in targets:
+            scan_res, res, archive_name = resumed.get(curr_target, (None, None, None))
+            if archive_name is not None:
+                done.put(scan_res + [archive_name])
+            elif res is not None:
+                guarded(lambda res, s=scan_res: on_archive(res, s), scan_res)(res)
+            elif scan_res is not None:
+                guarded(lambda scan_res, t=curr_target: on_scan(scan_res, t), scan_res)(scan_res)
+            else:
+                scan_pool.apply_async(_run_stage, (self, '_scan_target', (curr_target, actual_metadata[curr_target])),
+                                      callback=guarded(lambda scan_res, t=curr_target: on_scan(scan_res, t), None))
+        complete = False
+        try:
+            for _ in targets:
+                try:
+                    item = done.get(timeout=self._target_timeout)
+                except Queue.Empty:
+                    logging.error('No target finished in %s minutes, remaining targets are abandoned.',
+                                  str(self._target_timeout // 60))
+                    break
+                if item is not None:
+                    yield item
+            else:
+                complete = True
+        finally:
+            # hung transfer thread can not be joined, abandoned pools are only terminated
+            for pool in pools:
+                if complete:
+                    pool.close()
+                else:
+                    pool.terminate()
+            if complete:
+                for pool in pools:
+                    pool.join()
+
     def backup(self):
         # check settings
         if self.target_list is None or len(self.target_list) == 0:
@@ -285,90 +1711,85 @@ class BackupController(object):
         if self.metadata_dict_name is None:
             logging.error('Metadata dictionary not found: %s.', str(self.metadata_dict_name))
 
-        if self.dest_mount is None or len(self.dest_mount) == 0:
+        nfs = self._transport == TRANSPORT_NFS
+        if nfs and (self.dest_mount is None or len(self.dest_mount) == 0):
             logging.error('Destination mount point not found: %s', str(self.dest_mount))
             quit(-1)
 
-        # connect network folder
-        if not nettool.ping(self.server_ip, n_packets=2):
-            logging.info('Server (ip=%s) wake-on-LAN start.', str(self.server_ip))
-            nettool.wake_on_lan(self.server_mac)
-            if not nettool.ping(self.server_ip, n_packets=2, wait_before=60):
-                logging.error('Server wake-on-LAN failed: %s , %s', str(self.server_ip), str(self.server_mac))
+        pools = None
+        if self._parallel:
+            pools = self.__start_pools()
+
+        # connect destination, in overlap mode while targets are scanned and archived
+        self._destination_ready.clear()
+        self._destination_ok = False
+        if self._overlap_wakeup:
+            connector = threading.Thread(target=self.__connect_destination)
+            connector.daemon = True
+            connector.start()
+        else:
+            self.__connect_destination()
+            if not self._destination_ok:
                 quit(-1)
 
-        if not systool.mount_nfs_folder(self.dest_mount):
-            logging.error('Server folder mount failed: %s', str(self.dest_mount))
-            quit(-1)
-
-        if self.dest_path is None:
-            logging.error('Destination path not found: %s', str(self.dest_path))
-            quit(-1)
-
         # load stored metadata about target directories
         actual_metadata = self.load_metadata()
+        self._chains = self.__load_chains()
         backuped_list = []
 
-        # compare stored and actual metadata on each target dir
-        for curr_target in actual_metadata.keys():
-            m_el = actual_metadata[curr_target]
-            logging.info('Process directory %s ...', str(curr_target))
-            target_descr = DirDescriptor(curr_target)
-            target_descr.load_actual_state()
-            need_backup = False
-
-            if m_el is None:
-                logging.info('Create new directory description for %s ', str(curr_target))
-                _, body = os.path.split(curr_target)
-                actual_metadata[curr_target] = body + u'.json'
-                target_descr.save_to_json(os.path.join(self.metadata_path, actual_metadata[curr_target]))
-                logging.info('Description %s saved.', str(actual_metadata[curr_target]))
-                need_backup = True
-            else:
-                control_descr = DirDescriptor(curr_target)
-                control_descr.load_stored_state(os.path.join(self.metadata_path, actual_metadata[curr_target]))
+        # interrupted run is finished first, its done targets are not processed again
+        resumed = self.__resume_staged(actual_metadata)
+        if self._run_journal is not None:
+            resumed.update(self.__resume_run(actual_metadata, backuped_list, resumed))
+        targets = [t for t in actual_metadata.keys() if t not in resumed or resumed[t] is not None]
 
-                if control_descr == target_descr:
-                    logging.info('Changes not found at %s ', str(curr_target))
-                else:
-                    logging.info('Found changes at %s ', str(curr_target))
-                    need_backup = True
-
-            # update archive for this directory
-            if need_backup:
-                logging.info('Creating archive for %s ', str(curr_target))
-                current_time = '-' + time.strftime(self._backup_name_timestamp, time.localtime())
-                res = systool.make_archived_file(curr_target, self.metadata_path, name_suffix=current_time)
-
-                if (res is None) or len(res) != 2:
-                    logging.error('Can not create archive for %s', str(curr_target))
-                    continue
+        # compare stored and actual metadata on each target dir, archive and copy changed ones
+        if self._parallel:
+            results = self.__run_parallel(targets, actual_metadata, resumed, pools)
+        else:
+            results = self.__run_serial(targets, actual_metadata, resumed)
+        for curr_target, descr_name, pending_descr, archive_name in results:
+            self.__finish_target(actual_metadata, backuped_list, curr_target, descr_name, pending_descr, archive_name)
 
-                # copy archive and its hash into destination dir
-                systool.copy_with_cleanup(res[1], self.dest_path)
-                systool.copy_with_cleanup(res[0], self.dest_path)
-                logging.info('Copy %s and %s done.', str(res[1]), str(res[1]))
-                _, res[1] = os.path.split(res[1])
-                backuped_list.append(res[1])
+        # save updated metadata, targets without successful first backup have no descriptor yet
+        self.__save_metadata_dict(dict((k, v) for k, v in actual_metadata.items() if v is not None))
+        self.__save_chains(dict((k, v) for k, v in self._chains.items() if k in actual_metadata))
 
-        # save updated metadata
-        self.__save_metadata_dict(actual_metadata)
+        self._destination_ready.wait()
+        if not self._destination_ok:
+            logging.error('Destination was not ready, archives are not copied.')
+            quit(-1)
 
-        # save list of updated archives in destination dir
-        if len(backuped_list) > 0:
-            self._save_backup_list(backuped_list)
-        else:
+        if len(backuped_list) == 0:
             logging.info('No changed directories found, finishing.')
 
-        # start hash check on server side
-        exec_path, _ = os.path.split(sys.argv[0])
-        exec_path = os.path.join(exec_path, 'ssh_cmd.run')
-        if not systool.try_execute_command(exec_path):
-            logging.error('Checksum recalculation task on serverside failed: %s', str(exec_path))
+        if not nfs:
+            # archives are already verified and registered by receiver
+            self._connection.close()
+            self._connection = None
+        elif self._stream_handoff:
+            with io.open(os.path.join(self.dest_path, self._incoming_dir_name, DONE_MARKER), 'w',
+                         encoding='utf8') as done_file:
+                done_file.write(('\n'.join(backuped_list)).decode('utf8'))
+        elif self._ingest_queue:
+            # resident ingest daemon on server takes jobs of all clients
+            if len(backuped_list) > 0:
+                self.__submit_manifest(backuped_list)
         else:
-            logging.info('Checksum recalculation task on serverside start: %s', str(exec_path))
+            # save list of updated archives in destination dir
+            if len(backuped_list) > 0:
+                self._save_backup_list(backuped_list)
+
+            # start hash check on server side
+            self.__start_server_check()
+
+        # archives are handed to server, nothing is left to resume
+        if self._run_journal is not None:
+            self._run_journal.clear()
 
         # disconnect net folders
-        if not systool.umount_nfs_folder(self.dest_mount):
+        if nfs and not systool.umount_nfs_folder(self.dest_mount):
             logging.error('Server folder umount failed: %s', str(self.dest_mount))
+        if self._metrics is not None:
+            self._metrics.finish()
         logging.info('Backup finished.')
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import sys
+import os
+import io
+import json
+import time
+import errno
+import fcntl
+import select
+import struct
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import ConfigParser
+
+# journal entries: content of directory changed / whole subtree is new and must be read
+DIRTY = u'D'
+SUBTREE = u'T'
+LOCK_FILE_NAME = u'.lock'
+HEARTBEAT_SECONDS = 30
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+_EVENT = struct.Struct('iIII')
+
+
+class ChangeJournal(object):
+    """
+    Persistent per-target journal of changed directories, written by watcher daemon.
+    <key>.dirty collects entries, backup run moves them into <key>.taken and removes
+    that file only after target is backed up, so entries of failed run are used again.
+    <key>.state tells since when the daemon watches the target without gaps.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __file(self, target, suffix):
+        key = hashlib.sha1(os.path.abspath(target).encode('utf8')).hexdigest()[:16]
+        return os.path.join(self.path, key + suffix)
+
+    def __locked(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        lock_file = io.open(os.path.join(self.path, LOCK_FILE_NAME), 'w')
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        return lock_file
+
+    def record(self, target, entries):
+        lines = u''.join(u'%s\t%s\n' % (kind, rel_dir) for kind, rel_dir in entries)
+        lock_file = self.__locked()
+        try:
+            with io.open(self.__file(target, u'.dirty'), 'a', encoding='utf8') as dirty_file:
+                dirty_file.write(lines)
+        finally:
+            lock_file.close()
+
+    def take(self, target):
+        """
+        Move recorded entries into taken ones, returns set of all taken (kind, relative dir)
+        """
+        dirty = self.__file(target, u'.dirty')
+        taken = self.__file(target, u'.taken')
+        lock_file = self.__locked()
+        try:
+            if os.path.exists(dirty):
+                with io.open(dirty, 'r', encoding='utf8') as dirty_file:
+                    lines = dirty_file.read()
+                with io.open(taken, 'a', encoding='utf8') as taken_file:
+                    taken_file.write(lines)
+                os.remove(dirty)
+        finally:
+            lock_file.close()
+        entries = set()
+        if os.path.exists(taken):
+            with io.open(taken, 'r', encoding='utf8') as taken_file:
+                for line in taken_file:
+                    kind, _, rel_dir = line.rstrip(u'\n').partition(u'\t')
+                    entries.add((kind, rel_dir))
+        return entries
+
+    def commit(self, target):
+        taken = self.__file(target, u'.taken')
+        if os.path.exists(taken):
+            os.remove(taken)
+
+    def write_state(self, target, started, watching):
+        state_file = self.__file(target, u'.state')
+        with io.open(state_file + u'.tmp', 'w', encoding='utf8') as out_file:
+            out_file.write(json.dumps({u'target': target, u'started': started, u'watching': watching,
+                                       u'alive': time.time()}).decode('utf8'))
+        os.rename(state_file + u'.tmp', state_file)
+
+    def covers(self, target, since):
+        """
+        True if daemon is alive and watched the whole target without overflow since given time
+        """
+        state_file = self.__file(target, u'.state')
+        if since is None or not os.path.exists(state_file):
+            return False
+        with io.open(state_file, 'r', encoding='utf8') as source_file:
+            state = json.loads(source_file.read())
+        return state[u'watching'] and state[u'started'] <= since and \
+            time.time() - state[u'alive'] < 3 * HEARTBEAT_SECONDS
+
+
+class JournalDaemon(object):
+    """
+    Resident inotify watcher of all directories of targets.
+    Directory with changed entries is journaled as DIRTY, created or moved in directory as SUBTREE.
+    Event queue overflow journals SUBTREE of target root, so next run scans whole target;
+    target which can not be watched completely (watch limit) is reported as not watching.
+    """
+    def __init__(self, journal, targets):
+        self.journal = journal
+        self.targets = [os.path.abspath(t) for t in targets]
+        self.__libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.__fd = self.__libc.inotify_init()
+        if self.__fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.__watches = {}
+        self.__started = {}
+        self.__watching = {}
+
+    def __add_watch(self, target, rel_dir):
+        path = os.path.join(target, rel_dir) if rel_dir else target
+        wd = self.__libc.inotify_add_watch(self.__fd, path.encode('utf8'), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                logging.error('inotify watch limit reached, %s is not watched completely.', path.encode('utf8'))
+                self.__watching[target] = False
+            elif err not in (errno.ENOENT, errno.ENOTDIR):
+                logging.error('Can not watch %s: %s', path.encode('utf8'), os.strerror(err))
+                self.__watching[target] = False
+            return
+        self.__watches[wd] = (target, rel_dir)
+
+    def __watch_tree(self, target, rel_dir):
+        self.__add_watch(target, rel_dir)
+        top = os.path.join(target, rel_dir) if rel_dir else target
+        for dir_path, dir_names, _ in os.walk(top):
+            for name in dir_names:
+                self.__add_watch(target, os.path.relpath(os.path.join(dir_path, name), target))
+
+    def __start_target(self, target):
+        self.__watching[target] = True
+        self.__watch_tree(target, u'')
+        self.__started[target] = time.time()
+        self.journal.write_state(target, self.__started[target], self.__watching[target])
+
+    def __read_events(self):
+        data = os.read(self.__fd, 65536)
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, name_len = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = data[pos:pos + name_len].rstrip(b'\0').decode('utf8', 'replace')
+            pos += name_len
+            yield wd, mask, name
+
+    def __handle(self, changes):
+        for wd, mask, name in self.__read_events():
+            if mask & IN_Q_OVERFLOW:
+                logging.warning('inotify queue overflow, targets will be scanned completely.')
+                for target in self.targets:
+                    changes.setdefault(target, set()).add((SUBTREE, u''))
+                continue
+            watch = self.__watches.get(wd)
+            if watch is None:
+                continue
+            target, rel_dir = watch
+            if mask & IN_IGNORED:
+                self.__watches.pop(wd, None)
+                continue
+            target_changes = changes.setdefault(target, set())
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # parent journals removal of its entry, target root itself is rescanned
+                if rel_dir == u'':
+                    target_changes.add((SUBTREE, u''))
+                continue
+            target_changes.add((DIRTY, rel_dir))
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                child = os.path.join(rel_dir, name) if rel_dir else name
+                self.__watch_tree(target, child)
+                target_changes.add((SUBTREE, child))
+
+    def run(self):
+        for target in self.targets:
+            self.__start_target(target)
+        logging.info('Watching %s directories of %s targets.', str(len(self.__watches)), str(len(self.targets)))
+        last_beat = time.time()
+        while True:
+            ready, _, _ = select.select([self.__fd], [], [], HEARTBEAT_SECONDS)
+            if ready:
+                changes = {}
+                self.__handle(changes)
+                for target, entries in changes.items():
+                    self.journal.record(target, sorted(entries))
+            if time.time() - last_beat >= HEARTBEAT_SECONDS:
+                for target in self.targets:
+                    self.journal.write_state(target, self.__started[target], self.__watching[target])
+                last_beat = time.time()
+
+
+def main(config_file):
+    """
+    Start watcher daemon with the same configuration file as backup client
+    """
+    cfg_parser = ConfigParser.SafeConfigParser()
+    cfg_parser.read(config_file)
+    target_list_file = cfg_parser.get('targets', 'list_file').decode('utf8')
+    journal_path = os.path.join(cfg_parser.get('metadata', 'path').decode('utf8'), u'journal')
+    if cfg_parser.has_option('journal', 'path'):
+        journal_path = cfg_parser.get('journal', 'path').decode('utf8')
+    if not os.path.isdir(journal_path):
+        os.makedirs(journal_path)
+
+    logging.basicConfig(filename=os.path.join(journal_path, u'journal.log'),
+                        level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    with io.open(target_list_file, 'r', encoding='utf8') as list_file:
+        targets = [t.strip() for t in list_file.readlines() if len(t.strip()) > 0]
+    JournalDaemon(ChangeJournal(journal_path), targets).run()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
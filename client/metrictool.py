@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import json
+import time
+import fcntl
+
+MB = 1024.0 * 1024.0
+SUMMARY_PHASE = u'run'
+
+
+def _json_line(record):
+    json_string = json.dumps(record, ensure_ascii=False, sort_keys=True)
+    if isinstance(json_string, bytes):
+        json_string = json_string.decode('utf8')
+    return json_string + u'\n'
+
+
+def _append(file_name, text):
+    # worker processes of one run and different runs may append at the same time
+    with io.open(file_name, 'a', encoding='utf8') as out_file:
+        fcntl.flock(out_file.fileno(), fcntl.LOCK_EX)
+        out_file.write(text)
+        out_file.flush()
+
+
+class RunMetrics(object):
+    """
+    Wall time, processed bytes and files of each phase of each target, one JSON line per record
+    in run file. Finished run appends summary line (totals of each phase) and copies all its lines
+    into history file, if given. Only file names are kept, so object can be sent to worker processes.
+    """
+    def __init__(self, run_file, history_file=None, side=u'client'):
+        self.run_file = run_file
+        self.history_file = history_file
+        self.side = side
+        self.run_id = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime())
+        self.started = time.time()
+        if os.path.exists(self.run_file):
+            os.remove(self.run_file)
+
+    def record(self, target, phase, seconds, size=None, files=None):
+        """
+        Record phase of target (None - phase of the whole run)
+        """
+        record = {u'run': self.run_id, u'side': self.side, u'time': time.time(),
+                  u'target': target.decode('utf8') if isinstance(target, bytes) else target,
+                  u'phase': phase, u'seconds': seconds}
+        if size is not None:
+            record[u'bytes'] = size
+            if seconds > 0:
+                record[u'mb_per_sec'] = size / MB / seconds
+        if files is not None:
+            record[u'files'] = files
+        _append(self.run_file, _json_line(record))
+
+    def load(self):
+        if not os.path.exists(self.run_file):
+            return []
+        with io.open(self.run_file, 'r', encoding='utf8') as run_file:
+            return [json.loads(l) for l in run_file if len(l.strip()) > 0]
+
+    def finish(self):
+        records = self.load()
+        phases = {}
+        for record in records:
+            total = phases.setdefault(record[u'phase'], {u'seconds': 0.0, u'bytes': 0, u'files': 0, u'count': 0})
+            total[u'seconds'] += record[u'seconds']
+            total[u'bytes'] += record.get(u'bytes', 0)
+            total[u'files'] += record.get(u'files', 0)
+            total[u'count'] += 1
+        summary = {u'run': self.run_id, u'side': self.side, u'time': time.time(), u'target': None,
+                   u'phase': SUMMARY_PHASE, u'seconds': time.time() - self.started, u'phases': phases}
+        _append(self.run_file, _json_line(summary))
+        if self.history_file is not None:
+            _append(self.history_file, u''.join(_json_line(r) for r in records + [summary]))
@@ -31,3 +31,33 @@ def ping(ip_address, n_packets=1, wait_before=0):
     command = ['ping', param, ip_address]
     return subprocess.call(command) == 0
 
+
+
+def port_open(ip_address, port, timeout=1.0):
+    try:
+        sock = socket.create_connection((ip_address, port), timeout)
+        sock.close()
+        return True
+    except (socket.error, socket.timeout):
+        return False
+
+
+def wait_server_ready(ip_address, ports, deadline, mac_address=None,
+                      first_delay=1.0, max_delay=16.0, probe_timeout=1.0):
+    """
+    Poll service ports until all of them accept connection, sending magic packet
+    before each wait; waits grow twice up to max_delay.
+    Returns seconds spent or None if server is not ready in deadline seconds.
+    """
+    started = time.time()
+    delay = first_delay
+    while True:
+        if all(port_open(ip_address, p, probe_timeout) for p in ports):
+            return time.time() - started
+        elapsed = time.time() - started
+        if elapsed >= deadline:
+            return None
+        if mac_address is not None:
+            wake_on_lan(mac_address)
+        time.sleep(min(delay, deadline - elapsed))
+        delay = min(delay * 2, max_delay)
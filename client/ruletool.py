@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import io
+import json
+import time
+import fnmatch
+import hashlib
+import logging
+import ConfigParser
+
+MB = 1024 * 1024
+DAY_SECONDS = 24 * 3600
+
+
+def _split(value, separators):
+    return [v.strip() for v in re.split(separators, value) if len(v.strip()) > 0]
+
+
+def _compile_globs(patterns):
+    """
+    Pair of regular expressions: patterns matched against name, patterns with '/' against relative path
+    """
+    name_patterns = [fnmatch.translate(p) for p in patterns if os.sep not in p]
+    path_patterns = [fnmatch.translate(p.strip(os.sep)) for p in patterns if os.sep in p]
+    return (re.compile(u'|'.join(name_patterns)) if len(name_patterns) > 0 else None,
+            re.compile(u'|'.join(path_patterns)) if len(path_patterns) > 0 else None)
+
+
+def _glob_match(compiled, rel_path):
+    name_re, path_re = compiled
+    return (name_re is not None and name_re.match(os.path.basename(rel_path)) is not None) or \
+        (path_re is not None and path_re.match(rel_path) is not None)
+
+
+class TargetRules(object):
+    """
+    Include/exclude rules of one target, compiled once and applied to each entry during directory walk:
+    - exclude: glob patterns, pattern with '/' is matched against relative path, other ones against name,
+    - exclude_regex: regular expressions searched in relative path,
+    - max_size_mb, max_age_days: larger or older files are excluded (0 - no limit),
+    - include: glob patterns of files kept in spite of exclude rules.
+    Excluded directory is not descended into, so include rules do not apply inside it.
+    Fingerprint of rules is kept in descriptor, so changed rules give new state of the target.
+    """
+    def __init__(self, exclude=(), exclude_regex=(), include=(), max_size_mb=0, max_age_days=0):
+        self.__exclude = _compile_globs(exclude)
+        self.__exclude_regex = re.compile(u'|'.join(exclude_regex)) if len(exclude_regex) > 0 else None
+        self.__include = _compile_globs(include)
+        self.__max_size = max_size_mb * MB
+        self.__oldest = time.time() - max_age_days * DAY_SECONDS if max_age_days > 0 else None
+        rules = [sorted(exclude), sorted(exclude_regex), sorted(include), max_size_mb, max_age_days]
+        self.fingerprint = hashlib.sha1(json.dumps(rules).encode('utf8')).hexdigest()[:16].decode('utf8')
+
+    def excludes(self, rel_path, is_dir, stat=None):
+        """
+        True if entry is excluded; stat (function returning stat result) is called only by size and age rules
+        """
+        if not is_dir and _glob_match(self.__include, rel_path):
+            return False
+        if _glob_match(self.__exclude, rel_path):
+            return True
+        if self.__exclude_regex is not None and self.__exclude_regex.search(rel_path) is not None:
+            return True
+        if is_dir or stat is None or (self.__max_size == 0 and self.__oldest is None):
+            return False
+        sys_info = stat()
+        if self.__max_size > 0 and sys_info.st_size > self.__max_size:
+            return True
+        return self.__oldest is not None and sys_info.st_mtime < self.__oldest
+
+
+def load_rules(rules_file):
+    """
+    Rules of targets from INI file with section for each target path, returns {absolute target path: rules}
+    """
+    rules = {}
+    if rules_file is None:
+        return rules
+    if not os.path.exists(rules_file):
+        logging.warning('Target rules file %s not found, targets are archived completely.', str(rules_file))
+        return rules
+    cfg_parser = ConfigParser.RawConfigParser()
+    with io.open(rules_file, 'r', encoding='utf8') as source_file:
+        cfg_parser.readfp(source_file)
+    for target in cfg_parser.sections():
+        def option(name, default=u''):
+            return cfg_parser.get(target, name) if cfg_parser.has_option(target, name) else default
+        rules[os.path.abspath(target)] = TargetRules(
+            exclude=_split(option('exclude'), u'[,\n]'),
+            exclude_regex=_split(option('exclude_regex'), u'\n'),
+            include=_split(option('include'), u'[,\n]'),
+            max_size_mb=int(option('max_size_mb', 0)),
+            max_age_days=int(option('max_age_days', 0)))
+        logging.info('Rules for %s loaded.', target.encode('utf8'))
+    return rules
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import json
+import time
+import fcntl
+import logging
+import systool
+
+RUN_JOURNAL_FILE_NAME = u'run.journal'
+STAGED_SUFFIX = u'.staged.json'
+STEP_SCANNED = u'scanned'
+STEP_ARCHIVED = u'archived'
+STEP_COPIED = u'copied'
+STEP_FINISHED = u'finished'
+
+
+class RunJournal(object):
+    """
+    Write-ahead journal of backup run in service directory: one JSON line for each step a target
+    passed (scanned, archived, copied, finished), synced to disk before the run goes on.
+    Journal is removed when list of archives is handed to server, so journal found at start
+    belongs to interrupted run; the last record of each target tells where to continue.
+    """
+    def __init__(self, path, resume_hours=24):
+        self.journal_file = os.path.join(path, RUN_JOURNAL_FILE_NAME)
+        self.resume_seconds = resume_hours * 3600
+
+    def record(self, target, step, scan_res, res=None, archive_name=None):
+        record = {u'target': target, u'step': step, u'time': time.time(),
+                  u'descr': scan_res[1], u'pending': scan_res[2], u'res': res, u'archive': archive_name}
+        json_string = json.dumps(record, ensure_ascii=False)
+        if isinstance(json_string, bytes):
+            json_string = json_string.decode('utf8')
+        # stages of parallel run report from several threads
+        with io.open(self.journal_file, 'a', encoding='utf8') as journal_file:
+            fcntl.flock(journal_file.fileno(), fcntl.LOCK_EX)
+            journal_file.write(json_string + u'\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    def load(self):
+        """
+        {target: last record}; line torn by interruption is ignored
+        """
+        records = {}
+        if not os.path.exists(self.journal_file):
+            return records
+        with io.open(self.journal_file, 'r', encoding='utf8') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning('Incomplete record of run journal skipped.')
+                    continue
+                records[record[u'target']] = record
+        return records
+
+    def started(self):
+        """
+        Time of the first record (start of interrupted run), None if there is no journal
+        """
+        if not os.path.exists(self.journal_file):
+            return None
+        with io.open(self.journal_file, 'r', encoding='utf8') as journal_file:
+            for line in journal_file:
+                try:
+                    return json.loads(line)[u'time']
+                except ValueError:
+                    continue
+        return None
+
+    def fresh(self, record):
+        # scan result of old interrupted run is outdated, target is scanned again
+        return time.time() - record[u'time'] < self.resume_seconds
+
+    def clear(self):
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+
+
+def archive_intact(res):
+    """
+    True if staged archive [hash file, archive file] can be used again: hash file exists and each
+    archive file (volume) still in service directory matches its hash. Missing file was moved
+    into destination by interrupted copy, copy renames file into place only when it is complete.
+    """
+    if not os.path.exists(res[0]):
+        return False
+    volumes = systool.read_volumes(res[0])
+    if len(volumes) == 0:
+        with io.open(res[0], 'r', encoding='utf8') as sha_file:
+            volumes = [(sha_file.read().split()[0], res[1])]
+    for expected, file_name in volumes:
+        if not os.path.exists(file_name):
+            continue
+        actual = systool.sha512_file(file_name)
+        if actual is None or actual[0] != expected:
+            logging.warning('Staged file %s does not match its hash.', file_name.encode('utf8'))
+            return False
+    return True
+
+
+def save_staged(path, scan_res, res):
+    """
+    Keep archive whose copy failed for the next run: marker beside descriptor of the target names
+    target, its descriptor and pending state and archive result [hash file, archive file]
+    """
+    record = {u'target': scan_res[0], u'descr': scan_res[1], u'pending': scan_res[2], u'res': res,
+              u'time': time.time()}
+    json_string = json.dumps(record, ensure_ascii=False)
+    if isinstance(json_string, bytes):
+        json_string = json_string.decode('utf8')
+    marker = os.path.join(path, scan_res[1] + STAGED_SUFFIX)
+    with io.open(marker + u'.tmp', 'w', encoding='utf8') as marker_file:
+        marker_file.write(json_string)
+    os.rename(marker + u'.tmp', marker)
+
+
+def is_staged(path, descr_name):
+    return os.path.exists(os.path.join(path, descr_name + STAGED_SUFFIX))
+
+
+def load_staged(path):
+    """
+    {target: record} of archives kept by earlier runs; damaged marker is removed
+    """
+    records = {}
+    for name in os.listdir(path):
+        if not name.endswith(STAGED_SUFFIX):
+            continue
+        try:
+            with io.open(os.path.join(path, name), 'r', encoding='utf8') as marker_file:
+                record = json.loads(marker_file.read())
+        except ValueError:
+            logging.warning('Damaged marker %s of kept archive removed.', name.encode('utf8'))
+            os.remove(os.path.join(path, name))
+            continue
+        records[record[u'target']] = record
+    return records
+
+
+def remove_staged(path, descr_name):
+    marker = os.path.join(path, descr_name + STAGED_SUFFIX)
+    if os.path.exists(marker):
+        os.remove(marker)
+
+
+def remove_leftovers(path, names, prefixes, suffixes, since, keep):
+    """
+    Remove temporary files of interrupted run from service directory, except files in keep:
+    files in names and files made by the run itself - name starts with one of prefixes (archive names
+    of its targets), ends with one of suffixes and file was modified after the run started
+    """
+    keep = set(os.path.abspath(k) for k in keep)
+    names = set(names)
+    for name in os.listdir(path):
+        file_name = os.path.join(path, name)
+        if not os.path.isfile(file_name) or os.path.abspath(file_name) in keep:
+            continue
+        # file system may keep modification time in whole seconds
+        if name in names or (name.startswith(prefixes) and name.endswith(suffixes) and
+                             os.path.getmtime(file_name) >= int(since)):
+            logging.warning('Remove leftover of interrupted run: %s', file_name.encode('utf8'))
+            os.remove(file_name)
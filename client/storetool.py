@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import json
+import mmap
+import struct
+import time
+import calendar
+import binascii
+import logging
+
+STORE_MAGIC = b'SUBTDSC1'
+STORE_EXTENSION = u'.dsc'
+
+# magic, length of header json, number of subdirs, files and indexed directories
+_HEADER = struct.Struct('<8sIQQQ')
+# offset and length of section
+_SECTION = struct.Struct('<QQ')
+# length of prefix shared with previous path and length of path suffix
+_PATH_ENTRY = struct.Struct('<II')
+_DIR_TIMES = struct.Struct('<dd')
+_HASH_SIZE = 64
+_SECTIONS = (u'subdirs', u'files', u'mtimes', u'sizes', u'dirs', u'dir_times', u'dir_hashes')
+_LIST_KEYS = (u'subdirs', u'files', u'dirs')
+_PACK_CHUNK = 65536
+_COMPARE_CHUNK = 1024 * 1024
+
+
+class TimeFormatter(object):
+    """
+    Conversion of file mtime between unix seconds and descriptor string form
+    """
+    def __init__(self, time_format):
+        self.time_format = time_format
+        self.__strings = {}
+        self.__seconds = {}
+
+    def to_string(self, seconds):
+        str_mtime = self.__strings.get(seconds)
+        if str_mtime is None:
+            str_mtime = time.strftime(self.time_format, time.gmtime(seconds)).decode('utf8')
+            self.__strings[seconds] = str_mtime
+        return str_mtime
+
+    def to_seconds(self, str_mtime):
+        seconds = self.__seconds.get(str_mtime)
+        if seconds is None:
+            seconds = calendar.timegm(time.strptime(str_mtime.encode('utf8'), self.time_format))
+            # format may lose information (i.e. no seconds field), such value can not be stored
+            if self.to_string(seconds) != str_mtime:
+                raise ValueError('Time string can not be restored: ' + str_mtime.encode('utf8'))
+            self.__seconds[str_mtime] = seconds
+        return seconds
+
+
+def is_store(filename):
+    if not os.path.isfile(filename):
+        return False
+    with io.open(filename, 'rb') as store_file:
+        return store_file.read(len(STORE_MAGIC)) == STORE_MAGIC
+
+
+def _pack_paths(paths):
+    chunks = []
+    prev = b''
+    for path in paths:
+        raw = path.encode('utf8')
+        shared = len(os.path.commonprefix([prev, raw]))
+        chunks.append(_PATH_ENTRY.pack(shared, len(raw) - shared))
+        chunks.append(raw[shared:])
+        prev = raw
+    return b''.join(chunks)
+
+
+def _size_value(str_size):
+    size = int(str_size)
+    if str(size).decode('utf8') != str_size:
+        raise ValueError('File size can not be restored: ' + str_size.encode('utf8'))
+    return size
+
+
+def _pack_numbers(fmt, values):
+    chunks = []
+    for i in range(0, len(values), _PACK_CHUNK):
+        part = values[i:i + _PACK_CHUNK]
+        chunks.append(struct.pack('<%d%s' % (len(part), fmt), *part))
+    return b''.join(chunks)
+
+
+def write_store(filename, metadata, time_format):
+    """
+    Save descriptor metadata in binary form:
+    header, section table, json with scalar fields, then 8-byte aligned sections.
+    Paths are prefix compressed, mtime (unix seconds) and size are int64 arrays,
+    directory index keeps float64 times and raw sha-512 digests.
+    """
+    formatter = TimeFormatter(time_format)
+    files = metadata.get(u'files', [])
+    subdirs = metadata.get(u'subdirs', [])
+    dirs = metadata.get(u'dirs', {})
+    dir_names = sorted(dirs.keys())
+
+    sections = [
+        _pack_paths(subdirs),
+        _pack_paths([f[0] for f in files]),
+        _pack_numbers('q', [formatter.to_seconds(f[1]) for f in files]),
+        _pack_numbers('q', [_size_value(f[2]) for f in files]),
+        _pack_paths(dir_names),
+        b''.join([_DIR_TIMES.pack(dirs[d][0], dirs[d][1]) for d in dir_names]),
+        b''.join([binascii.unhexlify(dirs[d][2]) for d in dir_names]),
+    ]
+
+    scalars = dict((k, v) for k, v in metadata.items() if k not in _LIST_KEYS)
+    header_json = json.dumps(scalars, ensure_ascii=False)
+    if not isinstance(header_json, bytes):
+        header_json = header_json.encode('utf8')
+
+    offset = _HEADER.size + _SECTION.size * len(sections) + len(header_json)
+    table = []
+    for section in sections:
+        offset += (-offset) % 8
+        table.append(_SECTION.pack(offset, len(section)))
+        offset += len(section)
+
+    temp_filename = filename + u'.tmp'
+    with io.open(temp_filename, 'wb') as store_file:
+        store_file.write(_HEADER.pack(STORE_MAGIC, len(header_json), len(subdirs), len(files), len(dir_names)))
+        store_file.write(b''.join(table))
+        store_file.write(header_json)
+        for section in sections:
+            store_file.write(b'\0' * ((-store_file.tell()) % 8))
+            store_file.write(section)
+    os.rename(temp_filename, filename)
+
+
+class DescriptorStore(object):
+    """
+    Read-only memory-mapped binary descriptor.
+    Records are decoded one by one while iterating, nothing is loaded in advance.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.__file = io.open(filename, 'rb')
+        self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, json_len, self.n_subdirs, self.n_files, self.n_dirs = _HEADER.unpack_from(self.__map, 0)
+        if magic != STORE_MAGIC:
+            self.close()
+            raise ValueError('Not a descriptor store: ' + filename.encode('utf8'))
+        self.__sections = {}
+        pos = _HEADER.size
+        for name in _SECTIONS:
+            self.__sections[name] = _SECTION.unpack_from(self.__map, pos)
+            pos += _SECTION.size
+        self.header = json.loads(self.__map[pos:pos + json_len].decode('utf8'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+        self.__file.close()
+
+    def __iter_paths(self, section):
+        offset, length = self.__sections[section]
+        pos = offset
+        prev = b''
+        while pos < offset + length:
+            shared, size = _PATH_ENTRY.unpack_from(self.__map, pos)
+            pos += _PATH_ENTRY.size
+            prev = prev[:shared] + self.__map[pos:pos + size]
+            pos += size
+            yield prev.decode('utf8')
+
+    def iter_subdirs(self):
+        return self.__iter_paths(u'subdirs')
+
+    def iter_files(self):
+        """
+        Yields (path, mtime seconds, size) of each file in sorted path order
+        """
+        mtimes_offset, _ = self.__sections[u'mtimes']
+        sizes_offset, _ = self.__sections[u'sizes']
+        for i, path in enumerate(self.__iter_paths(u'files')):
+            mtime, = struct.unpack_from('<q', self.__map, mtimes_offset + 8 * i)
+            size, = struct.unpack_from('<q', self.__map, sizes_offset + 8 * i)
+            yield path, mtime, size
+
+    def iter_records(self, time_format):
+        """
+        Yields file records in descriptor form: [path, mtime string, size string]
+        """
+        formatter = TimeFormatter(time_format)
+        for path, mtime, size in self.iter_files():
+            yield [path, formatter.to_string(mtime), str(size).decode('utf8')]
+
+    def dirs_index(self):
+        times_offset, _ = self.__sections[u'dir_times']
+        hashes_offset, _ = self.__sections[u'dir_hashes']
+        index = {}
+        for i, rel_dir in enumerate(self.__iter_paths(u'dirs')):
+            mtime, ctime = _DIR_TIMES.unpack_from(self.__map, times_offset + _DIR_TIMES.size * i)
+            pos = hashes_offset + _HASH_SIZE * i
+            digest = binascii.hexlify(self.__map[pos:pos + _HASH_SIZE]).decode('utf8')
+            index[rel_dir] = [mtime, ctime, digest]
+        return index
+
+    def same_content(self, other):
+        """
+        Compare two stores section by section on mapped bytes
+        """
+        if self.header.get(u'hash') != other.header.get(u'hash'):
+            return False
+        for name in (u'subdirs', u'files', u'mtimes', u'sizes'):
+            own_offset, own_length = self.__sections[name]
+            other_offset, other_length = other.__sections[name]
+            if own_length != other_length:
+                return False
+            for pos in range(0, own_length, _COMPARE_CHUNK):
+                size = min(_COMPARE_CHUNK, own_length - pos)
+                if self.__map[own_offset + pos:own_offset + pos + size] != \
+                        other.__map[other_offset + pos:other_offset + pos + size]:
+                    return False
+        return True
+
+    def to_metadata(self, time_format):
+        metadata = dict(self.header)
+        metadata[u'subdirs'] = list(self.iter_subdirs())
+        metadata[u'files'] = list(self.iter_records(time_format))
+        # descriptor may be saved without directory index
+        if self.n_dirs > 0:
+            metadata[u'dirs'] = self.dirs_index()
+        return metadata
+
+
+def load_metadata(filename, time_format):
+    with DescriptorStore(filename) as store:
+        return store.to_metadata(time_format)
+
+
+def migrate_json(json_file, store_file, time_format):
+    """
+    Convert stored JSON descriptor into binary store.
+    JSON file is removed only after the store is read back with the same content.
+    """
+    with io.open(json_file, 'r', encoding='utf8') as source_file:
+        metadata = json.loads(source_file.read())
+    try:
+        write_store(store_file, metadata, time_format)
+        restored = load_metadata(store_file, time_format)
+    except (ValueError, TypeError, KeyError, struct.error) as err:
+        logging.warning('Descriptor %s can not be converted: %s', str(json_file), str(err))
+        restored = None
+    if restored != metadata:
+        logging.warning('Descriptor %s kept in JSON format.', str(json_file))
+        if os.path.exists(store_file):
+            os.remove(store_file)
+        return False
+    os.remove(json_file)
+    logging.info('Descriptor %s converted to %s.', str(json_file), str(store_file))
+    return True
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import hmac
+import json
+import socket
+import struct
+import hashlib
+import logging
+import threading
+import subprocess
+
+# frame: kind, stream id, payload length; several files may be sent through one connection at once
+FRAME_HEADER = struct.Struct('<BIQ')
+FRAME_OPEN = 1
+FRAME_DATA = 2
+FRAME_CLOSE = 3
+FRAME_RESULT = 4
+FRAME_BYE = 5
+FRAME_CHALLENGE = 6
+FRAME_AUTH = 7
+DATA_SIZE = 1024 * 1024
+AUTH_TIMEOUT = 30
+# OPEN frame carries archive list entry: file name and target, as server keys versions by target
+LIST_SEPARATOR = u'\t'
+
+
+def _read_exact(read, size):
+    chunks = []
+    while size > 0:
+        data = read(size)
+        if not data:
+            raise EOFError('Connection closed')
+        chunks.append(data)
+        size -= len(data)
+    return b''.join(chunks)
+
+
+class StreamConnection(object):
+    """
+    Client side of connection to archive receiver on server.
+    Each file is a stream: OPEN with its name and target, DATA frames, CLOSE with expected SHA-512.
+    Receiver hashes data while writing and answers each stream with RESULT frame.
+    Frames of different streams are interleaved, so transfer threads share one connection.
+    """
+    def __init__(self, read, write, finish, close):
+        self.__read = read
+        self.__write = write
+        self.__finish = finish
+        self.__close = close
+        self.__write_lock = threading.Lock()
+        self.__state_lock = threading.Lock()
+        self.__next_id = 1
+        self.__results = {}
+        self.__events = {}
+        self.__lost = False
+        self.__reader = threading.Thread(target=self.__read_results)
+        self.__reader.daemon = True
+        self.__reader.start()
+
+    @classmethod
+    def tcp(cls, host, port, secret=None):
+        """
+        Connection to receiver service; with secret challenge of receiver is answered first
+        """
+        sock = socket.create_connection((host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        in_file = sock.makefile('rb', 0)
+        if secret is not None:
+            try:
+                # receiver without secret sends no challenge, connection is not kept waiting for it
+                sock.settimeout(AUTH_TIMEOUT)
+                kind, _, length = FRAME_HEADER.unpack(_read_exact(in_file.read, FRAME_HEADER.size))
+                if kind != FRAME_CHALLENGE or length > 1024:
+                    raise IOError('receiver did not send challenge')
+                nonce = _read_exact(in_file.read, length)
+                digest = hmac.new(secret, nonce, hashlib.sha256).hexdigest()
+                sock.sendall(FRAME_HEADER.pack(FRAME_AUTH, 0, len(digest)) + digest)
+                sock.settimeout(None)
+            except (EOFError, IOError, socket.error):
+                in_file.close()
+                sock.close()
+                raise IOError('authentication with receiver failed')
+
+        def close():
+            in_file.close()
+            sock.close()
+        return cls(in_file.read, sock.sendall, lambda: sock.shutdown(socket.SHUT_WR), close)
+
+    @classmethod
+    def ssh(cls, command):
+        """
+        Receiver started by command (i.e. ssh to server) talks through its stdin and stdout
+        """
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+
+        def write(data):
+            proc.stdin.write(data)
+            proc.stdin.flush()
+
+        return cls(proc.stdout.read, write, proc.stdin.close, proc.wait)
+
+    def __send_frame(self, kind, stream_id, payload=b''):
+        with self.__write_lock:
+            self.__write(FRAME_HEADER.pack(kind, stream_id, len(payload)))
+            if len(payload) > 0:
+                self.__write(payload)
+
+    def __read_results(self):
+        try:
+            while True:
+                kind, stream_id, length = FRAME_HEADER.unpack(_read_exact(self.__read, FRAME_HEADER.size))
+                payload = _read_exact(self.__read, length)
+                if kind != FRAME_RESULT:
+                    continue
+                with self.__state_lock:
+                    self.__results[stream_id] = json.loads(payload.decode('utf8'))
+                    event = self.__events.get(stream_id)
+                if event is not None:
+                    event.set()
+        except (EOFError, IOError, OSError, ValueError):
+            pass
+        finally:
+            # waiting senders get no result
+            with self.__state_lock:
+                self.__lost = True
+                for event in self.__events.values():
+                    event.set()
+
+    def send_file(self, file_name, expected_hash, target):
+        """
+        Send file of target under its base name, returns True when receiver stored it with expected hash
+        """
+        _, tail = os.path.split(file_name)
+        entry = LIST_SEPARATOR.join(n if isinstance(n, unicode) else n.decode('utf8') for n in (tail, target))
+        with self.__state_lock:
+            stream_id = self.__next_id
+            self.__next_id += 1
+            event = threading.Event()
+            self.__events[stream_id] = event
+            if self.__lost:
+                event.set()
+        try:
+            self.__send_frame(FRAME_OPEN, stream_id, entry.encode('utf8'))
+            with io.open(file_name, 'rb') as source_file:
+                while True:
+                    data = source_file.read(DATA_SIZE)
+                    if not data:
+                        break
+                    self.__send_frame(FRAME_DATA, stream_id, data)
+            self.__send_frame(FRAME_CLOSE, stream_id, expected_hash.encode('utf8'))
+            event.wait()
+        except (IOError, OSError, socket.error) as err:
+            logging.error('Stream %s error occure: %s', str(file_name), str(err))
+        with self.__state_lock:
+            self.__events.pop(stream_id, None)
+            result = self.__results.pop(stream_id, None)
+        if result is None or not result.get(u'ok'):
+            logging.error('Receiver did not store %s: %s', str(file_name), str(result))
+            return False
+        return True
+
+    def close(self):
+        # receiver closes its side after BYE, so reader thread ends before connection is closed
+        try:
+            self.__send_frame(FRAME_BYE, 0)
+            self.__finish()
+        except (IOError, OSError, socket.error):
+            pass
+        self.__reader.join(60)
+        self.__close()
@@ -2,17 +2,67 @@ import subprocess
 import os
 import logging
 import io
-import shutil
+import time
+import hashlib
+import multiprocessing.pool
 
-def make_tar(source_dir, tar_file):
-    command = ['tar', '-cvf', str(tar_file), str(source_dir)]
+HASH_BUFFER_SIZE = 1024 * 1024
+VOLUME_TEMPLATE = '.v%03d'
+INDEX_SUFFIX = u'.idx.json'
+
+def make_tar(source_dir, tar_file, tar_args=None):
+    if tar_args is None:
+        tar_args = [str(source_dir)]
+    command = ['tar', '-cvf', str(tar_file)] + tar_args
     return subprocess.call(command) == 0
 
-def make_7z(tar_file, archived_file):
-    command = ['7z', 'a', '-mx=7', str(archived_file), str(tar_file)]
+def make_7z(tar_file, archived_file, zip_args=None):
+    if zip_args is None:
+        zip_args = ['-mx=7']
+    command = ['7z', 'a'] + zip_args + [str(archived_file), str(tar_file)]
     return subprocess.call(command) == 0
 
 
+def make_streamed_7z(source_dir, archived_file, inner_name, tar_args=None, zip_args=None):
+    """
+    Pipe tar stream of source directory directly into 7z, no intermediate tar file.
+    Archive keeps single member with inner_name, the same as 7z of tar file.
+    """
+    if tar_args is None:
+        tar_args = [str(source_dir)]
+    if zip_args is None:
+        zip_args = ['-mx=7']
+    tar_command = ['tar', '-cf', '-'] + tar_args
+    zip_command = ['7z', 'a'] + zip_args + ['-si' + str(inner_name), str(archived_file)]
+    tar_proc = subprocess.Popen(tar_command, stdout=subprocess.PIPE)
+    zip_proc = subprocess.Popen(zip_command, stdin=tar_proc.stdout)
+    # 7z owns the pipe now, tar gets SIGPIPE if 7z exits early
+    tar_proc.stdout.close()
+    zip_res = zip_proc.wait()
+    tar_res = tar_proc.wait()
+    if tar_res != 0:
+        logging.error('Target : %s tar stream error, code %s', str(source_dir), str(tar_res))
+    return tar_res == 0 and zip_res == 0
+
+
+def sha512_file(archived_file):
+    """
+    In-process replacement of make_sha512, returns [hash, file name] as sha512sum does
+    """
+    sha_obj = hashlib.sha512()
+    try:
+        with io.open(archived_file, 'rb') as source_file:
+            while True:
+                data = source_file.read(HASH_BUFFER_SIZE)
+                if not data:
+                    break
+                sha_obj.update(data)
+    except IOError as ioe:
+        logging.error('Target : %s hash calculation error: %s', str(archived_file), str(ioe))
+        return None
+    return [sha_obj.hexdigest(), str(archived_file)]
+
+
 def make_sha512(archived_file):
     command = ['sha512sum', str(archived_file)]
     try:
@@ -22,33 +72,143 @@ def make_sha512(archived_file):
         logging.error('Target : %s hash calculation error. Cmd: %s, %s', str(archived_file), str(cpe.cmd), str(cpe.output))
         return None
 
-def make_archived_file(source_dir, temp_dir, name_suffix=None):
+def make_archived_file(source_dir, temp_dir, name_suffix=None, streaming=False, tar_args=None, zip_args=None,
+                       timings=None, name=None):
+    """
+    Archive source directory (or tar_args instead, if given) into temp_dir with 7z options zip_args,
+    returns [hash file, archive file] or [None, None, None] on error.
+    Archive is named after name, if given, instead of source directory.
+    Seconds of tar, compress and hash steps are put into timings dict, if given;
+    streamed tar runs inside compress step.
+    """
+    if timings is None:
+        timings = {}
     head, tail = os.path.split(source_dir)
+    if not name is None:
+        tail = name
     if not name_suffix is None:
         tail += name_suffix
     tar_filename = os.path.join(temp_dir, tail + '.tar')
     zipped_filename = os.path.join(temp_dir, tail + '.tar.7z')
     sha_filename = os.path.join(temp_dir, tail + '.sha512')
 
-    if not make_tar(source_dir, tar_filename):
-        logging.error('Target : %s tar error', str(source_dir))
-        return [None, None, None]
+    # 7z adds files into existing archive, so leftover of interrupted run must go
+    if os.path.exists(zipped_filename):
+        os.remove(zipped_filename)
 
-    if not make_7z(tar_filename, zipped_filename):
-        logging.error('Target : %s zip error', str(tar_filename))
-        return [None, None, None]
+    started = time.time()
+    if streaming:
+        if not make_streamed_7z(source_dir, zipped_filename, tail + '.tar', tar_args, zip_args):
+            logging.error('Target : %s streamed zip error', str(source_dir))
+            if os.path.exists(zipped_filename):
+                os.remove(zipped_filename)
+            return [None, None, None]
+        timings['compress'] = time.time() - started
+        started = time.time()
+        res = sha512_file(zipped_filename)
+    else:
+        if not make_tar(source_dir, tar_filename, tar_args):
+            logging.error('Target : %s tar error', str(source_dir))
+            return [None, None, None]
+        timings['tar'] = time.time() - started
+        started = time.time()
 
-    res = make_sha512(zipped_filename)
+        if not make_7z(tar_filename, zipped_filename, zip_args):
+            logging.error('Target : %s zip error', str(tar_filename))
+            return [None, None, None]
+        timings['compress'] = time.time() - started
+        started = time.time()
+
+        res = make_sha512(zipped_filename)
+        os.remove(tar_filename)
+    timings['hash'] = time.time() - started
 
     if not res is None:
         with io.open(sha_filename, 'w', encoding='utf8') as sha_file:
             sha_file.write(' '.join(res).decode('utf8'))
         res[0] = sha_filename
 
-    os.remove(tar_filename)
-
     return res
 
+def make_volumes(source_dir, temp_dir, name_suffix, volume_lists, streaming=False, zip_args=None, workers=2,
+                 name=None):
+    """
+    Archive each list of paths (relative to '/') into independent volume <name>.vNNN.tar.7z,
+    volumes are made in parallel and a failed one is made once again.
+    Returns [hash file, archive file] like make_archived_file: hash file has line '<hash> <volume>'
+    for each volume, archive file itself does not exist. [None, None, None] on error.
+    """
+    head, tail = os.path.split(source_dir)
+    if not name is None:
+        tail = name
+    tail += name_suffix
+    sha_filename = os.path.join(temp_dir, tail + '.sha512')
+    zipped_filename = os.path.join(temp_dir, tail + '.tar.7z')
+
+    def make_volume(number):
+        volume_suffix = name_suffix + VOLUME_TEMPLATE % (number + 1)
+        list_file = os.path.join(temp_dir, tail + VOLUME_TEMPLATE % (number + 1) + '.lst')
+        with io.open(list_file, 'wb') as paths:
+            for path in volume_lists[number]:
+                paths.write(path.encode('utf8') + b'\0')
+        tar_args = ['--no-recursion', '-C', os.sep, '--null', '-T', str(list_file)]
+        try:
+            for attempt in range(2):
+                res = make_archived_file(source_dir, temp_dir, volume_suffix, streaming, tar_args, zip_args,
+                                         name=name)
+                if res is not None and res[0] is not None:
+                    return res
+                logging.warning('Volume %s of %s failed, attempt %s.',
+                                str(number + 1), str(source_dir), str(attempt + 1))
+            return None
+        finally:
+            os.remove(list_file)
+
+    pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+        results = pool.map(make_volume, range(len(volume_lists)))
+    finally:
+        pool.close()
+    lines = []
+    for res in results:
+        if res is None:
+            continue
+        with io.open(res[0], 'r', encoding='utf8') as volume_sha:
+            volume_hash = volume_sha.read().split()[0]
+        os.remove(res[0])
+        lines.append(u' '.join([volume_hash, os.path.basename(res[1])]))
+    if len(lines) != len(volume_lists):
+        logging.error('Target : %s volumes error', str(source_dir))
+        for res in results:
+            if res is not None and os.path.exists(res[1]):
+                os.remove(res[1])
+        return [None, None, None]
+    with io.open(sha_filename, 'w', encoding='utf8') as sha_file:
+        sha_file.write(u'\n'.join(lines) + u'\n')
+    return [sha_filename, zipped_filename]
+
+
+def index_file_name(zipped_filename):
+    """
+    Member index is kept beside archive: <name>.tar.7z -> <name>.idx.json
+    """
+    if zipped_filename.endswith('.tar.7z'):
+        zipped_filename = zipped_filename[:-len('.tar.7z')]
+    return zipped_filename + INDEX_SUFFIX
+
+
+def read_volumes(sha_filename):
+    """
+    [(hash, volume file)] from hash file of volumed archive, empty list for single archive
+    """
+    with io.open(sha_filename, 'r', encoding='utf8') as sha_file:
+        lines = [l.split() for l in sha_file.readlines() if len(l.split()) == 2]
+    if len(lines) < 2:
+        return []
+    temp_dir = os.path.dirname(sha_filename)
+    return [(h, os.path.join(temp_dir, os.path.basename(n))) for h, n in lines]
+
+
 def mount_nfs_folder(path_to_mount):
     command = ['mount', str(path_to_mount)]
     try:
@@ -73,15 +233,6 @@ def umount_nfs_folder(path_to_umount):
                       str(cpe.output))
         return False
 
-def copy_with_cleanup(src, dest_path):
-    try:
-        _, tail = os.path.split(src)
-        shutil.copyfile(src, os.path.join(dest_path, tail))
-    except:
-        logging.error('Copy %s error occure.', str(src))
-    finally:
-        os.remove(src)
-
 def try_execute_command(cmd):
     try:
         res = subprocess.check_output(cmd)
@@ -2,12 +2,25 @@
 from __future__ import print_function
 import sys
 import os
+import re
 import time
+import fcntl
 import io
 import logging
-import subprocess
-import json
 import ConfigParser
+import chunkstore
+import hashtool
+import catalog
+
+INCREMENTAL_SUFFIX = u'.inc.tar.7z'
+INCOMING_DIR_NAME = u'incoming'
+READY_SUFFIX = u'.ready'
+DONE_MARKER = u'run.done'
+LOCK_FILE_NAME = u'.lock'
+INDEX_SUFFIX = u'.idx.json'
+METRICS_SUFFIX = u'.metrics.jsonl'
+VOLUME_PATTERN = re.compile(u'\\.v\\d{3,}\\.tar\\.7z$')
+LIST_SEPARATOR = u'\t'
 
 
 def write_fatal_startup(message):
@@ -28,34 +41,256 @@ def remove_fatal_startup():
         os.remove(fatal_error_filename)
 
 
-def make_sha512(archived_file):
-    command = ['sha512sum', str(archived_file)]
+def split_chains(archive_list):
+    """
+    Split versions (oldest first) into chains: full archive and incremental ones made after it.
+    Incremental archive without full one before it starts its own chain.
+    """
+    chains = []
+    for archive in archive_list:
+        if archive.endswith(INCREMENTAL_SUFFIX) and len(chains) > 0:
+            chains[-1].append(archive)
+        else:
+            chains.append([archive])
+    return chains
+
+
+def hash_file_name(archive_file_name):
+    for suffix in (u'.tar.7z', chunkstore.MANIFEST_SUFFIX):
+        if archive_file_name.endswith(suffix):
+            return archive_file_name[:-len(suffix)] + u'.sha512'
+    return archive_file_name + u'.sha512'
+
+
+def index_file_name(archive_file_name):
+    if archive_file_name.endswith(u'.tar.7z'):
+        return archive_file_name[:-len(u'.tar.7z')] + INDEX_SUFFIX
+    return archive_file_name + INDEX_SUFFIX
+
+
+def list_entry(line):
+    """
+    (archive name, target) of archive list entry '<archive name>\t<target>'. Entry of older client
+    has archive name only, its target is taken as the name up to the first '-'.
+    """
+    name, _, target = line.strip().partition(LIST_SEPARATOR)
+    if len(target) == 0:
+        target = name[:name.index(u'-')]
+    return name, target
+
+
+def is_volume(file_name):
+    return VOLUME_PATTERN.search(file_name) is not None
+
+
+def archive_files(archive_file_name):
+    """
+    Files of archive with their hashes from hash file: [(archive file, hash)] or, for archive split
+    into volumes, [(volume file, hash)] for each '<hash> <volume>' line. Hash is None if not known.
+    """
+    root_path, name = os.path.split(archive_file_name)
+    entries = []
+    checksum_file_name = hash_file_name(archive_file_name)
+    if os.path.exists(checksum_file_name):
+        with io.open(checksum_file_name, 'r', encoding='utf8') as file_:
+            entries = [l.split() for l in file_.readlines() if len(l.split()) > 0]
+    volumes = [(os.path.join(root_path, os.path.basename(e[1])), e[0]) for e in entries
+               if len(e) > 1 and is_volume(e[1])]
+    if len(volumes) > 0:
+        return volumes
+    return [(archive_file_name, entries[0][0] if len(entries) > 0 else None)]
+
+
+def remove_archive(archive_file_name, chunk_index=None):
     try:
-        res = subprocess.check_output(command)
-        return res.rstrip().split()
-    except subprocess.CalledProcessError as cpe:
-        logging.error('Target : %s hash calculation error. Cmd: %s, %s',
-                      str(archived_file), str(cpe.cmd), str(cpe.output))
-        return None
+        if chunk_index is not None and archive_file_name.endswith(chunkstore.MANIFEST_SUFFIX):
+            chunk_index.release_version(archive_file_name)
+        for file_name, _ in archive_files(archive_file_name):
+            os.remove(file_name)
+        if os.path.exists(index_file_name(archive_file_name)):
+            os.remove(index_file_name(archive_file_name))
+        hash_file_name_ = hash_file_name(archive_file_name)
+        os.remove(hash_file_name_)
+        logging.info('Deleted files: %s and %s.',
+                     str(archive_file_name),
+                     str(hash_file_name_))
+    except OSError:
+        logging.error('Error while delete file: %s or its hash',
+                      str(archive_file_name))
+
+
+def verify_archives(income_backup_list, root_path, chunk_index, hash_workers, source_name=u'backup.lst',
+                    hash_seconds=None):
+    """
+    Check hashes of newly copied archives, broken ones are removed.
+    Volumes of all archives are checked independently in the same worker pool.
+    Returns {target: [archive file, hash file, archive hash]} of verified archives,
+    archive split into volumes is identified by hash of its hash file.
+    """
+    in_metadata_dict = {}
+    in_files_dict = {}
+    for el in income_backup_list:
+        archive_name, target = list_entry(el)
+        zip_file_name = os.path.join(root_path, archive_name)
+        checksum_file_name = hash_file_name(zip_file_name)
+        in_metadata_dict[target] = [zip_file_name, checksum_file_name]
+        in_files_dict[target] = archive_files(zip_file_name)
 
+    logging.info('Start to check archive hashes with %s workers.',
+                 str(hash_workers))
 
-def save_dict_to_json(file_name, metadata):
-    with io.open(file_name, 'w', encoding='utf8') as json_file:
-        json_string = json.dumps(metadata, ensure_ascii=False)
-        json_file.write(json_string.decode('utf8'))
+    for el in in_metadata_dict.keys():
+        missing = [f for f, _ in in_files_dict[el] if not os.path.exists(f)]
+        if len(missing) > 0:
+            logging.error('Archive file: %s found in %s, but not found in %s',
+                          str(missing[0]),
+                          str(source_name),
+                          str(root_path))
+            in_metadata_dict.pop(el)
 
+    archive_hashes = hashtool.hash_files([f for el in in_metadata_dict.keys() for f, _ in in_files_dict[el]],
+                                         hash_workers, hash_seconds)
 
-def main(config_file):
-    if config_file is None or not os.path.exists(config_file):
-        print('Config file not found. Exiting.')
-        quit(-1)
+    for el in in_metadata_dict.keys():
+        # hash check of each file (volume)
+        broken = False
+        unknown = False
+        for file_name, stored_hash_str in in_files_dict[el]:
+            if archive_hashes[file_name] is None:
+                logging.error('Can not get sha-512 for %s.',
+                              str(file_name))
+                unknown = True
+            elif stored_hash_str is None or len(stored_hash_str) == 0:
+                logging.error('Can not read stored sha-512 for %s from %s.',
+                              str(file_name),
+                              str(in_metadata_dict[el][1]))
+                unknown = True
+            elif archive_hashes[file_name] != stored_hash_str:
+                logging.error('Checksum verification FAILED for %s.',
+                              str(file_name))
+                broken = True
+
+        if broken:
+            logging.error('Archive %s removed.', str(in_metadata_dict[el][0]))
+            remove_archive(in_metadata_dict[el][0])
+            in_metadata_dict.pop(el)
+            continue
+        if unknown:
+            in_metadata_dict.pop(el)
+            continue
 
-    cfg_parser = ConfigParser.SafeConfigParser()
-    cfg_parser.read(config_file)
+        # chunked version is stored only when all its new chunks are intact
+        if in_metadata_dict[el][0].endswith(chunkstore.MANIFEST_SUFFIX) and \
+                not chunk_index.add_version(in_metadata_dict[el][0]):
+            logging.error('Chunk verification FAILED for %s. Version removed.',
+                          str(in_metadata_dict[el][0]))
+            remove_archive(in_metadata_dict[el][0])
+            in_metadata_dict.pop(el)
+            continue
 
+        if len(in_files_dict[el]) > 1:
+            archive_hash = hashtool.sha512_file(in_metadata_dict[el][1])[0]
+        else:
+            archive_hash = archive_hashes[in_files_dict[el][0][0]]
+        in_metadata_dict[el].append(archive_hash)
+        logging.info('Checksum for %s verified successfully.',
+                     str(in_metadata_dict[el][0]))
+
+    logging.info('Archive checksum verification finished.')
+    return in_metadata_dict
+
+
+def update_catalog(in_metadata_dict, archive_catalog, chunk_index, archive_list_depth, metrics=None):
+    # merge archive catalog and newly added, only targets of this run are checked
+    for target in in_metadata_dict.keys():
+        started = time.time()
+        removed = 0
+        zip_file_name, _, archive_hash = in_metadata_dict[target]
+        archive_catalog.adopt_versions(target)
+        archive_catalog.add_version(target, os.path.basename(zip_file_name), archive_hash,
+                                    files=[os.path.basename(f) for f, _ in archive_files(zip_file_name)])
+        # incremental archives need all previous ones of their chain, so whole chains are removed
+        chains = split_chains(archive_catalog.versions(target))
+        while len(chains) > archive_list_depth:
+            logging.info('For item: %s found more than %s archived versions. Remove the oldest one: %s.',
+                         target.encode('utf8'), str(archive_list_depth),
+                         str(archive_catalog.path(chains[0][0])))
+            for archive in chains[0]:
+                remove_archive(archive_catalog.path(archive), chunk_index)
+            archive_catalog.remove_versions(chains[0])
+            removed += len(chains[0])
+            chains.pop(0)
+        if metrics is not None:
+            # files of retention phase are removed archives
+            metrics.record(target, u'retention', time.time() - started, files=removed)
+
+
+def process_archives(income_backup_list, root_path, chunk_index, archive_catalog, hash_workers,
+                     archive_list_depth, source_name=u'backup.lst', metrics=None):
+    # archives of a batch are hashed together in one worker pool, verify time of archive is hash time of its files
+    files = {}
+    for el in income_backup_list:
+        archive_name, target = list_entry(el)
+        files[target] = [f for f, _ in archive_files(os.path.join(root_path, archive_name))]
+    sizes = dict((t, sum(os.path.getsize(f) for f in files[t] if os.path.exists(f))) for t in files.keys())
+    hash_seconds = {}
+    in_metadata_dict = verify_archives(income_backup_list, root_path, chunk_index, hash_workers, source_name,
+                                       hash_seconds)
+    if metrics is not None:
+        for target in files.keys():
+            metrics.record(target, u'verify', sum(hash_seconds.get(f, 0.0) for f in files[target]),
+                           sizes[target], len(files[target]))
+    update_catalog(in_metadata_dict, archive_catalog, chunk_index, archive_list_depth, metrics)
+    chunk_index.save()
+
+
+def watch_incoming(incoming_path, poll_seconds, idle_timeout, process):
+    """
+    Process archives as client publishes them: each archive has marker <name>.ready in incoming dir,
+    which holds its list entry. Markers are taken in order of publishing, at most one archive of a target per batch.
+    Finishes when client wrote run.done marker and nothing is left, or after idle_timeout seconds.
+    """
+    logging.info('Watch %s for published archives.', str(incoming_path))
+    last_activity = time.time()
+    done_file = os.path.join(incoming_path, DONE_MARKER)
+    while True:
+        # done marker is checked first, it is written only after all ready markers of the run
+        client_done = os.path.exists(done_file)
+        markers = [m for m in os.listdir(incoming_path) if m.endswith(READY_SUFFIX)]
+        markers.sort(key=lambda m: (os.path.getmtime(os.path.join(incoming_path, m)), m))
+        batch = []
+        targets = set()
+        for marker in markers:
+            with io.open(os.path.join(incoming_path, marker), 'r', encoding='utf8') as marker_file:
+                entry = marker_file.read().strip()
+            if len(entry) == 0:
+                entry = marker[:-len(READY_SUFFIX)]
+            target = list_entry(entry)[1]
+            if target not in targets:
+                targets.add(target)
+                batch.append((marker, entry))
+        if len(batch) > 0:
+            logging.info('Found %s published archive(s).', str(len(batch)))
+            process([entry for _, entry in batch])
+            for marker, _ in batch:
+                os.remove(os.path.join(incoming_path, marker))
+            last_activity = time.time()
+            continue
+        if client_done:
+            os.remove(done_file)
+            logging.info('Client run finished.')
+            return
+        if time.time() - last_activity > idle_timeout:
+            logging.warning('No archives published for %s seconds, stop watching.', str(idle_timeout))
+            return
+        time.sleep(poll_seconds)
+
+
+def init_log(cfg_parser, log_file_name_template=None):
     if cfg_parser.has_section('log'):
         log_path = cfg_parser.get('log', 'path').decode('utf8')
-        log_file_name_template = cfg_parser.get('log', 'file_name_template')
+        if log_file_name_template is None:
+            log_file_name_template = cfg_parser.get('log', 'file_name_template')
         filename_timestamp = cfg_parser.get('log', 'name_time_format')
 
         current_log = time.strftime(filename_timestamp, time.localtime()) + '.log'
@@ -74,156 +309,157 @@ def main(config_file):
         print('Invalid config file. Exiting.')
         quit(-1)
 
+
+def init_metrics(cfg_parser, log_file_name_template=None):
+    """
+    Run metrics beside the log file (or in [metrics] path), None if not enabled
+    """
+    if not cfg_parser.has_section('metrics') or not cfg_parser.getboolean('metrics', 'enabled'):
+        return None
+    metrics_path = cfg_parser.get('log', 'path').decode('utf8')
+    if cfg_parser.has_option('metrics', 'path'):
+        metrics_path = cfg_parser.get('metrics', 'path').decode('utf8')
+    history_file = None
+    if cfg_parser.has_option('metrics', 'history_file'):
+        history_file = os.path.join(metrics_path, cfg_parser.get('metrics', 'history_file').decode('utf8'))
+    if log_file_name_template is None:
+        log_file_name_template = cfg_parser.get('log', 'file_name_template')
+    run_file = log_file_name_template + time.strftime(cfg_parser.get('log', 'name_time_format'), time.localtime())
+    # server scripts do not need metrics module when metrics are off
+    import metrictool
+    return metrictool.RunMetrics(os.path.join(metrics_path, run_file.decode('utf8') + METRICS_SUFFIX),
+                                 history_file, u'server')
+
+
+def main(config_file):
+    if config_file is None or not os.path.exists(config_file):
+        print('Config file not found. Exiting.')
+        quit(-1)
+
+    cfg_parser = ConfigParser.SafeConfigParser()
+    cfg_parser.read(config_file)
+
+    init_log(cfg_parser)
+    metrics = init_metrics(cfg_parser)
+
     remove_fatal_startup()
 
     income_backup_filename = u''
     archive_list_depth = 3
     root_path = u''
+    chunks_dir = u'chunks'
+    chunk_orphan_days = 7
+    hash_workers = hashtool.default_workers()
+    catalog_file = catalog.CATALOG_FILE_NAME
     if cfg_parser.has_section('target'):
         income_backup_filename = cfg_parser.get('target', 'input_list_file').decode('utf8')
         archive_list_depth = int(cfg_parser.get('target', 'depth'))
         root_path = cfg_parser.get('target', 'path').decode('utf8')
+        if cfg_parser.has_option('target', 'chunks_dir'):
+            chunks_dir = cfg_parser.get('target', 'chunks_dir').decode('utf8')
+        if cfg_parser.has_option('target', 'chunk_orphan_days'):
+            chunk_orphan_days = int(cfg_parser.get('target', 'chunk_orphan_days'))
+        if cfg_parser.has_option('target', 'catalog_file'):
+            catalog_file = cfg_parser.get('target', 'catalog_file').decode('utf8')
+        if cfg_parser.has_option('target', 'hash_workers'):
+            hash_workers = int(cfg_parser.get('target', 'hash_workers'))
         income_backup_filename = os.path.join(root_path,
                                               income_backup_filename)
     else:
         logging.error('Invalid config file. Exiting.')
         quit(-1)
 
+    watch = False
+    incoming_dir = INCOMING_DIR_NAME
+    poll_seconds = 5
+    idle_timeout_minutes = 120
+    if cfg_parser.has_section('incoming'):
+        watch = cfg_parser.getboolean('incoming', 'enabled')
+        if cfg_parser.has_option('incoming', 'dir_name'):
+            incoming_dir = cfg_parser.get('incoming', 'dir_name').decode('utf8')
+        if cfg_parser.has_option('incoming', 'poll_seconds'):
+            poll_seconds = int(cfg_parser.get('incoming', 'poll_seconds'))
+        if cfg_parser.has_option('incoming', 'idle_timeout_minutes'):
+            idle_timeout_minutes = int(cfg_parser.get('incoming', 'idle_timeout_minutes'))
+
+    # client with stream_handoff publishes archives into incoming folder and writes no list
+    incoming_path = os.path.join(root_path, incoming_dir)
+    if not watch and os.path.isdir(incoming_path):
+        if not os.path.exists(income_backup_filename):
+            logging.warning('%s not found, but %s exists: watch it for published archives.',
+                            str(income_backup_filename), str(incoming_path))
+            watch = True
+        elif any(m.endswith(READY_SUFFIX) for m in os.listdir(incoming_path)):
+            logging.error('Archives published in %s are not checked: set [incoming] enabled = yes.',
+                          str(incoming_path))
+
     logging.info('Start archive update with depth %s.',
                  str(archive_list_depth))
 
-    logging.info('Read newly added files from %s.',
-                 str(income_backup_filename))
-
     income_backup_list = []
-    with io.open(income_backup_filename, 'r', encoding='utf8') as inc_f:
-        income_backup_list = inc_f.readlines()
-
-    if income_backup_list is None or len(income_backup_list) == 0:
-        logging.info('No new backup files found. Finished.')
-        logging.shutdown()
-        quit(0)
-
-    income_backup_list = [f.rstrip() for f in income_backup_list]
-    logging.info('Found %s new backup file(s)', str(len(income_backup_list)))
-
-    in_metadata_dict = {}
-    for el in income_backup_list:
-        basic_name = el
-        basic_name = basic_name[:basic_name.index(u'-')]
-        zip_file_name = os.path.join(root_path, el)
-        checksum_file_name = zip_file_name.replace(u'.tar.7z', u'.sha512')
-        in_metadata_dict[basic_name] = [zip_file_name, checksum_file_name]
-
-    logging.info('Start to check archive hashes.')
-
-    for el in in_metadata_dict.keys():
-        if not os.path.exists(in_metadata_dict[el][0]):
-            logging.error('Archive file: %s found in %s, but not found in %s',
-                          str(in_metadata_dict[el][0]),
-                          str(u'backup.lst'),
-                          str(root_path))
-            in_metadata_dict.pop(el)
-            continue
-
-        # hash check
-        archive_hash = make_sha512(in_metadata_dict[el][0])
-
-        if archive_hash is None:
-            logging.error('Can not get sha-512 for %s.',
-                          str(in_metadata_dict[el][0]))
-
-        archive_hash = archive_hash[0]
-
-        with io.open(in_metadata_dict[el][1], 'r', encoding='utf8') as file_:
-            stored_hash_str = file_.read().decode('utf8')
-
-        if stored_hash_str is None or len(stored_hash_str) == 0:
-            logging.error('Can not read stored sha-512 for %s from %s.',
-                          str(in_metadata_dict[el][0]),
-                          str(in_metadata_dict[el][1]))
-            in_metadata_dict.pop(el)
-            continue
-
-        stored_hash_str = stored_hash_str.split()[0]
-        if stored_hash_str is None or len(stored_hash_str) == 0:
-            logging.error('Can not read stored sha-512 for %s from %s.',
-                          str(in_metadata_dict[el][0]),
-                          str(in_metadata_dict[el][1]))
-            in_metadata_dict.pop(el)
-            continue
-
-        if archive_hash != stored_hash_str:
-            logging.error('Checksum verification FAILED for %s. Archive removed.',
-                          str(in_metadata_dict[el][0]))
-            try:
-                os.remove(in_metadata_dict[el][0])
-                os.remove(in_metadata_dict[el][1])
-            except OSError:
-                logging.error('Failed archive removed for: %s and %s',
-                              str(in_metadata_dict[el][0]),
-                              str(in_metadata_dict[el][1]))
-            in_metadata_dict.pop(el)
-            continue
-
-        logging.info('Checksum for %s verified successfully.',
-                     str(in_metadata_dict[el][0]))
-
-    logging.info('Archive checksum verification finished.')
-
-    stored_archive_list_filename = u'stored_archives.json'
-    stored_archive_list_filename = os.path.join(root_path,
-                                                stored_archive_list_filename)
-
-    archive_dict = {}
-    if not os.path.exists(stored_archive_list_filename):
-        logging.warning('Archive list does not exist, create the empty one: %s.',
-                        stored_archive_list_filename)
-        save_dict_to_json(stored_archive_list_filename, archive_dict)
-
-    with io.open(stored_archive_list_filename, 'r', encoding='utf8') as file_:
-        json_str = file_.read()
-        archive_dict = json.loads(json_str)
-
-    logging.info('Loaded archive list.')
-
-    # merge archive list and newly added
-    for basic_name in in_metadata_dict.keys():
-        if basic_name not in archive_dict.keys():
-            archive_dict[basic_name] = []
-
-        archive_dict[basic_name].append(in_metadata_dict[basic_name][0])
-        if len(archive_dict[basic_name]) > archive_list_depth:
-            logging.info('For item: %s found more than %s archived versions. Remove the oldest one: %s.',
-                         str(basic_name), str(archive_list_depth),
-                         str(archive_dict[basic_name][0]))
-            try:
-                os.remove(archive_dict[basic_name][0])
-                hash_file_name = archive_dict[basic_name][0]
-                hash_file_name = hash_file_name.replace(u'.tar.7z', u'.sha512')
-                os.remove(hash_file_name)
-                logging.info('Deleted files: %s and %s.',
-                             str(archive_dict[basic_name][0]),
-                             str(hash_file_name))
-            except OSError:
-                logging.error('Error while delete file: %s or its hash',
-                              str(archive_dict[basic_name][0]))
-            finally:
-                archive_dict[basic_name].remove(archive_dict[basic_name][0])
-
-    logging.info('Archive list update finished.')
-
-    save_dict_to_json(stored_archive_list_filename, archive_dict)
-    logging.info('Archive list saved.')
-
-    try:
-        os.remove(income_backup_filename)
-        logging.info('Backup list deleted: %s.',
+    if not watch:
+        logging.info('Read newly added files from %s.',
                      str(income_backup_filename))
-    except OSError:
-        logging.error('Error while delete backup list: %s.',
-                      str(income_backup_filename))
 
+        with io.open(income_backup_filename, 'r', encoding='utf8') as inc_f:
+            income_backup_list = inc_f.readlines()
+
+        if income_backup_list is None or len(income_backup_list) == 0:
+            logging.info('No new backup files found. Finished.')
+            logging.shutdown()
+            quit(0)
+
+        income_backup_list = [f.rstrip() for f in income_backup_list]
+        logging.info('Found %s new backup file(s)', str(len(income_backup_list)))
+
+    chunk_index = chunkstore.ChunkIndex(os.path.join(root_path, chunks_dir))
+
+    archive_catalog = catalog.ArchiveCatalog(root_path, catalog_file)
+    json_list_filename = os.path.join(root_path, catalog.JSON_LIST_FILE_NAME)
+    if os.path.exists(json_list_filename):
+        archive_catalog.import_json_list(json_list_filename)
+
+    logging.info('Opened archive catalog %s.',
+                 str(archive_catalog.db_file))
+
+    if watch:
+        if not os.path.isdir(incoming_path):
+            os.makedirs(incoming_path)
+        # only one consumer may take markers, another started one just exits
+        lock_file = io.open(os.path.join(incoming_path, LOCK_FILE_NAME), 'w')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logging.info('Archives of %s are already watched by another process. Finished.',
+                         str(incoming_path))
+            archive_catalog.close()
+            logging.shutdown()
+            quit(0)
+        watch_incoming(incoming_path, poll_seconds, idle_timeout_minutes * 60,
+                       lambda names: process_archives(names, root_path, chunk_index, archive_catalog,
+                                                      hash_workers, archive_list_depth, incoming_dir, metrics))
+        lock_file.close()
+    else:
+        process_archives(income_backup_list, root_path, chunk_index, archive_catalog,
+                         hash_workers, archive_list_depth, metrics=metrics)
+
+    chunk_index.sweep_orphans(chunk_orphan_days)
+    chunk_index.save()
+
+    archive_catalog.close()
+    logging.info('Archive catalog update finished.')
+
+    if not watch:
+        try:
+            os.remove(income_backup_filename)
+            logging.info('Backup list deleted: %s.',
+                         str(income_backup_filename))
+        except OSError:
+            logging.error('Error while delete backup list: %s.',
+                          str(income_backup_filename))
+
+    if metrics is not None:
+        metrics.finish()
     logging.info('Archive update finished.')
     logging.shutdown()
 
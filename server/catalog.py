@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import json
+import time
+import sqlite3
+import logging
+
+CATALOG_FILE_NAME = u'catalog.db'
+JSON_LIST_FILE_NAME = u'stored_archives.json'
+
+_SCHEMA = (
+    u'CREATE TABLE IF NOT EXISTS archives ('
+    u' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+    u' target TEXT NOT NULL,'
+    u' name TEXT NOT NULL UNIQUE,'
+    u' size INTEGER,'
+    u' sha512 TEXT,'
+    u' created REAL NOT NULL,'
+    u' verified REAL)',
+    u'CREATE INDEX IF NOT EXISTS archives_target ON archives (target, id)',
+    u'CREATE INDEX IF NOT EXISTS archives_created ON archives (created)',
+)
+
+
+class ArchiveCatalog(object):
+    """
+    Archive versions stored in destination directory, one row per archive file.
+    Versions of a target are ordered by insertion (id), as they came from clients.
+    Every public method which changes rows runs in its own transaction.
+    """
+    def __init__(self, root, file_name=CATALOG_FILE_NAME):
+        self.root = root
+        self.db_file = os.path.join(root, file_name)
+        self.conn = sqlite3.connect(self.db_file)
+        with self.conn:
+            for statement in _SCHEMA:
+                self.conn.execute(statement)
+            # catalogs made before scrubbing have no mark of corrupted versions
+            columns = [r[1] for r in self.conn.execute(u'PRAGMA table_info(archives)')]
+            if u'corrupted' not in columns:
+                self.conn.execute(u'ALTER TABLE archives ADD COLUMN corrupted REAL')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def __upsert(self, target, name, size, sha512, created, verified):
+        # archive registered again (list processed twice) is still one version
+        cursor = self.conn.execute(u'UPDATE archives SET size = ?, sha512 = ?, created = ?, verified = ?, '
+                                   u'corrupted = NULL WHERE name = ?', (size, sha512, created, verified, name))
+        if cursor.rowcount == 0:
+            self.conn.execute(u'INSERT INTO archives (target, name, size, sha512, created, verified) '
+                              u'VALUES (?, ?, ?, ?, ?, ?)', (target, name, size, sha512, created, verified))
+
+    def add_version(self, target, name, sha512, verified=None, files=None):
+        """
+        Archive split into volumes is one version, its size is total size of volume files
+        """
+        if files is None:
+            files = [name]
+        if verified is None:
+            verified = time.time()
+        with self.conn:
+            self.__upsert(target, name, sum(os.path.getsize(self.path(f)) for f in files), sha512,
+                          os.path.getmtime(self.path(files[0])), verified)
+
+    def adopt_versions(self, target):
+        """
+        Versions registered before clients named their targets are keyed by archive name up to the first '-',
+        so versions of target 'my-data' were kept under 'my'. Those named '<target>-<digit>...' get the real target.
+        """
+        if u'-' not in target:
+            return
+        prefix = target + u'-'
+        rows = self.conn.execute(u'SELECT name FROM archives WHERE target = ?', (target[:target.index(u'-')],))
+        names = [r[0] for r in rows if r[0].startswith(prefix) and r[0][len(prefix):len(prefix) + 1].isdigit()]
+        if len(names) > 0:
+            with self.conn:
+                self.conn.executemany(u'UPDATE archives SET target = ? WHERE name = ?', [(target, n) for n in names])
+            logging.info('%s old versions moved to target %s.', str(len(names)), target.encode('utf8'))
+
+    def remove_versions(self, names):
+        with self.conn:
+            self.conn.executemany(u'DELETE FROM archives WHERE name = ?', [(n,) for n in names])
+
+    def versions(self, target):
+        """
+        Archive names of target, oldest first
+        """
+        rows = self.conn.execute(u'SELECT name FROM archives WHERE target = ? ORDER BY id', (target,))
+        return [r[0] for r in rows]
+
+    def latest(self, target):
+        row = self.conn.execute(u'SELECT name FROM archives WHERE target = ? ORDER BY id DESC LIMIT 1',
+                                (target,)).fetchone()
+        return None if row is None else row[0]
+
+    def older_than(self, days):
+        """
+        (target, name) of archives created more than given number of days ago
+        """
+        deadline = time.time() - days * 24 * 3600
+        return self.conn.execute(u'SELECT target, name FROM archives WHERE created < ? ORDER BY created',
+                                 (deadline,)).fetchall()
+
+    def scrub_queue(self, days):
+        """
+        (target, name, sha512) of versions not verified for given number of days, the longest unchecked first
+        """
+        deadline = time.time() - days * 24 * 3600
+        return self.conn.execute(u'SELECT target, name, sha512 FROM archives '
+                                 u'WHERE verified IS NULL OR verified < ? '
+                                 u'ORDER BY verified IS NOT NULL, verified', (deadline,)).fetchall()
+
+    def mark_verified(self, name):
+        with self.conn:
+            self.conn.execute(u'UPDATE archives SET verified = ?, corrupted = NULL WHERE name = ?',
+                              (time.time(), name))
+
+    def mark_corrupted(self, name):
+        # verification time moves too, so scrubbing goes on with other versions
+        with self.conn:
+            self.conn.execute(u'UPDATE archives SET verified = ?, corrupted = ? WHERE name = ?',
+                              (time.time(), time.time(), name))
+
+    def corrupted(self):
+        return self.conn.execute(u'SELECT target, name, corrupted FROM archives WHERE corrupted IS NOT NULL '
+                                 u'ORDER BY target, id').fetchall()
+
+    def total_bytes(self):
+        return dict(self.conn.execute(u'SELECT target, SUM(size) FROM archives GROUP BY target'))
+
+    def import_json_list(self, json_file):
+        """
+        Move archive lists of stored_archives.json into catalog, json file is renamed after import
+        """
+        with io.open(json_file, 'r', encoding='utf8') as source_file:
+            archive_dict = json.loads(source_file.read())
+        imported = 0
+        with self.conn:
+            for target, archive_list in archive_dict.items():
+                for archive_file in archive_list:
+                    name = os.path.basename(archive_file)
+                    if not os.path.exists(self.path(name)):
+                        logging.warning('Archive %s from %s not found, skipped.', str(name), str(json_file))
+                        continue
+                    # hash is not known for old entries, it is set by next verification
+                    self.__upsert(target, name, os.path.getsize(self.path(name)), None,
+                                  os.path.getmtime(self.path(name)), None)
+                    imported += 1
+        os.rename(json_file, json_file + u'.migrated')
+        logging.info('Imported %s archives from %s.', str(imported), str(json_file))
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import json
+import zlib
+import time
+import hashlib
+import logging
+
+INDEX_FILE_NAME = u'index.json'
+MANIFEST_SUFFIX = u'.chunks.json'
+
+
+def load_manifest(manifest_file):
+    with io.open(manifest_file, 'r', encoding='utf8') as source_file:
+        return json.loads(source_file.read())
+
+
+class ChunkIndex(object):
+    """
+    Reference counts of chunks in content-addressed store, kept in <root>/index.json.
+    Chunk is zlib-compressed file <root>/<id[:2]>/<id>, id is sha-256 of raw chunk.
+    Each stored version (manifest) holds one reference to each of its distinct chunks.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.refs = {}
+        self.index_file = os.path.join(root, INDEX_FILE_NAME)
+        if os.path.exists(self.index_file):
+            with io.open(self.index_file, 'r', encoding='utf8') as source_file:
+                self.refs = json.loads(source_file.read())
+
+    def chunk_path(self, chunk_id):
+        return os.path.join(self.root, chunk_id[:2], chunk_id)
+
+    def verify_chunk(self, chunk_id):
+        try:
+            with io.open(self.chunk_path(chunk_id), 'rb') as chunk_file:
+                data = zlib.decompress(chunk_file.read())
+        except (IOError, OSError, zlib.error) as err:
+            logging.error('Chunk %s can not be read: %s', str(chunk_id), str(err))
+            return False
+        return hashlib.sha256(data).hexdigest() == chunk_id
+
+    def add_version(self, manifest_file):
+        """
+        Verify chunks not stored before and take references to all chunks of version.
+        Nothing changes if any chunk is missing or broken.
+        """
+        chunk_ids = set(c[0] for c in load_manifest(manifest_file)[u'chunks'])
+        new_ids = [c for c in chunk_ids if c not in self.refs]
+        broken = [c for c in new_ids if not self.verify_chunk(c)]
+        if len(broken) > 0:
+            logging.error('Version %s has %s broken chunks.', str(manifest_file), str(len(broken)))
+            for chunk_id in broken:
+                self.__remove_chunk(chunk_id)
+            return False
+        for chunk_id in chunk_ids:
+            self.refs[chunk_id] = self.refs.get(chunk_id, 0) + 1
+        logging.info('Version %s stored: %s chunks, %s new.',
+                     str(manifest_file), str(len(chunk_ids)), str(len(new_ids)))
+        return True
+
+    def release_version(self, manifest_file):
+        """
+        Drop references of removed version, chunks without references are deleted
+        """
+        chunk_ids = set(c[0] for c in load_manifest(manifest_file)[u'chunks'])
+        removed = 0
+        for chunk_id in chunk_ids:
+            count = self.refs.get(chunk_id, 0) - 1
+            if count > 0:
+                self.refs[chunk_id] = count
+                continue
+            self.refs.pop(chunk_id, None)
+            self.__remove_chunk(chunk_id)
+            removed += 1
+        logging.info('Version %s released, %s chunks deleted.', str(manifest_file), str(removed))
+
+    def sweep_orphans(self, max_age_days):
+        """
+        Delete chunks which no version references (i.e. left by client run which
+        did not deliver its manifest) and which are older than max_age_days
+        """
+        if not os.path.isdir(self.root):
+            return
+        deadline = time.time() - max_age_days * 24 * 3600
+        removed = 0
+        for sub_dir in os.listdir(self.root):
+            sub_path = os.path.join(self.root, sub_dir)
+            if not os.path.isdir(sub_path):
+                continue
+            for chunk_id in os.listdir(sub_path):
+                if chunk_id in self.refs:
+                    continue
+                chunk_file = os.path.join(sub_path, chunk_id)
+                if os.path.getmtime(chunk_file) < deadline:
+                    os.remove(chunk_file)
+                    removed += 1
+        if removed > 0:
+            logging.info('Removed %s orphan chunks.', str(removed))
+
+    def __remove_chunk(self, chunk_id):
+        try:
+            os.remove(self.chunk_path(chunk_id))
+        except OSError:
+            logging.error('Error while delete chunk: %s', str(chunk_id))
+
+    def save(self):
+        if not os.path.isdir(self.root):
+            if len(self.refs) == 0:
+                return
+            os.makedirs(self.root)
+        temp_file = self.index_file + u'.tmp'
+        with io.open(temp_file, 'w', encoding='utf8') as json_file:
+            json_string = json.dumps(self.refs, ensure_ascii=False)
+            if isinstance(json_string, bytes):
+                json_string = json_string.decode('utf8')
+            json_file.write(json_string)
+        os.rename(temp_file, self.index_file)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import io
+import time
+import hashlib
+import ctypes
+import ctypes.util
+import logging
+import multiprocessing
+import multiprocessing.pool
+
+READ_SIZE = 4 * 1024 * 1024
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+try:
+    _posix_fadvise = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).posix_fadvise
+    _posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+except (OSError, AttributeError):
+    _posix_fadvise = None
+
+
+def _fadvise(fd, advice):
+    # only a hint for kernel read-ahead and page cache, errors do not matter
+    if _posix_fadvise is not None:
+        _posix_fadvise(fd, 0, 0, advice)
+
+
+class Throttle(object):
+    """
+    Limit of read bandwidth: consume() sleeps while more than mb_per_sec was read
+    """
+    def __init__(self, mb_per_sec):
+        self.bytes_per_sec = mb_per_sec * 1024.0 * 1024.0
+        self.started = time.time()
+        self.consumed = 0
+
+    def consume(self, size):
+        self.consumed += size
+        ahead = self.consumed / self.bytes_per_sec - (time.time() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def sha512_file(file_name, read_size=READ_SIZE, throttle=None):
+    """
+    SHA-512 of file read with one reused buffer, returns [hex digest, file name] or None on error
+    """
+    sha_obj = hashlib.sha512()
+    buf = bytearray(read_size)
+    view = memoryview(buf)
+    try:
+        with io.open(file_name, 'rb', buffering=0) as source_file:
+            _fadvise(source_file.fileno(), POSIX_FADV_SEQUENTIAL)
+            while True:
+                size = source_file.readinto(buf)
+                if not size:
+                    break
+                sha_obj.update(view[:size])
+                if throttle is not None:
+                    throttle.consume(size)
+            # archive is read once, do not push other data out of page cache
+            _fadvise(source_file.fileno(), POSIX_FADV_DONTNEED)
+    except (IOError, OSError) as err:
+        logging.error('Target : %s hash calculation error: %s', str(file_name), str(err))
+        return None
+    return [sha_obj.hexdigest().decode('utf8'), file_name]
+
+
+def default_workers():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def hash_files(file_names, workers=None, seconds=None):
+    """
+    Hash files in thread pool (hashlib releases GIL while hashing), returns {file name: hex digest or None}.
+    Time spent on each file is put into seconds dict, if given.
+    """
+    if workers is None:
+        workers = default_workers()
+    file_names = list(file_names)
+
+    def timed_hash(file_name):
+        started = time.time()
+        return sha512_file(file_name), time.time() - started
+
+    if workers <= 1 or len(file_names) <= 1:
+        results = [timed_hash(f) for f in file_names]
+    else:
+        pool = multiprocessing.pool.ThreadPool(min(workers, len(file_names)))
+        try:
+            results = pool.map(timed_hash, file_names, 1)
+        finally:
+            pool.close()
+            pool.join()
+    if seconds is not None:
+        seconds.update((f, res[1]) for f, res in zip(file_names, results))
+    return dict((f, None if res[0] is None else res[0][0]) for f, res in zip(file_names, results))
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import sys
+import os
+import io
+import time
+import fcntl
+import logging
+import ConfigParser
+import backup_tool
+import catalog
+import chunkstore
+import hashtool
+
+QUEUE_DIR_NAME = u'queue'
+WORK_DIR_NAME = u'work'
+FAILED_DIR_NAME = u'failed'
+JOB_SUFFIX = u'.lst'
+LOCK_FILE_NAME = u'.lock'
+SWEEP_INTERVAL = 24 * 3600
+
+
+class IngestQueue(object):
+    """
+    Persistent queue of client manifests (lists of copied archives) in queue folder of destination.
+    Client writes <client>-<time>.lst under temporary name and renames it into place, so only complete
+    manifests are seen and clients never overwrite each other. Taken job is moved into work folder
+    and removed when processed; jobs left there by stopped daemon are queued again on start.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.work_path = os.path.join(path, WORK_DIR_NAME)
+        self.failed_path = os.path.join(path, FAILED_DIR_NAME)
+        for folder in (self.path, self.work_path, self.failed_path):
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+    def lock(self):
+        """
+        Only one daemon takes jobs of the queue, returns open lock file or None if queue is served already
+        """
+        lock_file = io.open(os.path.join(self.path, LOCK_FILE_NAME), 'w')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def recover(self):
+        for job in os.listdir(self.work_path):
+            logging.warning('Job %s was not finished, queued again.', job.encode('utf8'))
+            os.rename(os.path.join(self.work_path, job), os.path.join(self.path, job))
+
+    def pending(self):
+        """
+        [(job, archive list entries)] in order of submission
+        """
+        jobs = [j for j in os.listdir(self.path) if j.endswith(JOB_SUFFIX)]
+        jobs.sort(key=lambda j: (os.path.getmtime(os.path.join(self.path, j)), j))
+        res = []
+        for job in jobs:
+            with io.open(os.path.join(self.path, job), 'r', encoding='utf8') as job_file:
+                archives = [l.strip() for l in job_file.readlines() if len(l.strip()) > 0]
+            for archive in [a for a in archives if u'-' not in a.split(backup_tool.LIST_SEPARATOR)[0]]:
+                logging.error('Invalid archive name %s in %s, skipped.', archive.encode('utf8'), job.encode('utf8'))
+                archives.remove(archive)
+            res.append((job, archives))
+        return res
+
+    def take(self, job):
+        os.rename(os.path.join(self.path, job), os.path.join(self.work_path, job))
+
+    def done(self, job):
+        os.remove(os.path.join(self.work_path, job))
+
+    def fail(self, job):
+        os.rename(os.path.join(self.work_path, job), os.path.join(self.failed_path, job))
+
+
+def next_batch(pending):
+    """
+    Jobs of all clients verified together: archives of a target must be checked in order of submission,
+    so job with target already in batch (or in earlier job left out) waits for the next batch.
+    """
+    batch = []
+    names = set()
+    blocked = set()
+    for job, archives in pending:
+        job_names = set(backup_tool.list_entry(a)[1] for a in archives)
+        if len(job_names & (names | blocked)) == 0:
+            batch.append((job, archives))
+            names |= job_names
+        else:
+            blocked |= job_names
+    return batch
+
+
+def serve(cfg_parser, queue, root_path, chunk_index, archive_catalog, hash_workers, archive_list_depth,
+          poll_seconds, chunk_orphan_days, log_file_name_template):
+    last_sweep = 0
+    while True:
+        batch = next_batch(queue.pending())
+        if len(batch) == 0:
+            if time.time() - last_sweep > SWEEP_INTERVAL:
+                chunk_index.sweep_orphans(chunk_orphan_days)
+                chunk_index.save()
+                last_sweep = time.time()
+            time.sleep(poll_seconds)
+            continue
+
+        archives = []
+        for job, job_archives in batch:
+            queue.take(job)
+            archives += job_archives
+        jobs = u', '.join(job for job, _ in batch)
+        logging.info('Ingest %s archive(s) of %s: %s', str(len(archives)), jobs.encode('utf8'),
+                     u', '.join(archives).encode('utf8'))
+        metrics = backup_tool.init_metrics(cfg_parser, log_file_name_template)
+        try:
+            # archives of all clients in batch are hashed by one pool of hash_workers
+            backup_tool.process_archives(archives, root_path, chunk_index, archive_catalog, hash_workers,
+                                         archive_list_depth, jobs, metrics)
+        except Exception:
+            logging.exception('Jobs %s failed.', jobs.encode('utf8'))
+            for job, _ in batch:
+                queue.fail(job)
+            continue
+        for job, _ in batch:
+            queue.done(job)
+        if metrics is not None:
+            metrics.finish()
+
+
+def main(config_file):
+    if config_file is None or not os.path.exists(config_file):
+        print('Config file not found. Exiting.')
+        quit(-1)
+
+    cfg_parser = ConfigParser.SafeConfigParser()
+    cfg_parser.read(config_file)
+
+    queue_dir = QUEUE_DIR_NAME
+    poll_seconds = 10
+    log_file_name_template = 'ingest-'
+    if cfg_parser.has_section('ingest'):
+        if cfg_parser.has_option('ingest', 'queue_dir_name'):
+            queue_dir = cfg_parser.get('ingest', 'queue_dir_name').decode('utf8')
+        if cfg_parser.has_option('ingest', 'poll_seconds'):
+            poll_seconds = cfg_parser.getint('ingest', 'poll_seconds')
+        if cfg_parser.has_option('ingest', 'file_name_template'):
+            log_file_name_template = cfg_parser.get('ingest', 'file_name_template')
+    backup_tool.init_log(cfg_parser, log_file_name_template)
+
+    archive_list_depth = 3
+    chunks_dir = u'chunks'
+    chunk_orphan_days = 7
+    hash_workers = hashtool.default_workers()
+    catalog_file = catalog.CATALOG_FILE_NAME
+    if cfg_parser.has_section('target'):
+        root_path = cfg_parser.get('target', 'path').decode('utf8')
+        archive_list_depth = cfg_parser.getint('target', 'depth')
+        if cfg_parser.has_option('target', 'chunks_dir'):
+            chunks_dir = cfg_parser.get('target', 'chunks_dir').decode('utf8')
+        if cfg_parser.has_option('target', 'chunk_orphan_days'):
+            chunk_orphan_days = cfg_parser.getint('target', 'chunk_orphan_days')
+        if cfg_parser.has_option('target', 'catalog_file'):
+            catalog_file = cfg_parser.get('target', 'catalog_file').decode('utf8')
+        if cfg_parser.has_option('target', 'hash_workers'):
+            hash_workers = cfg_parser.getint('target', 'hash_workers')
+    else:
+        logging.error('Invalid config file. Exiting.')
+        quit(-1)
+
+    queue = IngestQueue(os.path.join(root_path, queue_dir))
+    lock_file = queue.lock()
+    if lock_file is None:
+        logging.info('Queue %s is already served by another process. Finished.', str(queue.path))
+        logging.shutdown()
+        quit(0)
+    queue.recover()
+
+    chunk_index = chunkstore.ChunkIndex(os.path.join(root_path, chunks_dir))
+    logging.info('Serve queue %s with %s hash workers.', str(queue.path), str(hash_workers))
+    with catalog.ArchiveCatalog(root_path, catalog_file) as archive_catalog:
+        serve(cfg_parser, queue, root_path, chunk_index, archive_catalog, hash_workers, archive_list_depth,
+              poll_seconds, chunk_orphan_days, log_file_name_template)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
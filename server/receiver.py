@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import sys
+import os
+import io
+import hmac
+import json
+import struct
+import hashlib
+import logging
+import threading
+import SocketServer
+import ConfigParser
+import backup_tool
+import catalog
+import chunkstore
+
+# the same framing as client streamtool: kind, stream id, payload length
+FRAME_HEADER = struct.Struct('<BIQ')
+FRAME_OPEN = 1
+FRAME_DATA = 2
+FRAME_CLOSE = 3
+FRAME_RESULT = 4
+FRAME_BYE = 5
+FRAME_CHALLENGE = 6
+FRAME_AUTH = 7
+# largest payload of each frame kind client may send, longer frame ends the connection
+MAX_PAYLOAD = {FRAME_OPEN: 4096, FRAME_DATA: 16 * 1024 * 1024, FRAME_CLOSE: 1024, FRAME_BYE: 0, FRAME_AUTH: 1024}
+NONCE_SIZE = 32
+LOOPBACK_HOSTS = ('127.0.0.1', 'localhost', '::1')
+PART_SUFFIX = u'.part'
+HASH_SUFFIX = u'.sha512'
+
+
+def _read_exact(read, size):
+    chunks = []
+    while size > 0:
+        data = read(size)
+        if not data:
+            raise EOFError('Connection closed')
+        chunks.append(data)
+        size -= len(data)
+    return b''.join(chunks)
+
+
+def _read_frame(read):
+    """
+    (kind, stream id, payload) of frame sent by client; payload length is checked before it is read
+    """
+    kind, stream_id, length = FRAME_HEADER.unpack(_read_exact(read, FRAME_HEADER.size))
+    if length > MAX_PAYLOAD.get(kind, -1):
+        raise ValueError('frame of kind %s with %s bytes refused' % (kind, length))
+    return kind, stream_id, _read_exact(read, length)
+
+
+def auth_digest(secret, nonce):
+    return hmac.new(secret, nonce, hashlib.sha256).hexdigest()
+
+
+class _Stream(object):
+    def __init__(self, name, target, file_name):
+        self.name = name
+        self.target = target
+        self.file_name = file_name
+        self.out_file = io.open(file_name + PART_SUFFIX, 'wb')
+        self.sha_obj = hashlib.sha512()
+
+    def write(self, data):
+        self.sha_obj.update(data)
+        self.out_file.write(data)
+
+    def discard(self):
+        self.out_file.close()
+        os.remove(self.file_name + PART_SUFFIX)
+
+
+class ArchiveReceiver(object):
+    """
+    Server side of archive streams. Each stream is written into <root>/<name>.part and hashed
+    on the way; archive with expected hash gets its .sha512 file and is added to catalog at once,
+    so no separate verification pass is needed. Stream never replaces stored file.
+    """
+    def __init__(self, root_path, archive_list_depth, chunks_dir, catalog_file):
+        self.root_path = root_path
+        self.archive_list_depth = archive_list_depth
+        self.chunks_dir = chunks_dir
+        self.catalog_file = catalog_file
+        # catalog and chunk index are changed by one connection at a time
+        self.__catalog_lock = threading.Lock()
+
+    def __valid_name(self, name):
+        if os.path.basename(name) != name or name.startswith(u'.') or u'-' not in name:
+            return False
+        file_name = os.path.join(self.root_path, name)
+        return not os.path.exists(file_name) and not os.path.exists(file_name + PART_SUFFIX)
+
+    def __add_version(self, stream, archive_file, hash_file, archive_hash):
+        with self.__catalog_lock:
+            chunk_index = chunkstore.ChunkIndex(os.path.join(self.root_path, self.chunks_dir))
+            with catalog.ArchiveCatalog(self.root_path, self.catalog_file) as archive_catalog:
+                backup_tool.update_catalog({stream.target: [archive_file, hash_file, archive_hash]},
+                                           archive_catalog, chunk_index, self.archive_list_depth)
+            chunk_index.save()
+
+    def __register(self, stream, archive_hash):
+        hash_file = backup_tool.hash_file_name(stream.file_name)
+        with io.open(hash_file, 'w', encoding='utf8') as sha_file:
+            sha_file.write(u' '.join([archive_hash, stream.name]))
+        self.__add_version(stream, stream.file_name, hash_file, archive_hash)
+
+    def __register_volumes(self, stream, archive_hash):
+        # hash file of archive split into volumes comes after all its volumes, each verified on arrival
+        archive_file = stream.file_name[:-len(HASH_SUFFIX)] + u'.tar.7z'
+        files = backup_tool.archive_files(archive_file)
+        missing = [f for f, _ in files if not os.path.exists(f)]
+        if len(missing) > 0:
+            logging.error('Volume %s of %s not received. Archive removed.', str(missing[0]), str(archive_file))
+            for file_name, _ in files:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+            os.remove(stream.file_name)
+            return False
+        self.__add_version(stream, archive_file, stream.file_name, archive_hash)
+        return True
+
+    def __finish(self, stream, expected_hash):
+        archive_hash = stream.sha_obj.hexdigest().decode('utf8')
+        if archive_hash != expected_hash:
+            logging.error('Checksum verification FAILED for %s. Archive removed.', str(stream.file_name))
+            stream.discard()
+            return False
+        stream.out_file.flush()
+        os.fsync(stream.out_file.fileno())
+        stream.out_file.close()
+        os.rename(stream.file_name + PART_SUFFIX, stream.file_name)
+        logging.info('Checksum for %s verified successfully.', str(stream.file_name))
+        if stream.name.endswith(HASH_SUFFIX):
+            return self.__register_volumes(stream, archive_hash)
+        # volume and member index are registered together with their archive
+        if not backup_tool.is_volume(stream.name) and not stream.name.endswith(backup_tool.INDEX_SUFFIX):
+            self.__register(stream, archive_hash)
+        return True
+
+    def handle(self, read, write, secret=None):
+        """
+        Serve one connection until client says BYE or connection is lost.
+        With secret client must first answer challenge with HMAC-SHA256 of it keyed by the secret.
+        """
+        streams = {}
+
+        def send_result(stream_id, name, ok):
+            payload = json.dumps({u'name': name, u'ok': ok})
+            write(FRAME_HEADER.pack(FRAME_RESULT, stream_id, len(payload)) + payload)
+
+        try:
+            if secret is not None:
+                nonce = os.urandom(NONCE_SIZE)
+                write(FRAME_HEADER.pack(FRAME_CHALLENGE, 0, len(nonce)) + nonce)
+                kind, _, payload = _read_frame(read)
+                if kind != FRAME_AUTH or not hmac.compare_digest(payload, auth_digest(secret, nonce)):
+                    logging.error('Client failed authentication, connection closed.')
+                    return
+            while True:
+                kind, stream_id, payload = _read_frame(read)
+                if kind == FRAME_BYE:
+                    break
+                if kind == FRAME_OPEN:
+                    # payload is archive list entry: file name and target of its archive
+                    entry = payload.decode('utf8')
+                    name = entry.partition(backup_tool.LIST_SEPARATOR)[0]
+                    if not self.__valid_name(name):
+                        logging.error('Stream name rejected or file exists: %s', name.encode('utf8'))
+                        streams[stream_id] = None
+                        continue
+                    streams[stream_id] = _Stream(name, backup_tool.list_entry(entry)[1],
+                                                 os.path.join(self.root_path, name))
+                    logging.info('Receive %s.', name.encode('utf8'))
+                elif kind == FRAME_DATA:
+                    stream = streams.get(stream_id)
+                    if stream is not None:
+                        stream.write(payload)
+                elif kind == FRAME_CLOSE:
+                    stream = streams.pop(stream_id, None)
+                    if stream is None:
+                        send_result(stream_id, None, False)
+                        continue
+                    send_result(stream_id, stream.name, self.__finish(stream, payload.decode('utf8')))
+        except (EOFError, IOError, OSError) as err:
+            logging.error('Connection lost: %s', str(err))
+        except ValueError as err:
+            logging.error('Protocol error, connection closed: %s', str(err))
+        finally:
+            for stream in streams.values():
+                if stream is not None:
+                    logging.warning('Incomplete archive %s removed.', str(stream.file_name))
+                    stream.discard()
+
+
+def make_server(receiver, host, port, secret=None):
+    """
+    Threading TCP server which serves each connection by receiver
+    """
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            logging.info('Connection from %s.', str(self.client_address))
+            receiver.handle(self.rfile.read, self.wfile.write, secret)
+
+    SocketServer.ThreadingTCPServer.allow_reuse_address = True
+    server = SocketServer.ThreadingTCPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(config_file, stdio=False):
+    if config_file is None or not os.path.exists(config_file):
+        print('Config file not found. Exiting.')
+        quit(-1)
+
+    cfg_parser = ConfigParser.SafeConfigParser()
+    cfg_parser.read(config_file)
+    backup_tool.init_log(cfg_parser)
+
+    chunks_dir = u'chunks'
+    catalog_file = catalog.CATALOG_FILE_NAME
+    if cfg_parser.has_section('target'):
+        archive_list_depth = int(cfg_parser.get('target', 'depth'))
+        root_path = cfg_parser.get('target', 'path').decode('utf8')
+        if cfg_parser.has_option('target', 'chunks_dir'):
+            chunks_dir = cfg_parser.get('target', 'chunks_dir').decode('utf8')
+        if cfg_parser.has_option('target', 'catalog_file'):
+            catalog_file = cfg_parser.get('target', 'catalog_file').decode('utf8')
+    else:
+        logging.error('Invalid config file. Exiting.')
+        quit(-1)
+
+    host = '127.0.0.1'
+    port = 7070
+    secret = None
+    if cfg_parser.has_section('receiver'):
+        if cfg_parser.has_option('receiver', 'host'):
+            host = cfg_parser.get('receiver', 'host')
+        if cfg_parser.has_option('receiver', 'port'):
+            port = cfg_parser.getint('receiver', 'port')
+        if cfg_parser.has_option('receiver', 'secret'):
+            secret = cfg_parser.get('receiver', 'secret') or None
+
+    receiver = ArchiveReceiver(root_path, archive_list_depth, chunks_dir, catalog_file)
+
+    if stdio:
+        # started by client through ssh, one connection on stdin and stdout
+        logging.info('Receive archives through standard streams.')
+        out = sys.stdout
+
+        def write(data):
+            out.write(data)
+            out.flush()
+        receiver.handle(sys.stdin.read, write)
+        logging.info('Receiver finished.')
+        logging.shutdown()
+        return
+
+    if secret is None and host not in LOOPBACK_HOSTS:
+        logging.error('Receiver on %s needs [receiver] secret, anyone could store archives otherwise. Exiting.',
+                      str(host))
+        quit(-1)
+    server = make_server(receiver, host, port, secret)
+    logging.info('Receive archives on %s:%s.', str(host), str(port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], len(sys.argv) > 2 and sys.argv[2] == '--stdio')
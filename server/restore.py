@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import os
+import io
+import json
+import shutil
+import logging
+import tarfile
+import argparse
+import subprocess
+import ConfigParser
+import backup_tool
+import catalog
+
+
+def load_index(archive_file_name):
+    index_file = backup_tool.index_file_name(archive_file_name)
+    if not os.path.exists(index_file):
+        return None
+    with io.open(index_file, 'r', encoding='utf8') as source_file:
+        return json.loads(source_file.read())
+
+
+def find_file(archive_catalog, target, rel_path, version=None):
+    """
+    Yields (archive name, index, file record) of versions holding the file, newest first
+    """
+    names = [version] if version is not None else reversed(archive_catalog.versions(target))
+    for name in names:
+        index = load_index(archive_catalog.path(name))
+        if index is None:
+            logging.warning('Archive %s has no member index, skipped.', name.encode('utf8'))
+            continue
+        for record in index[u'files']:
+            if record[0] == rel_path:
+                yield name, index, record
+                break
+
+
+def extract_member(archive_file, member_name, out_file_name):
+    """
+    Stream tar out of 7z and stop as soon as the member is written: only volume holding the file
+    is decompressed, and only up to the end of the file. Returns extracted size or None.
+    """
+    # 7z complains about closed pipe when reading stops early
+    devnull = io.open(os.devnull, 'wb')
+    proc = subprocess.Popen(['7z', 'x', '-so', archive_file], stdout=subprocess.PIPE, stderr=devnull)
+    size = None
+    try:
+        tar = tarfile.open(fileobj=proc.stdout, mode='r|')
+        for info in tar:
+            if info.name != member_name:
+                continue
+            member = tar.extractfile(info)
+            with io.open(out_file_name, 'wb') as out_file:
+                shutil.copyfileobj(member, out_file, 1024 * 1024)
+            os.utime(out_file_name, (info.mtime, info.mtime))
+            size = info.size
+            break
+    except tarfile.TarError as err:
+        logging.error('Archive %s read error: %s', str(archive_file), str(err))
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.terminate()
+        proc.wait()
+        devnull.close()
+    return size
+
+
+def restore_file(archive_catalog, target, rel_path, output_dir, version=None):
+    for name, index, record in find_file(archive_catalog, target, rel_path, version):
+        volume_file = archive_catalog.path(index[u'volumes'][record[3]])
+        member_name = os.path.join(index[u'target'].lstrip(os.sep), rel_path)
+        out_file_name = os.path.join(output_dir, os.path.basename(rel_path))
+        logging.info('Restore %s from %s.', rel_path.encode('utf8'), volume_file.encode('utf8'))
+        size = extract_member(volume_file, member_name.encode('utf8'), out_file_name)
+        if size is None or size != int(record[2]):
+            logging.error('File %s not found in %s.', rel_path.encode('utf8'), volume_file.encode('utf8'))
+            continue
+        return name, out_file_name
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Restore single file from stored archives.')
+    parser.add_argument('config', help='server configuration file')
+    parser.add_argument('target', help='target name, i.e. directory name of client target')
+    parser.add_argument('path', help='file path relative to target directory')
+    parser.add_argument('--version', help='archive name to restore from, the newest one holding the file by default')
+    parser.add_argument('--output', default=os.getcwd(), help='directory for restored file')
+    parser.add_argument('--list', action='store_true', help='only list versions holding the file')
+    args = parser.parse_args()
+
+    cfg_parser = ConfigParser.SafeConfigParser()
+    cfg_parser.read(args.config)
+    backup_tool.init_log(cfg_parser)
+    root_path = cfg_parser.get('target', 'path').decode('utf8')
+    catalog_file = catalog.CATALOG_FILE_NAME
+    if cfg_parser.has_option('target', 'catalog_file'):
+        catalog_file = cfg_parser.get('target', 'catalog_file').decode('utf8')
+
+    target = args.target.decode('utf8')
+    rel_path = args.path.decode('utf8').strip(os.sep)
+    version = args.version.decode('utf8') if args.version is not None else None
+    with catalog.ArchiveCatalog(root_path, catalog_file) as archive_catalog:
+        if args.list:
+            for name, _, record in find_file(archive_catalog, target, rel_path, version):
+                print(u' '.join([name, record[1], record[2]]).encode('utf8'))
+            return
+        res = restore_file(archive_catalog, target, rel_path, args.output.decode('utf8'), version)
+    if res is None:
+        print('File not found in stored archives.')
+        quit(-1)
+    print(u'Restored {0} from {1}'.format(res[1], res[0]).encode('utf8'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import sys
+import os
+import time
+import logging
+import ConfigParser
+import backup_tool
+import catalog
+import chunkstore
+import hashtool
+
+
+class Scrubber(object):
+    """
+    Background re-verification of stored versions against their hash files.
+    Versions are taken from catalog, the longest unchecked first, and verification time of each one
+    is saved at once, so scrubbing stopped by server shutdown goes on from the same place next time.
+    Reading is limited to mb_per_sec, run stops after max_seconds (between files).
+    """
+    def __init__(self, archive_catalog, chunk_index, mb_per_sec, max_seconds, interval_days):
+        self.archive_catalog = archive_catalog
+        self.chunk_index = chunk_index
+        self.throttle = hashtool.Throttle(mb_per_sec)
+        self.deadline = time.time() + max_seconds
+        self.interval_days = interval_days
+        self.__checked_chunks = set()
+
+    def __check_file(self, file_name, expected_hash):
+        if not os.path.exists(file_name):
+            logging.error('Scrub: file %s is missing.', str(file_name))
+            return False
+        res = hashtool.sha512_file(file_name, throttle=self.throttle)
+        if res is None or expected_hash is None or res[0] != expected_hash:
+            logging.error('Scrub: checksum of %s does not match.', str(file_name))
+            return False
+        return True
+
+    def __check_chunks(self, manifest_file):
+        chunk_ids = set(c[0] for c in chunkstore.load_manifest(manifest_file)[u'chunks'])
+        # chunks are shared by versions, each one is read once per run
+        for chunk_id in chunk_ids - self.__checked_chunks:
+            chunk_path = self.chunk_index.chunk_path(chunk_id)
+            if os.path.exists(chunk_path):
+                self.throttle.consume(os.path.getsize(chunk_path))
+            if not self.chunk_index.verify_chunk(chunk_id):
+                logging.error('Scrub: chunk %s of %s is broken.', str(chunk_id), str(manifest_file))
+                return False
+            self.__checked_chunks.add(chunk_id)
+        return True
+
+    def check_version(self, name, catalog_hash):
+        archive_file = self.archive_catalog.path(name)
+        files = backup_tool.archive_files(archive_file)
+        # catalog keeps hash of archive, or hash of hash file for archive split into volumes
+        if len(files) > 1:
+            if catalog_hash is not None and \
+                    not self.__check_file(backup_tool.hash_file_name(archive_file), catalog_hash):
+                return False
+        elif catalog_hash is not None and files[0][1] != catalog_hash:
+            logging.error('Scrub: hash file of %s does not match catalog.', str(name))
+            return False
+        for file_name, expected_hash in files:
+            if not self.__check_file(file_name, expected_hash):
+                return False
+        if archive_file.endswith(chunkstore.MANIFEST_SUFFIX):
+            return self.__check_chunks(archive_file)
+        return True
+
+    def run(self):
+        """
+        Returns number of checked and corrupted versions
+        """
+        checked = 0
+        corrupted = 0
+        for target, name, catalog_hash in self.archive_catalog.scrub_queue(self.interval_days):
+            if time.time() > self.deadline:
+                logging.info('Scrub time is over, it goes on next time.')
+                break
+            if self.check_version(name, catalog_hash):
+                self.archive_catalog.mark_verified(name)
+            else:
+                logging.error('Scrub: version %s of %s is CORRUPTED.', str(name), str(target))
+                self.archive_catalog.mark_corrupted(name)
+                corrupted += 1
+            checked += 1
+        return checked, corrupted
+
+
+def main(config_file, report_only=False):
+    if config_file is None or not os.path.exists(config_file):
+        print('Config file not found. Exiting.')
+        quit(-1)
+
+    cfg_parser = ConfigParser.SafeConfigParser()
+    cfg_parser.read(config_file)
+
+    mb_per_sec = 20
+    max_minutes = 60
+    interval_days = 30
+    log_file_name_template = 'scrub-'
+    if cfg_parser.has_section('scrub'):
+        if cfg_parser.has_option('scrub', 'max_mb_per_sec'):
+            mb_per_sec = cfg_parser.getint('scrub', 'max_mb_per_sec')
+        if cfg_parser.has_option('scrub', 'max_minutes'):
+            max_minutes = cfg_parser.getint('scrub', 'max_minutes')
+        if cfg_parser.has_option('scrub', 'interval_days'):
+            interval_days = cfg_parser.getint('scrub', 'interval_days')
+        if cfg_parser.has_option('scrub', 'file_name_template'):
+            log_file_name_template = cfg_parser.get('scrub', 'file_name_template')
+    if not report_only:
+        backup_tool.init_log(cfg_parser, log_file_name_template)
+
+    chunks_dir = u'chunks'
+    catalog_file = catalog.CATALOG_FILE_NAME
+    if cfg_parser.has_section('target'):
+        root_path = cfg_parser.get('target', 'path').decode('utf8')
+        if cfg_parser.has_option('target', 'chunks_dir'):
+            chunks_dir = cfg_parser.get('target', 'chunks_dir').decode('utf8')
+        if cfg_parser.has_option('target', 'catalog_file'):
+            catalog_file = cfg_parser.get('target', 'catalog_file').decode('utf8')
+    else:
+        logging.error('Invalid config file. Exiting.')
+        quit(-1)
+
+    with catalog.ArchiveCatalog(root_path, catalog_file) as archive_catalog:
+        if not report_only:
+            logging.info('Scrub stored versions at %s MB/s for %s minutes.', str(mb_per_sec), str(max_minutes))
+            scrubber = Scrubber(archive_catalog, chunkstore.ChunkIndex(os.path.join(root_path, chunks_dir)),
+                                mb_per_sec, max_minutes * 60, interval_days)
+            checked, corrupted = scrubber.run()
+            logging.info('Scrub finished: %s versions checked, %s corrupted.', str(checked), str(corrupted))
+        for target, name, found in archive_catalog.corrupted():
+            message = u'Corrupted version {0} of {1}, found {2}'.format(
+                name, target, time.strftime('%Y-%m-%d %H:%M', time.localtime(found)))
+            if report_only:
+                print(message.encode('utf8'))
+            else:
+                logging.error(message.encode('utf8'))
+    logging.shutdown()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], len(sys.argv) > 2 and sys.argv[2] == '--report')
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import unittest
+import testtool
+import dirtool
+import cachetool
+
+
+class ContentCacheTest(testtool.SandboxTestCase):
+
+    def setUp(self):
+        super(ContentCacheTest, self).setUp()
+        self.file_name = self.write(u'tg/home/a.txt', u'first')
+        self.cache_file = cachetool.cache_file_name(self.path(u'meta'), self.path(u'tg', u'home'))
+
+    def content(self):
+        cache = cachetool.ContentCache(self.cache_file)
+        content = cache.content(u'a.txt', self.file_name, os.stat(self.file_name))
+        cache.save()
+        return cache, content
+
+    def rewrite(self, data, mtime):
+        with io.open(self.file_name, 'w', encoding='utf8') as out_file:
+            out_file.write(data)
+        os.utime(self.file_name, (mtime, mtime))
+
+    def test_file_is_hashed_only_when_changed(self):
+        cache, first = self.content()
+        self.assertEqual(cache.hashed_files, 1)
+        cache, content = self.content()
+        self.assertEqual((cache.hashed_files, content), (0, first))
+        self.rewrite(u'second', os.stat(self.file_name).st_mtime + 10)
+        cache, content = self.content()
+        self.assertEqual(cache.hashed_files, 1)
+        self.assertNotEqual(content, first)
+
+    def test_same_second_rewrite_of_same_size_is_flagged(self):
+        mtime = int(os.stat(self.file_name).st_mtime)
+        self.rewrite(u'first', mtime + 0.25)
+        cache, first = self.content()
+        self.rewrite(u'other', mtime + 0.75)
+        cache, content = self.content()
+        self.assertNotEqual(content, first)
+        # archive stage reads flags from saved cache
+        cache = cachetool.ContentCache(self.cache_file)
+        self.assertEqual(cache.hidden_changes(), set([u'a.txt']))
+        cache.commit()
+        self.assertEqual(cachetool.ContentCache(self.cache_file).hidden_changes(), set())
+
+    def test_touched_file_keeps_state_of_target(self):
+        def scan():
+            descr = dirtool.DirDescriptor(self.path(u'tg', u'home'),
+                                          content_cache=cachetool.ContentCache(self.cache_file))
+            descr.load_actual_state()
+            return descr
+        first = scan()
+        self.rewrite(u'first', os.stat(self.file_name).st_mtime + 10)
+        self.assertEqual(scan(), first)
+        self.rewrite(u'other', os.stat(self.file_name).st_mtime)
+        self.assertNotEqual(scan(), first)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import time
+import random
+import unittest
+import testtool
+import chunktool
+import chunkstore
+
+
+class ChunkingTest(unittest.TestCase):
+
+    def test_inserted_data_keeps_following_chunks(self):
+        data = os.urandom(2 * 1024 * 1024)
+        before = list(chunktool.iter_chunks(io.BytesIO(data)))
+        after = list(chunktool.iter_chunks(io.BytesIO(b'inserted' + data)))
+        self.assertEqual(b''.join(before), data)
+        self.assertTrue(len(set(before) & set(after)) >= len(before) - 2)
+
+
+class ChunkReferenceTest(testtool.SandboxTestCase):
+
+    def setUp(self):
+        super(ChunkReferenceTest, self).setUp()
+        self.store_root = self.path(u'dest', u'chunks')
+        shared = random.Random(2)
+        for number in range(4):
+            self.write(u'tg/home/shared%d.bin' % number, u''.join(chr(shared.randint(32, 126)) for _ in range(65536)))
+        self.first = self.version(u'-1')
+        self.write(u'tg/home/own.bin', u''.join(chr(shared.randint(32, 126)) for _ in range(65536)))
+        self.second = self.version(u'-2')
+
+    def version(self, name_suffix):
+        store = chunktool.ChunkStore(self.store_root)
+        res = chunktool.make_chunked_version(self.path(u'tg', u'home'), self.path(u'meta'), store,
+                                             name_suffix=name_suffix)
+        return res[1]
+
+    def chunk_ids(self, manifest_file):
+        return set(c[0] for c in chunkstore.load_manifest(manifest_file)[u'chunks'])
+
+    def stored_ids(self):
+        return set(name for sub_dir in os.listdir(self.store_root) if os.path.isdir(os.path.join(self.store_root, sub_dir))
+                   for name in os.listdir(os.path.join(self.store_root, sub_dir)))
+
+    def test_shared_chunks_live_until_last_version_is_released(self):
+        index = chunkstore.ChunkIndex(self.store_root)
+        self.assertTrue(index.add_version(self.first))
+        self.assertTrue(index.add_version(self.second))
+        first_ids, second_ids = self.chunk_ids(self.first), self.chunk_ids(self.second)
+        self.assertTrue(len(first_ids & second_ids) > 0)
+        for chunk_id in first_ids & second_ids:
+            self.assertEqual(index.refs[chunk_id], 2)
+
+        index.release_version(self.first)
+        self.assertEqual(self.stored_ids(), second_ids)
+        with io.open(self.path(u'restored.tar'), 'wb') as out_stream:
+            self.assertTrue(chunktool.read_version(self.second, self.store_root, out_stream))
+
+        index.release_version(self.second)
+        self.assertEqual(index.refs, {})
+        self.assertEqual(self.stored_ids(), set())
+
+    def test_version_with_broken_chunk_takes_no_references(self):
+        chunk_id = sorted(self.chunk_ids(self.first))[0]
+        with io.open(os.path.join(self.store_root, chunk_id[:2], chunk_id), 'wb') as chunk_file:
+            chunk_file.write(b'broken')
+        index = chunkstore.ChunkIndex(self.store_root)
+        self.assertFalse(index.add_version(self.first))
+        self.assertEqual(index.refs, {})
+        self.assertFalse(os.path.exists(index.chunk_path(chunk_id)))
+
+    def test_sweep_removes_only_old_orphans(self):
+        index = chunkstore.ChunkIndex(self.store_root)
+        index.add_version(self.second)
+        orphans = self.chunk_ids(self.first) - self.chunk_ids(self.second)
+        old_orphan = sorted(orphans)[0]
+        old_time = time.time() - 3 * 24 * 3600
+        os.utime(index.chunk_path(old_orphan), (old_time, old_time))
+        index.sweep_orphans(2)
+        self.assertEqual(self.stored_ids(), (self.chunk_ids(self.first) | self.chunk_ids(self.second)) - {old_orphan})
+
+    def test_saved_index_is_known_to_client_store(self):
+        index = chunkstore.ChunkIndex(self.store_root)
+        index.add_version(self.first)
+        index.save()
+        self.assertEqual(chunktool.ChunkStore(self.store_root).known, self.chunk_ids(self.first))
+        self.assertEqual(chunkstore.ChunkIndex(self.store_root).refs, index.refs)
+
+
+if __name__ == '__main__':
+    unittest.main()
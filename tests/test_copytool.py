@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import json
+import errno
+import unittest
+import testtool
+import copytool
+import dirtool
+import runtool
+import test_parallel
+
+MB = copytool.MB
+
+
+class FileTransferTest(testtool.SandboxTestCase):
+
+    def setUp(self):
+        super(FileTransferTest, self).setUp()
+        self.src = self.path(u'meta', u'home-2024-01-31.tar.7z')
+        self.data = os.urandom(3 * MB + 1000)
+        with io.open(self.src, 'wb') as src_file:
+            src_file.write(self.data)
+        self.dest_file = self.path(u'dest', u'home-2024-01-31.tar.7z')
+
+    def interrupted_copy(self, part_data, signature=None):
+        with io.open(self.dest_file + copytool.PART_SUFFIX, 'wb') as part_file:
+            part_file.write(part_data)
+        if signature is None:
+            src_stat = os.stat(self.src)
+            signature = {u'size': src_stat.st_size, u'mtime': src_stat.st_mtime}
+        with io.open(self.dest_file + copytool.INFO_SUFFIX, 'w', encoding='utf8') as info:
+            info.write(json.dumps(signature).decode('utf8'))
+
+    def copied(self):
+        with io.open(self.dest_file, 'rb') as dest_file:
+            return dest_file.read()
+
+    def test_copy_resumes_after_last_matching_block(self):
+        self.interrupted_copy(self.data[:2 * MB + 500])
+        stats = copytool.FileTransfer(self.src, self.path(u'dest'), MB).run()
+        self.assertEqual(stats.resumed_from, 2 * MB)
+        self.assertEqual(stats.bytes, len(self.data) - 2 * MB)
+        self.assertEqual(self.copied(), self.data)
+        self.assertFalse(os.path.exists(self.dest_file + copytool.PART_SUFFIX))
+        self.assertFalse(os.path.exists(self.dest_file + copytool.INFO_SUFFIX))
+
+    def test_damaged_partial_copy_starts_from_zero(self):
+        self.interrupted_copy(self.data[:MB] + b'\0' * MB)
+        stats = copytool.FileTransfer(self.src, self.path(u'dest'), MB).run()
+        self.assertEqual(stats.resumed_from, 0)
+        self.assertEqual(self.copied(), self.data)
+
+    def test_partial_copy_of_other_source_starts_from_zero(self):
+        self.interrupted_copy(self.data[:2 * MB], {u'size': len(self.data), u'mtime': 0.0})
+        stats = copytool.FileTransfer(self.src, self.path(u'dest'), MB).run()
+        self.assertEqual(stats.resumed_from, 0)
+        self.assertEqual(self.copied(), self.data)
+
+    def test_source_shrunk_during_copy_fails(self):
+        transfer = copytool.FileTransfer(self.src, self.path(u'dest'), MB)
+        signature = {u'size': len(self.data) + MB, u'mtime': os.stat(self.src).st_mtime}
+        transfer._FileTransfer__source_signature = lambda: signature
+        self.assertRaises((IOError, OSError), transfer.run)
+        self.assertFalse(os.path.exists(self.dest_file))
+
+    def test_failed_transfer_keeps_source(self):
+        os.rmdir(self.path(u'dest'))
+        self.assertIsNone(copytool.transfer_file(self.src, self.path(u'dest'), retries=1, retry_delay=0))
+        self.assertTrue(os.path.exists(self.src))
+
+
+TRANSFER = u'''[transfer]
+retries = 1
+retry_delay = 0
+block_size_mb = 1
+'''
+
+
+class FailedCopyTest(testtool.SandboxTestCase):
+
+    def setUp(self):
+        super(FailedCopyTest, self).setUp()
+        with io.open(self.write(u'tg/home/data.bin', u''), 'wb') as data_file:
+            data_file.write(os.urandom(3 * MB))
+        self.write(u'targets.txt', self.path(u'tg', u'home') + u'\n')
+
+    def staged(self):
+        return sorted(n for n in os.listdir(self.path(u'meta')) if n.endswith(u'.tar.7z'))
+
+    def continued_copy(self, extra):
+        copy_block = copytool.FileTransfer._FileTransfer__copy_block
+
+        def failing_copy_block(transfer, src_file, part_file, offset, count):
+            if offset >= 2 * MB:
+                raise IOError(errno.EIO, 'link is down')
+            return copy_block(transfer, src_file, part_file, offset, count)
+        self.patch(copytool.FileTransfer, '_FileTransfer__copy_block', failing_copy_block)
+        self.controller(extra).backup()
+
+        archive = self.staged()
+        self.assertEqual(len(archive), 1)
+        self.assertTrue(set([archive[0] + copytool.PART_SUFFIX, archive[0] + copytool.INFO_SUFFIX]) <=
+                        set(self.dest_files()))
+        self.assertFalse(archive[0] in self.dest_files())
+        self.assertTrue(any(n.endswith(dirtool.PENDING_SUFFIX) for n in os.listdir(self.path(u'meta'))))
+
+        setattr(copytool.FileTransfer, '_FileTransfer__copy_block', copy_block)
+        transfers = []
+        transfer_file = copytool.transfer_file
+
+        def recorded_transfer(src, *args, **kwargs):
+            stats = transfer_file(src, *args, **kwargs)
+            transfers.append((os.path.basename(src), stats.resumed_from))
+            return stats
+        self.patch(copytool, 'transfer_file', recorded_transfer)
+        self.controller(extra).backup()
+
+        self.assertEqual(transfers[0], (archive[0], 2 * MB))
+        self.assertEqual(self.staged(), [])
+        self.assertEqual([f for f in self.dest_files() if f.endswith(u'.tar.7z')], archive)
+        self.assertFalse(any(n.endswith((dirtool.PENDING_SUFFIX, runtool.STAGED_SUFFIX))
+                             for n in os.listdir(self.path(u'meta'))))
+        with io.open(self.path(u'dest', u'backup.lst'), 'r', encoding='utf8') as list_file:
+            self.assertEqual(list_file.read().split(u'\t')[0], archive[0])
+
+        # target was not scanned by the run which finished the copy, state is current anyway
+        self.controller(extra).backup()
+        self.assertEqual([f for f in self.dest_files() if f.endswith(u'.tar.7z')], archive)
+
+    def test_next_run_continues_copy_of_kept_archive(self):
+        self.continued_copy(TRANSFER)
+
+    def test_next_parallel_run_continues_copy_of_kept_archive(self):
+        self.continued_copy(TRANSFER + test_parallel.PARALLEL)
+
+    def test_kept_archive_which_is_damaged_is_made_again(self):
+        self.patch(copytool, 'transfer_file', lambda *args, **kwargs: None)
+        self.controller(TRANSFER).backup()
+        archive = self.staged()
+        with io.open(self.path(u'meta', archive[0]), 'ab') as archive_file:
+            archive_file.write(b'damage')
+        self.controller(TRANSFER).backup()
+        self.assertEqual(self.staged(), archive)
+        res = [self.path(u'meta', archive[0][:-len(u'.tar.7z')] + u'.sha512'), self.path(u'meta', archive[0])]
+        self.assertTrue(runtool.archive_intact(res))
+
+if __name__ == '__main__':
+    unittest.main()
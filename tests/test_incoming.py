@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+import testtool
+import backup_tool
+import catalog
+
+HANDOFF = u'''stream_handoff = yes
+incoming_dir_name = incoming
+'''
+
+
+class IncomingTest(testtool.SandboxTestCase):
+
+    def versions(self):
+        with catalog.ArchiveCatalog(self.path(u'dest')) as archive_catalog:
+            return dict((t, len(archive_catalog.versions(t))) for t in (u'home', u'mail'))
+
+    def test_published_archives_are_checked_without_incoming_section(self):
+        self.targets(u'home', u'mail')
+        self.controller(destination=HANDOFF).backup()
+        self.assertEqual(len([m for m in os.listdir(self.path(u'dest', u'incoming'))
+                              if m.endswith(backup_tool.READY_SUFFIX)]), 2)
+
+        backup_tool.main(self.server_config())
+        self.assertEqual(self.versions(), {u'home': 1, u'mail': 1})
+        self.assertEqual(os.listdir(self.path(u'dest', u'incoming')), [backup_tool.LOCK_FILE_NAME])
+
+
+if __name__ == '__main__':
+    unittest.main()
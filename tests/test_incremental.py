@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import time
+import tarfile
+import unittest
+import testtool
+
+
+class IncrementalChainTest(testtool.SandboxTestCase):
+
+    def run_backup(self):
+        controller = self.controller()
+        controller.backup()
+        return controller
+
+    def manifest(self, archive_name):
+        with tarfile.open(self.path(u'dest', archive_name), 'r:gz') as archive:
+            member = [m for m in archive.getmembers() if m.name.endswith('.manifest.json')][0]
+            return json.loads(archive.extractfile(member).read().decode('utf8'))
+
+    def test_incrementals_of_the_same_day_get_sequence_numbers(self):
+        self.targets(u'home')
+        today = time.strftime('-%Y-%m-%d')
+        self.run_backup()
+        self.write(u'tg/home/sub/file0.txt', u'first change')
+        self.run_backup()
+        self.write(u'tg/home/sub/file1.txt', u'second change')
+        self.run_backup()
+
+        full = u'home' + today + u'.tar.7z'
+        first = u'home' + today + u'.2.inc.tar.7z'
+        second = u'home' + today + u'.3.inc.tar.7z'
+        self.assertEqual([n for n in self.dest_files() if n.endswith(u'.tar.7z')], sorted([full, first, second]))
+        with io.open(self.path(u'meta', u'chains.json'), 'r', encoding='utf8') as chains_file:
+            chain = list(json.load(chains_file).values())[0]
+        self.assertEqual((chain[u'base'], chain[u'last']), (full, second))
+        self.assertEqual(self.manifest(first)[u'parent'], full)
+        self.assertEqual(self.manifest(second)[u'parent'], first)
+        self.assertEqual(self.manifest(second)[u'base'], full)
+
+    def test_new_time_stamp_starts_without_sequence_number(self):
+        target = self.targets(u'home')[0]
+        controller = self.controller()
+        name_suffix = controller._BackupController__name_suffix
+        today = time.strftime('-%Y-%m-%d')
+        self.assertEqual(name_suffix(target, None), today)
+        self.assertEqual(name_suffix(target, {u'last': u'home-2000-01-01.3.inc.tar.7z'}), today)
+        self.assertEqual(name_suffix(target, {u'last': u'home' + today + u'.9.inc.tar.7z'}), today + u'.10')
+        self.assertEqual(name_suffix(target, {u'last': u'home' + today + u'.chunks.json'}), today + u'.2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import unittest
+import testtool
+import backup_tool
+import catalog
+import chunkstore
+import ingest
+
+INGEST = u'''ingest_queue = yes
+client_id = %s
+'''
+
+
+class IngestTest(testtool.SandboxTestCase):
+
+    def client(self, client_id, content):
+        """
+        Backup of target 'home' by client with its own service directory
+        """
+        self.write(u'tg/%s/home/file.txt' % client_id, content)
+        self.write(u'targets.txt', self.path(u'tg', client_id, u'home') + u'\n')
+        shutil.rmtree(self.path(u'meta'))
+        os.mkdir(self.path(u'meta'))
+        self.controller(destination=INGEST % client_id).backup()
+
+    def test_targets_of_clients_with_same_name_are_kept_apart(self):
+        self.client(u'host1', u'first client')
+        self.client(u'host2', u'second client')
+        archives = [f for f in self.dest_files() if f.endswith(u'.tar.7z')]
+        self.assertEqual(sorted(a.split(u'-')[0] for a in archives), [u'host1.home', u'host2.home'])
+
+        queue = ingest.IngestQueue(self.path(u'dest', ingest.QUEUE_DIR_NAME))
+        batch = ingest.next_batch(queue.pending())
+        self.assertEqual(len(batch), 2)
+        with catalog.ArchiveCatalog(self.path(u'dest')) as archive_catalog:
+            backup_tool.process_archives([a for _, job_archives in batch for a in job_archives], self.path(u'dest'),
+                                         chunkstore.ChunkIndex(self.path(u'dest', u'chunks')), archive_catalog, 2, 3)
+            versions = dict((t, archive_catalog.versions(t)) for t in (u'home', u'host1.home', u'host2.home'))
+        self.assertEqual([len(versions[t]) for t in (u'home', u'host1.home', u'host2.home')], [0, 1, 1])
+        self.assertEqual(sorted(v for t in (u'host1.home', u'host2.home') for v in versions[t]), sorted(archives))
+
+
+if __name__ == '__main__':
+    unittest.main()
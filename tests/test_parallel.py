@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+import testtool
+import dirtool
+import runtool
+
+PARALLEL = u'''[parallel]
+enabled = yes
+scan_workers = 2
+compress_workers = 2
+transfer_workers = 2
+'''
+
+
+class ParallelRunTest(testtool.SandboxTestCase):
+
+    def test_failed_callback_drops_only_its_target(self):
+        self.targets(u'one', u'two', u'three')
+        record = runtool.RunJournal.record
+
+        def failing_record(journal, target, step, *args, **kwargs):
+            if step == runtool.STEP_ARCHIVED and target.endswith(u'two'):
+                raise IOError('No space left on device')
+            return record(journal, target, step, *args, **kwargs)
+        self.patch(runtool.RunJournal, 'record', failing_record)
+        self.controller(PARALLEL + u'[metadata]\nrun_journal = yes\n').backup()
+
+        archives = [n for n in self.dest_files() if n.endswith(u'.tar.7z')]
+        self.assertEqual([n[:n.index(u'-')] for n in archives], [u'one', u'three'])
+
+    def test_lost_worker_abandons_remaining_targets(self):
+        self.targets(u'one', u'two')
+        archive_target = dirtool.BackupController._archive_target
+
+        def killed_worker(controller, curr_target, *args):
+            if curr_target.endswith(u'two'):
+                os._exit(9)
+            return archive_target(controller, curr_target, *args)
+        self.patch(dirtool.BackupController, '_archive_target', killed_worker)
+        controller = self.controller(PARALLEL)
+        controller._target_timeout = 2
+        controller.backup()
+
+        archives = [n for n in self.dest_files() if n.endswith(u'.tar.7z')]
+        self.assertEqual([n[:n.index(u'-')] for n in archives], [u'one'])
+        self.assertTrue(os.path.exists(self.path(u'meta', u'dict.json')))
+
+
+if __name__ == '__main__':
+    unittest.main()
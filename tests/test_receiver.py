@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import hashlib
+import threading
+import unittest
+import testtool
+import receiver
+import streamtool
+import catalog
+
+NAME = u'home-2024-01-31.tar.7z'
+DATA = b'archive data' * 1000
+
+
+def frame(kind, stream_id, payload=b''):
+    return receiver.FRAME_HEADER.pack(kind, stream_id, len(payload)) + payload
+
+
+def stream_frames(name, data, stream_id=1, expected_hash=None):
+    if expected_hash is None:
+        expected_hash = hashlib.sha512(data).hexdigest()
+    return (frame(receiver.FRAME_OPEN, stream_id, name.encode('utf8')) + frame(receiver.FRAME_DATA, stream_id, data) +
+            frame(receiver.FRAME_CLOSE, stream_id, expected_hash))
+
+
+class ReceiverTest(testtool.SandboxTestCase):
+
+    def setUp(self):
+        super(ReceiverTest, self).setUp()
+        self.receiver = receiver.ArchiveReceiver(self.path(u'dest'), 3, u'chunks', catalog.CATALOG_FILE_NAME)
+
+    def handle(self, frames):
+        """
+        Serve connection with given client frames, returns results sent back {stream id: ok}
+        """
+        out = io.BytesIO()
+        self.receiver.handle(io.BytesIO(frames).read, out.write)
+        results = {}
+        answer = io.BytesIO(out.getvalue())
+        while True:
+            header = answer.read(receiver.FRAME_HEADER.size)
+            if len(header) == 0:
+                return results
+            kind, stream_id, length = receiver.FRAME_HEADER.unpack(header)
+            results[stream_id] = json.loads(answer.read(length))[u'ok']
+
+    def versions(self, target):
+        with catalog.ArchiveCatalog(self.path(u'dest')) as archive_catalog:
+            return archive_catalog.versions(target)
+
+    def test_stream_is_stored_and_registered_by_target(self):
+        results = self.handle(stream_frames(u'my-data-2024-01-31.tar.7z\tmy-data', DATA) + frame(receiver.FRAME_BYE, 0))
+        self.assertEqual(results, {1: True})
+        self.assertEqual(self.versions(u'my-data'), [u'my-data-2024-01-31.tar.7z'])
+        self.assertEqual(self.dest_files(), [u'catalog.db', u'my-data-2024-01-31.sha512', u'my-data-2024-01-31.tar.7z'])
+
+    def test_stream_with_wrong_hash_is_discarded(self):
+        results = self.handle(stream_frames(NAME, DATA, expected_hash=b'0' * 128) + frame(receiver.FRAME_BYE, 0))
+        self.assertEqual(results, {1: False})
+        self.assertEqual(self.dest_files(), [])
+
+    def test_existing_file_is_not_replaced(self):
+        self.write(u'dest/' + NAME, u'stored')
+        results = self.handle(stream_frames(NAME, DATA) + frame(receiver.FRAME_BYE, 0))
+        self.assertEqual(results, {1: False})
+        with io.open(self.path(u'dest', NAME), 'r', encoding='utf8') as stored:
+            self.assertEqual(stored.read(), u'stored')
+
+    def test_oversized_frame_closes_connection(self):
+        frames = (frame(receiver.FRAME_OPEN, 1, NAME.encode('utf8')) +
+                  receiver.FRAME_HEADER.pack(receiver.FRAME_DATA, 1, 1 << 40) + DATA)
+        self.assertEqual(self.handle(frames), {})
+        self.assertEqual(self.dest_files(), [])
+        self.assertEqual(self.handle(receiver.FRAME_HEADER.pack(receiver.FRAME_OPEN, 1, 1 << 20)), {})
+        self.assertEqual(self.handle(frame(99, 1, b'x')), {})
+
+
+class AuthenticationTest(testtool.SandboxTestCase):
+
+    def setUp(self):
+        super(AuthenticationTest, self).setUp()
+        self.patch(streamtool, 'AUTH_TIMEOUT', 1)
+        self.archive = self.write(u'meta/' + NAME, u'archive data')
+        with io.open(self.archive, 'rb') as archive_file:
+            self.hash = hashlib.sha512(archive_file.read()).hexdigest().decode('utf8')
+
+    def serve(self, secret):
+        archive_receiver = receiver.ArchiveReceiver(self.path(u'dest'), 3, u'chunks', catalog.CATALOG_FILE_NAME)
+        server = receiver.make_server(archive_receiver, '127.0.0.1', 0, secret)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_address[1]
+
+    def send(self, port, secret):
+        connection = streamtool.StreamConnection.tcp('127.0.0.1', port, secret)
+        try:
+            return connection.send_file(self.archive, self.hash, u'home')
+        finally:
+            connection.close()
+
+    def test_client_with_secret_is_accepted(self):
+        self.assertTrue(self.send(self.serve('shared secret'), 'shared secret'))
+        self.assertTrue(NAME in self.dest_files())
+
+    def test_client_with_wrong_or_without_secret_is_refused(self):
+        port = self.serve('shared secret')
+        self.assertFalse(self.send(port, 'other secret'))
+        self.assertFalse(self.send(port, None))
+        self.assertFalse(NAME in self.dest_files())
+
+    def test_client_with_secret_does_not_wait_for_receiver_without_it(self):
+        self.assertRaises(IOError, self.send, self.serve(None), 'shared secret')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import unittest
+import testtool
+import backup_tool
+import catalog
+import chunkstore
+import restore
+
+
+class RestoreTest(testtool.SandboxTestCase):
+
+    def setUp(self):
+        super(RestoreTest, self).setUp()
+        self.target = self.targets(u'home')[0]
+        os.mkdir(self.path(u'out'))
+
+    def backup(self, volume_size=0):
+        """
+        Client run and server check of its archives, returns archive names of the run
+        """
+        controller = self.controller()
+        controller._volume_size = volume_size
+        controller.backup()
+        with io.open(self.path(u'dest', u'backup.lst'), 'r', encoding='utf8') as list_file:
+            entries = list_file.read().split(u'\n')
+        with catalog.ArchiveCatalog(self.path(u'dest')) as archive_catalog:
+            backup_tool.process_archives(entries, self.path(u'dest'),
+                                         chunkstore.ChunkIndex(self.path(u'dest', u'chunks')), archive_catalog, 2, 3)
+        return [backup_tool.list_entry(e)[0] for e in entries]
+
+    def restore(self, rel_path, version=None):
+        with catalog.ArchiveCatalog(self.path(u'dest')) as archive_catalog:
+            return restore.restore_file(archive_catalog, u'home', rel_path, self.path(u'out'), version)
+
+    def versions(self, rel_path):
+        with catalog.ArchiveCatalog(self.path(u'dest')) as archive_catalog:
+            return [name for name, _, _ in restore.find_file(archive_catalog, u'home', rel_path)]
+
+    def assertRestored(self, res, rel_path):
+        source = os.path.join(self.target, rel_path)
+        with io.open(res[1], 'rb') as restored_file, io.open(source, 'rb') as source_file:
+            self.assertEqual(restored_file.read(), source_file.read())
+        self.assertEqual(int(os.path.getmtime(res[1])), int(os.path.getmtime(source)))
+
+    def test_file_is_restored_from_archive(self):
+        archive = self.backup()
+        res = self.restore(u'sub/file1.txt')
+        self.assertEqual(res[0], archive[0])
+        self.assertRestored(res, u'sub/file1.txt')
+        self.assertIsNone(self.restore(u'sub/missing.txt'))
+
+    def test_file_is_restored_from_its_volume(self):
+        archive = self.backup(volume_size=300)
+        index = restore.load_index(self.path(u'dest', archive[0]))
+        self.assertTrue(len(index[u'volumes']) > 2)
+        self.assertEqual([r[0] for r in index[u'files']], [u'sub/file%d.txt' % n for n in range(3)])
+        record = [r for r in index[u'files'] if r[0] == u'sub/file2.txt'][0]
+        self.assertTrue(record[3] > 0)
+        res = self.restore(u'sub/file2.txt')
+        self.assertEqual(res[0], archive[0])
+        self.assertRestored(res, u'sub/file2.txt')
+
+    def test_newest_version_is_restored_first(self):
+        full = self.backup()
+        self.write(u'tg/home/sub/file1.txt', u'changed content')
+        incremental = self.backup()
+        self.assertEqual(self.versions(u'sub/file1.txt'), incremental + full)
+        self.assertEqual(self.versions(u'sub/file0.txt'), full)
+        res = self.restore(u'sub/file1.txt')
+        self.assertEqual(res[0], incremental[0])
+        self.assertRestored(res, u'sub/file1.txt')
+        res = self.restore(u'sub/file1.txt', full[0])
+        with io.open(res[1], 'r', encoding='utf8') as restored_file:
+            self.assertEqual(restored_file.read(), u'home' * 200)
+
+    def test_archive_without_index_is_skipped(self):
+        full = self.backup()
+        self.write(u'tg/home/sub/file1.txt', u'changed content')
+        incremental = self.backup()
+        os.remove(backup_tool.index_file_name(self.path(u'dest', incremental[0])))
+        self.assertEqual(self.versions(u'sub/file1.txt'), full)
+        self.assertEqual(self.restore(u'sub/file1.txt')[0], full[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
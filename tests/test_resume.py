@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import time
+import unittest
+import testtool
+import dirtool
+import runtool
+
+JOURNAL = u'run_journal = yes\n'
+
+
+class ResumeTest(testtool.SandboxTestCase):
+
+    def interrupted_run(self):
+        """
+        Run stopped (as by power loss) when the second archive is being copied
+        """
+        transfer_archive = dirtool.BackupController._transfer_archive
+        copied = []
+
+        def stopping_transfer(controller, curr_target, res):
+            if len(copied) == 1:
+                raise KeyboardInterrupt()
+            copied.append(curr_target)
+            return transfer_archive(controller, curr_target, res)
+        self.patch(dirtool.BackupController, '_transfer_archive', stopping_transfer)
+        self.assertRaises(KeyboardInterrupt, self.controller(metadata=JOURNAL).backup)
+        setattr(dirtool.BackupController, '_transfer_archive', transfer_archive)
+        return os.path.basename(copied[0])
+
+    def archives(self):
+        return sorted(f for f in self.dest_files() if f.endswith(u'.tar.7z'))
+
+    def test_journal_is_off_by_default(self):
+        self.targets(u'home')
+        controller = self.controller()
+        self.assertIsNone(controller._run_journal)
+        controller.backup()
+        self.assertFalse(os.path.exists(self.path(u'meta', runtool.RUN_JOURNAL_FILE_NAME)))
+
+    def test_interrupted_run_is_finished(self):
+        self.targets(u'home', u'mail')
+        done = self.interrupted_run()
+        self.assertEqual([a.split(u'-')[0] for a in self.archives()], [done])
+        self.assertTrue(os.path.exists(self.path(u'meta', runtool.RUN_JOURNAL_FILE_NAME)))
+
+        self.controller(metadata=JOURNAL).backup()
+        self.assertEqual([a.split(u'-')[0] for a in self.archives()], [u'home', u'mail'])
+        with io.open(self.path(u'dest', u'backup.lst'), 'r', encoding='utf8') as list_file:
+            self.assertEqual(sorted(l.split(u'\t')[0] for l in list_file.read().split(u'\n')), self.archives())
+        self.assertFalse(os.path.exists(self.path(u'meta', runtool.RUN_JOURNAL_FILE_NAME)))
+        self.assertEqual([n for n in os.listdir(self.path(u'meta')) if n.endswith(dirtool.LEFTOVER_SUFFIXES)], [])
+
+    def test_only_leftovers_of_interrupted_run_are_removed(self):
+        self.targets(u'home', u'mail')
+        done = self.interrupted_run()
+        leftover = self.write(u'meta/%s-2000-01-01.tar' % done, u'leftover')
+        old_file = self.write(u'meta/%s-1999-12-31.tar' % done, u'kept by user')
+        old_time = time.time() - 3 * 24 * 3600
+        os.utime(old_file, (old_time, old_time))
+        other_file = self.write(u'meta/notes.tar', u'not a target')
+
+        self.controller(metadata=JOURNAL).backup()
+        self.assertFalse(os.path.exists(leftover))
+        self.assertTrue(os.path.exists(old_file))
+        self.assertTrue(os.path.exists(other_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import tarfile
+import unittest
+import testtool
+import dirtool
+import ruletool
+
+RULES = u'''[%s]
+exclude = node_modules, *.o, build/
+exclude_regex = \\.bak$
+include = *.keep.o
+max_size_mb = 1
+'''
+
+
+class TargetRulesTest(unittest.TestCase):
+
+    def test_entries_are_excluded_by_name_path_and_regex(self):
+        rules = ruletool.TargetRules(exclude=[u'node_modules', u'*.o', u'build/'], exclude_regex=[u'\\.bak$'],
+                                     include=[u'*.keep.o'])
+        self.assertTrue(rules.excludes(u'src/node_modules', True))
+        self.assertTrue(rules.excludes(u'src/main.o', False))
+        self.assertFalse(rules.excludes(u'src/main.keep.o', False))
+        self.assertTrue(rules.excludes(u'build', True))
+        self.assertFalse(rules.excludes(u'src/build', True))
+        self.assertTrue(rules.excludes(u'notes.txt.bak', False))
+        self.assertFalse(rules.excludes(u'notes.txt', False))
+
+    def test_large_and_old_files_are_excluded(self):
+        rules = ruletool.TargetRules(max_size_mb=1, max_age_days=10)
+        now = time.time()
+        self.assertTrue(rules.excludes(u'big', False, lambda: os.stat_result((0,) * 6 + (2 * ruletool.MB, 0, now, 0))))
+        self.assertTrue(rules.excludes(u'old', False, lambda: os.stat_result((0,) * 6 + (10, 0, now - 11 * 86400, 0))))
+        self.assertFalse(rules.excludes(u'new', False, lambda: os.stat_result((0,) * 6 + (10, 0, now, 0))))
+        self.assertFalse(rules.excludes(u'dir', True, lambda: os.stat_result((0,) * 6 + (2 * ruletool.MB, 0, 0, 0))))
+
+    def test_fingerprint_follows_rules(self):
+        self.assertEqual(ruletool.TargetRules(exclude=[u'a', u'b']).fingerprint,
+                         ruletool.TargetRules(exclude=[u'b', u'a']).fingerprint)
+        self.assertNotEqual(ruletool.TargetRules(exclude=[u'a']).fingerprint,
+                            ruletool.TargetRules(exclude=[u'a'], max_size_mb=1).fingerprint)
+
+
+class RulesOfTargetTest(testtool.SandboxTestCase):
+
+    def setUp(self):
+        super(RulesOfTargetTest, self).setUp()
+        for rel_path in (u'main.c', u'main.o', u'main.keep.o', u'notes.bak', u'node_modules/lib.js',
+                         u'build/out.bin', u'src/build/kept.c'):
+            self.write(u'tg/project/' + rel_path, rel_path)
+        self.write(u'tg/project/large.bin', u'x' * (2 * ruletool.MB))
+        self.target = self.path(u'tg', u'project')
+        self.rules_file = self.write(u'rules.cfg', RULES % self.target)
+        self.kept = [u'main.c', u'main.keep.o', u'src/build/kept.c']
+
+    def test_rules_are_loaded_by_target_path(self):
+        rules = ruletool.load_rules(self.rules_file)
+        self.assertEqual(list(rules.keys()), [self.target])
+        descr = dirtool.DirDescriptor(self.target, rules=rules[self.target])
+        descr.load_actual_state()
+        self.assertEqual([f[0] for f in descr.metadata[u'files']], sorted(self.kept))
+        self.assertEqual(descr.metadata[u'subdirs'], [u'src', u'src/build'])
+        self.assertEqual(descr.metadata[u'rules'], rules[self.target].fingerprint)
+
+    def test_archive_holds_only_included_files(self):
+        self.write(u'targets.txt', self.target + u'\n')
+        # options of the same section in another part of config are merged by parser
+        self.controller(u'[targets]\nrules_file = %s\n' % self.rules_file).backup()
+        archive = [f for f in self.dest_files() if f.endswith(u'.tar.7z')][0]
+        with tarfile.open(self.path(u'dest', archive), 'r:gz') as archive_file:
+            names = [n for n in archive_file.getnames() if os.path.isfile(os.path.join(os.sep, n))]
+        root = self.target.lstrip(os.sep)
+        self.assertEqual(sorted(names), sorted(os.path.join(root, k) for k in self.kept))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+import testtool
+import dirtool
+
+
+class ScannerTest(testtool.SandboxTestCase):
+
+    def setUp(self):
+        super(ScannerTest, self).setUp()
+        for rel_path in (u'a.txt', u'b/c.txt', u'b/d/e.txt', u'b-x/f.txt', u'b.y/g.txt', u'z/h.txt'):
+            self.write(u'tg/home/' + rel_path, rel_path * 10)
+        os.mkdir(self.path(u'tg', u'home', u'empty'))
+        self.target = self.path(u'tg', u'home')
+
+    def walked(self):
+        subdirs, files = [], []
+        for root, dir_names, file_names in os.walk(self.target):
+            rel_dir = os.path.relpath(root, self.target)
+            rel_dir = u'' if rel_dir == u'.' else rel_dir
+            subdirs += [os.path.join(rel_dir, d) for d in dir_names]
+            files += [os.path.join(rel_dir, f) for f in file_names]
+        return sorted(subdirs), sorted(files)
+
+    def scan(self, stored_descr=None):
+        descr = dirtool.DirDescriptor(self.target)
+        descr.load_actual_state(stored_descr)
+        return descr
+
+    def test_walk_finds_what_os_walk_finds_in_sorted_order(self):
+        items = list(dirtool.TreeScanner(self.target).walk())
+        subdirs = [p for kind, p, _ in items if kind == dirtool.TreeScanner.SUBDIR]
+        files = [p for kind, p, _ in items if kind == dirtool.TreeScanner.FILE]
+        self.assertEqual((subdirs, files), (sorted(subdirs), sorted(files)))
+        self.assertEqual((subdirs, files), self.walked())
+
+    def test_scandir_and_listdir_give_the_same_state(self):
+        if dirtool._scandir is None:
+            self.skipTest('scandir is not available')
+        scanned = self.scan()
+        self.patch(dirtool, '_scandir', None)
+        self.assertEqual(self.scan(), scanned)
+
+    def test_state_lists_all_files_and_subdirs(self):
+        descr = self.scan()
+        self.assertEqual((descr.metadata[u'subdirs'], [f[0] for f in descr.metadata[u'files']]), self.walked())
+
+
+    def test_pruned_scan_reuses_unchanged_dirs_and_finds_changes(self):
+        stored = self.scan()
+        self.write(u'tg/home/b/d/new.txt', u'new file')
+        scanner = dirtool.PruningTreeScanner(self.target, stored.metadata)
+        self.assertTrue(any(p == u'b/d/new.txt' for _, p, _ in scanner.walk()))
+        # only root, b and b/d are listed again
+        self.assertEqual(scanner.reused_dirs, len(stored.metadata[u'dirs']) - 3)
+
+        pruned = self.scan(stored)
+        self.assertEqual(pruned, self.scan())
+        self.assertNotEqual(pruned, stored)
+        self.assertEqual(pruned.changed_dirs(stored.metadata[u'dirs']), [u'', u'b', u'b/d'])
+        self.assertEqual(self.scan(pruned).changed_dirs(pruned.metadata[u'dirs']), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+import testtool
+import dirtool
+import storetool
+
+
+class DescriptorStoreTest(testtool.SandboxTestCase):
+
+    def setUp(self):
+        super(DescriptorStoreTest, self).setUp()
+        for rel_path in (u'a.txt', u'b/c.txt', u'b/d/e.txt', u'b/d/é ü.txt', u'z/h.txt'):
+            self.write(u'tg/home/' + rel_path, rel_path * 10)
+        self.descr = dirtool.DirDescriptor(self.path(u'tg', u'home'))
+        self.descr.load_actual_state()
+        self.store_file = self.path(u'meta', u'home' + storetool.STORE_EXTENSION)
+
+    def test_metadata_is_restored_from_store(self):
+        self.descr.save_to_store(self.store_file)
+        self.assertTrue(storetool.is_store(self.store_file))
+        restored = dirtool.DirDescriptor(self.path(u'tg', u'home'))
+        restored.load_stored_state(self.store_file)
+        self.assertEqual(restored.metadata, self.descr.metadata)
+        with dirtool.StoredState(self.store_file) as stored:
+            self.assertEqual(list(stored.iter_files()), self.descr.metadata[u'files'])
+            self.assertEqual(list(stored.iter_subdirs()), self.descr.metadata[u'subdirs'])
+
+    def test_stores_of_same_state_have_same_content(self):
+        self.descr.save_to_store(self.store_file)
+        self.descr.save_to_store(self.store_file + u'.copy')
+        self.write(u'tg/home/b/new.txt', u'new file')
+        changed = dirtool.DirDescriptor(self.path(u'tg', u'home'))
+        changed.load_actual_state()
+        changed.save_to_store(self.store_file + u'.changed')
+        with storetool.DescriptorStore(self.store_file) as store:
+            with storetool.DescriptorStore(self.store_file + u'.copy') as copy:
+                self.assertTrue(store.same_content(copy))
+            with storetool.DescriptorStore(self.store_file + u'.changed') as other:
+                self.assertFalse(store.same_content(other))
+
+    def test_json_descriptor_is_migrated(self):
+        json_file = self.path(u'meta', u'home.json')
+        self.descr.save_to_json(json_file)
+        self.assertFalse(storetool.is_store(json_file))
+        self.assertTrue(storetool.migrate_json(json_file, self.store_file, dirtool.DEFAULT_TIME_FORMAT))
+        self.assertFalse(os.path.exists(json_file))
+        self.assertEqual(storetool.load_metadata(self.store_file, dirtool.DEFAULT_TIME_FORMAT), self.descr.metadata)
+
+
+    def streaming_matches(self):
+        actual = dirtool.DirDescriptor(self.path(u'tg', u'home'))
+        with storetool.DescriptorStore(self.store_file) as store:
+            return actual.streaming_matches_store(store)
+
+    def test_streaming_compare_stops_at_change(self):
+        self.descr.save_to_store(self.store_file)
+        self.assertTrue(self.streaming_matches())
+        os.utime(self.path(u'tg', u'home', u'b', u'c.txt'), (0, 0))
+        self.assertFalse(self.streaming_matches())
+        os.remove(self.path(u'tg', u'home', u'b', u'c.txt'))
+        self.assertFalse(self.streaming_matches())
+        self.descr.load_actual_state()
+        self.descr.save_to_store(self.store_file)
+        self.assertTrue(self.streaming_matches())
+        os.mkdir(self.path(u'tg', u'home', u'b', u'empty'))
+        self.assertFalse(self.streaming_matches())
+
+    def test_unchanged_target_is_not_archived_with_streaming_compare(self):
+        self.targets(u'mail')
+        self.controller(metadata=u'streaming_compare = yes\n').backup()
+        archives = self.dest_files()
+        self.controller(metadata=u'streaming_compare = yes\n').backup()
+        self.assertEqual(self.dest_files(), archives)
+        self.write(u'tg/mail/sub/file0.txt', u'changed')
+        self.controller(metadata=u'streaming_compare = yes\n').backup()
+        self.assertEqual(len([f for f in self.dest_files() if f.endswith(u'.tar.7z')]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import time
+import hashlib
+import unittest
+import testtool
+import backup_tool
+import catalog
+import chunkstore
+import metrictool
+import chunktool
+import scrubber
+
+
+class ArchiveTestCase(testtool.SandboxTestCase):
+
+    def archive(self, name, content, volumes=0):
+        """
+        Archive in destination with its hash file, optionally split into volumes
+        """
+        if volumes == 0:
+            self.write(u'dest/' + name + u'.tar.7z', content)
+            lines = [u'%s  %s' % (hashlib.sha512(content.encode('utf8')).hexdigest(), name + u'.tar.7z')]
+        else:
+            lines = []
+            for number in range(volumes):
+                volume = name + u'.v%03d.tar.7z' % (number + 1)
+                self.write(u'dest/' + volume, content * (number + 1))
+                lines.append(u'%s  %s' % (hashlib.sha512((content * (number + 1)).encode('utf8')).hexdigest(), volume))
+        self.write(u'dest/' + name + u'.sha512', u'\n'.join(lines) + u'\n')
+        return name + u'.tar.7z'
+
+    def process(self, income_backup_list, targets=(u'home', u'mail', u'work'), depth=3, metrics=None):
+        with catalog.ArchiveCatalog(self.path(u'dest')) as archive_catalog:
+            backup_tool.process_archives(income_backup_list, self.path(u'dest'),
+                                         chunkstore.ChunkIndex(self.path(u'dest', u'chunks')), archive_catalog, 2,
+                                         depth, metrics=metrics)
+            return dict((t, archive_catalog.versions(t)) for t in targets)
+
+
+class VerifyArchivesTest(ArchiveTestCase):
+
+    def test_broken_archives_are_removed(self):
+        home = self.archive(u'home-2024-01-31', u'home data')
+        mail = self.archive(u'mail-2024-01-31', u'mail data')
+        work = self.archive(u'work-2024-01-31', u'work data', volumes=3)
+        with io.open(self.path(u'dest', mail), 'ab') as mail_file:
+            mail_file.write(b'damage')
+        with io.open(self.path(u'dest', u'work-2024-01-31.v002.tar.7z'), 'ab') as volume_file:
+            volume_file.write(b'damage')
+
+        versions = self.process([home, mail, work])
+        self.assertEqual(versions, {u'home': [home], u'mail': [], u'work': []})
+        self.assertEqual(self.dest_files(), [u'catalog.db', u'home-2024-01-31.sha512', home])
+
+    def test_volumes_are_one_version(self):
+        work = self.archive(u'work-2024-01-31', u'work data', volumes=3)
+        self.assertEqual(self.process([work]), {u'home': [], u'mail': [], u'work': [work]})
+        with catalog.ArchiveCatalog(self.path(u'dest')) as archive_catalog:
+            self.assertEqual(archive_catalog.total_bytes(), {u'work': len(u'work data') * 6})
+
+    def test_missing_archive_is_skipped(self):
+        home = self.archive(u'home-2024-01-31', u'home data')
+        os.remove(self.path(u'dest', home))
+        self.assertEqual(self.process([home]), {u'home': [], u'mail': [], u'work': []})
+
+    def test_retention_is_kept_by_target_from_list(self):
+        targets = (u'my', u'my-data', u'my-logs')
+        data = self.archive(u'my-data-2024-01-30', u'data')
+        logs = self.archive(u'my-logs-2024-01-30', u'logs')
+        self.process([data + u'\tmy-data', logs + u'\tmy-logs'], targets, depth=1)
+        newer_data = self.archive(u'my-data-2024-01-31', u'newer data')
+        versions = self.process([newer_data + u'\tmy-data'], targets, depth=1)
+        self.assertEqual(versions, {u'my': [], u'my-data': [newer_data], u'my-logs': [logs]})
+        self.assertFalse(os.path.exists(self.path(u'dest', data)))
+
+    def test_versions_of_older_client_move_to_real_target(self):
+        targets = (u'my', u'my-data', u'my-logs')
+        data = self.archive(u'my-data-2024-01-30', u'data')
+        logs = self.archive(u'my-logs-2024-01-30', u'logs')
+        self.process([data], targets)
+        self.assertEqual(self.process([logs], targets)[u'my'], [data, logs])
+        newer_data = self.archive(u'my-data-2024-01-31', u'newer data')
+        versions = self.process([newer_data + u'\tmy-data'], targets)
+        self.assertEqual(versions, {u'my': [logs], u'my-data': [data, newer_data], u'my-logs': []})
+
+    def test_metrics_are_recorded_by_target(self):
+        self.process([self.archive(u'home-2024-01-30', u'old home data')], depth=1)
+        home = self.archive(u'home-2024-01-31', u'home data')
+        work = self.archive(u'work-2024-01-31', u'work data', volumes=2)
+        metrics = metrictool.RunMetrics(self.path(u'log', u'check.metrics.jsonl'), side=u'server')
+        self.process([home, work], depth=1, metrics=metrics)
+        records = dict(((r[u'target'], r[u'phase']), r) for r in metrics.load())
+        self.assertEqual(sorted(records.keys()), [(u'home', u'retention'), (u'home', u'verify'),
+                                                  (u'work', u'retention'), (u'work', u'verify')])
+        self.assertEqual(records[(u'home', u'verify')][u'bytes'], len(u'home data'))
+        self.assertEqual(records[(u'work', u'verify')][u'files'], 2)
+        self.assertEqual(records[(u'home', u'retention')][u'files'], 1)
+        self.assertEqual(records[(u'work', u'retention')][u'files'], 0)
+
+    def test_client_list_names_targets(self):
+        self.targets(u'my-data', u'my-logs')
+        self.controller().backup()
+        with io.open(self.path(u'dest', u'backup.lst'), 'r', encoding='utf8') as list_file:
+            entries = list_file.read().split(u'\n')
+        self.assertEqual(sorted(backup_tool.list_entry(e)[1] for e in entries), [u'my-data', u'my-logs'])
+        versions = self.process(entries, (u'my', u'my-data', u'my-logs'))
+        self.assertEqual([len(versions[t]) for t in (u'my', u'my-data', u'my-logs')], [0, 1, 1])
+
+
+class ScrubberTest(ArchiveTestCase):
+
+    def age(self, archive_catalog, days):
+        old_time = time.time() - days * 24 * 3600
+        with archive_catalog.conn:
+            archive_catalog.conn.execute(u'UPDATE archives SET verified = ?', (old_time,))
+
+    def scrub(self, archive_catalog, max_seconds=60):
+        chunk_index = chunkstore.ChunkIndex(self.path(u'dest', u'chunks'))
+        return scrubber.Scrubber(archive_catalog, chunk_index, 1000, max_seconds, 30)
+
+    def test_damaged_volume_marks_version_corrupted(self):
+        home = self.archive(u'home-2024-01-31', u'home data')
+        work = self.archive(u'work-2024-01-31', u'work data', volumes=3)
+        self.process([home, work])
+        with catalog.ArchiveCatalog(self.path(u'dest')) as archive_catalog:
+            self.assertEqual(archive_catalog.scrub_queue(30), [])
+            self.age(archive_catalog, 31)
+            with io.open(self.path(u'dest', u'work-2024-01-31.v002.tar.7z'), 'ab') as volume_file:
+                volume_file.write(b'damage')
+            self.assertEqual(self.scrub(archive_catalog).run(), (2, 1))
+            self.assertEqual([(t, n) for t, n, _ in archive_catalog.corrupted()], [(u'work', work)])
+            self.assertEqual(archive_catalog.scrub_queue(30), [])
+
+    def test_broken_chunk_marks_version_corrupted(self):
+        self.write(u'tg/home/data.bin', u'chunked data ' * 10000)
+        store = chunktool.ChunkStore(self.path(u'dest', u'chunks'))
+        res = chunktool.make_chunked_version(self.path(u'tg', u'home'), self.path(u'dest'), store,
+                                             name_suffix=u'-2024-01-31')
+        version = os.path.basename(res[1])
+        self.assertEqual(self.process([version])[u'home'], [version])
+        chunk_id = sorted(c[0] for c in chunkstore.load_manifest(res[1])[u'chunks'])[0]
+        with catalog.ArchiveCatalog(self.path(u'dest')) as archive_catalog:
+            self.age(archive_catalog, 31)
+            with io.open(os.path.join(self.path(u'dest', u'chunks'), chunk_id[:2], chunk_id), 'wb') as chunk_file:
+                chunk_file.write(b'broken')
+            self.assertEqual(self.scrub(archive_catalog).run(), (1, 1))
+            self.assertEqual([n for _, n, _ in archive_catalog.corrupted()], [version])
+
+    def test_run_stops_between_versions_when_time_is_over(self):
+        home = self.archive(u'home-2024-01-31', u'home data')
+        mail = self.archive(u'mail-2024-01-31', u'mail data')
+        self.process([home, mail])
+        with catalog.ArchiveCatalog(self.path(u'dest')) as archive_catalog:
+            self.age(archive_catalog, 31)
+            self.assertEqual(self.scrub(archive_catalog, max_seconds=0).run(), (0, 0))
+            first_scrubber = self.scrub(archive_catalog)
+            check_version = first_scrubber.check_version
+
+            def last_check(name, catalog_hash):
+                # time is over while the first version is read
+                first_scrubber.deadline = 0
+                return check_version(name, catalog_hash)
+            first_scrubber.check_version = last_check
+            self.assertEqual(first_scrubber.run(), (1, 0))
+            self.assertEqual(len(archive_catalog.scrub_queue(30)), 1)
+            self.assertEqual(self.scrub(archive_catalog).run(), (1, 0))
+            self.assertEqual(archive_catalog.scrub_queue(30), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Common fixture of tests: client and server modules on import path, sandbox directory with targets,
+service directory and local destination, stand-ins for network, NFS mount and 7z.
+"""
+import sys
+import os
+import io
+import shutil
+import logging
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'client'))
+sys.path.insert(0, os.path.join(ROOT, 'server'))
+
+import nettool
+import systool
+
+# controllers configure logging only when root logger has no handler, tests stay quiet
+logging.getLogger().addHandler(logging.NullHandler())
+
+# 7z stand-in: gzip is enough for tests, archives are only hashed and moved
+SEVEN_ZIP = u'''#!/bin/bash
+if [ "$1" = x ]; then gunzip -c "${@: -1}"; exit $?; fi
+si=0; files=()
+for a in "${@:2}"; do case "$a" in -si*) si=1;; -*) ;; *) files+=("$a");; esac; done
+if [ $si = 1 ]; then gzip -c > "${files[0]}"; else gzip -c "${files[1]}" > "${files[0]}"; fi
+'''
+
+CLIENT_CONFIG = u'''[targets]
+list_file = %(root)s/targets.txt
+[metadata]
+path = %(root)s/meta
+dict_file_name = dict.json
+%(metadata)s
+[archive]
+streaming = yes
+incremental = yes
+full_interval_days = 7
+[destination]
+mount_point = %(root)s/dest
+path = %(root)s/dest
+file_name_timestamp_format = %%%%Y-%%%%m-%%%%d
+list_file_name_template = backup.lst
+%(destination)s
+[server]
+ip = 127.0.0.1
+mac = 00:11:22:33:44:55
+[log]
+path = %(root)s/log
+name_time_format = %%%%Y-%%%%m-%%%%dT%%%%H-%%%%M
+file_name_template = backup-
+message_format = %%%%(asctime)s %%%%(levelname)s %%%%(message)s
+time_format = %%%%I:%%%%M:%%%%S %%%%p
+'''
+
+SERVER_CONFIG = u'''[log]
+path = %(root)s/log
+name_time_format = %%%%Y-%%%%m-%%%%dT%%%%H-%%%%M
+file_name_template = check-
+message_format = %%%%(asctime)s %%%%(levelname)s %%%%(message)s
+time_format = %%%%I:%%%%M:%%%%S %%%%p
+[target]
+path = %(root)s/dest
+depth = 3
+input_list_file = backup.lst
+'''
+
+
+class SandboxTestCase(unittest.TestCase):
+    """
+    Each test gets its own directory: targets in tg, service directory meta, destination dest.
+    Client runs against local destination, as NFS mount, wake-up and server start always succeed.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix=u'backup_test_').decode('utf8')
+        for name in (u'tg', u'meta', u'dest', u'log', u'bin'):
+            os.mkdir(os.path.join(self.root, name))
+        seven_zip = os.path.join(self.root, u'bin', u'7z')
+        with io.open(seven_zip, 'w', encoding='utf8') as script:
+            script.write(SEVEN_ZIP)
+        os.chmod(seven_zip, 0o755)
+        self.__path = os.environ.get('PATH', '')
+        os.environ['PATH'] = os.path.dirname(seven_zip).encode('utf8') + os.pathsep + self.__path
+        self.__patched = []
+        self.patch(nettool, 'ping', lambda *args, **kwargs: True)
+        self.patch(nettool, 'wait_server_ready', lambda *args, **kwargs: 0.0)
+        self.patch(systool, 'mount_nfs_folder', lambda path: True)
+        self.patch(systool, 'umount_nfs_folder', lambda path: True)
+        self.patch(systool, 'try_execute_command', lambda cmd: True)
+
+    def tearDown(self):
+        for owner, name, value in reversed(self.__patched):
+            setattr(owner, name, value)
+        os.environ['PATH'] = self.__path
+        shutil.rmtree(self.root)
+
+    def patch(self, owner, name, value):
+        self.__patched.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, value)
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def write(self, rel_path, content):
+        file_name = self.path(rel_path)
+        if not os.path.isdir(os.path.dirname(file_name)):
+            os.makedirs(os.path.dirname(file_name))
+        with io.open(file_name, 'w', encoding='utf8') as out_file:
+            out_file.write(content)
+        return file_name
+
+    def targets(self, *names):
+        """
+        Create target directories with few files, return their paths
+        """
+        paths = []
+        for name in names:
+            for number in range(3):
+                self.write(os.path.join(u'tg', name, u'sub', u'file%d.txt' % number), name * (number + 1) * 100)
+            paths.append(self.path(u'tg', name))
+        self.write(u'targets.txt', u'\n'.join(paths) + u'\n')
+        return paths
+
+    def config(self, extra=u'', destination=u'', metadata=u''):
+        """
+        Client config file: base config with extra options of metadata and destination sections and extra sections
+        """
+        return self.write(u'backup.cfg', CLIENT_CONFIG % {u'root': self.root, u'metadata': metadata,
+                                                          u'destination': destination} + extra)
+
+    def server_config(self, extra=u''):
+        return self.write(u'server.cfg', SERVER_CONFIG % {u'root': self.root} + extra)
+
+    def controller(self, extra=u'', destination=u'', metadata=u''):
+        import dirtool
+        return dirtool.BackupController(self.config(extra, destination, metadata))
+
+    def dest_files(self):
+        return sorted(os.listdir(self.path(u'dest')))